@@ -0,0 +1,472 @@
+"""
+Tile-bucketed spatial index for annotation files stored in GridFS.
+
+Every feature is split into parts (one point of a MultiPoint, one polygon of a
+MultiPolygon, or the whole geometry for Point/Polygon) and each part is written
+into every BUCKET_SIZE x BUCKET_SIZE bucket of full-resolution image space that
+its bounding box overlaps. A viewport query only reads the buckets under the
+viewport, so its cost follows the number of visible cells instead of the size
+of the slide.
+
+Bucket documents hold their parts in the columnar layout of columnar.py, so
+together they are also the stored form of the annotation geometry; the GeoJSON
+in GridFS is only needed for export. The index is written batch by batch as the
+GeoJSON is streamed (see SpatialIndexWriter), and read back the same way. Each
+document also carries its parts' levels of detail (see lod.py). Viewport and
+tile queries keep decoded buckets in a byte-bounded LRU (chunk_cache), so
+repeated views of the same slide do not read or decode them again.
+"""
+import os
+
+import numpy as np
+import pymongo
+
+from cache import ByteLRUCache
+
+from columnar import (
+    GEOMETRY_TYPES, PENDING_CLASS, chunk_fields, decode_chunk, gather_ranges, lengths_to_offsets, part_coordinates,
+    part_vertex_offsets,
+)
+from lod import CENTROID_LOD, apply_lod, lod_fields, lod_geometry_type, lod_projection
+from metrics import READ_BYTES, log_event, phase, register_cache
+
+BUCKET_SIZE = 1024  # Bucket edge in level-0 image pixels
+MAX_PARTS_PER_DOC = 5000  # Keeps bucket documents well below the 16 MB BSON limit
+MAX_VERTICES_PER_DOC = 125000  # 2 MB of float64 coordinates, plus their simplified levels
+INDEX_VERSION = 4
+ANNOTATION_CACHE_BYTES = int(os.getenv("ANNOTATION_CACHE_MB", "256")) * 1024 * 1024
+MAX_LISTED_BUCKETS = 256  # Buckets missing from the cache are fetched by name up to this many, else by range
+
+# Decoded bucket chunks by (file id, upload date, lod, bx, by), and bucket directories by (file id, upload date, "buckets")
+chunk_cache = ByteLRUCache(ANNOTATION_CACHE_BYTES)
+register_cache("annotation_buckets", chunk_cache)
+
+
+def bucket_range(x_min, y_min, x_max, y_max):
+    """
+    Returns the inclusive bucket column and row ranges covering a box.
+    Works on scalars and on arrays of boxes.
+    """
+    bx_min = np.maximum(np.floor_divide(x_min, BUCKET_SIZE), 0).astype(np.int64)
+    by_min = np.maximum(np.floor_divide(y_min, BUCKET_SIZE), 0).astype(np.int64)
+    bx_max = np.maximum(np.floor_divide(x_max, BUCKET_SIZE), 0).astype(np.int64)
+    by_max = np.maximum(np.floor_divide(y_max, BUCKET_SIZE), 0).astype(np.int64)
+    return bx_min, by_min, bx_max, by_max
+
+
+class SpatialIndexWriter:
+    """
+    Replaces the bucket documents of one GridFS annotation file with the parts of
+    columnar tables written batch by batch (see columnar.TableBuilder). The file
+    counts as indexed only after finish(), so an interrupted build is redone.
+    """
+
+    def __init__(self, db, file_doc):
+        self.db = db
+        self.file_id = file_doc["_id"]
+        self.metadata = file_doc.get("metadata", {})
+        self.next_seq = {}
+        self.part_sizes = []
+
+        invalidate_cached_file(self.file_id)
+        db.fs.files.update_one({"_id": self.file_id}, {"$unset": {"metadata.spatial_index": ""}})
+        db.annotation_buckets.delete_many({"file_id": self.file_id})
+
+    def write(self, table):
+        bbox = table["bbox"].astype(np.float64)
+        part_count = len(bbox)
+
+        # One entry per (part, bucket) pair, grouped by bucket with parts in their original order
+        bx_min, by_min, bx_max, by_max = bucket_range(bbox[:, 0], bbox[:, 1], bbox[:, 2], bbox[:, 3])
+        widths = bx_max - bx_min + 1
+        counts = widths * (by_max - by_min + 1)
+        entry_part = np.repeat(np.arange(part_count), counts)
+        within = np.arange(len(entry_part)) - np.repeat(np.cumsum(counts) - counts, counts)
+        entry_bx = bx_min[entry_part] + within % widths[entry_part]
+        entry_by = by_min[entry_part] + within // widths[entry_part]
+        order = np.lexsort((entry_part, entry_by, entry_bx))
+        entry_part, entry_bx, entry_by = entry_part[order], entry_bx[order], entry_by[order]
+        bucket_starts = np.flatnonzero(np.diff(entry_bx, prepend=-1) | np.diff(entry_by, prepend=-1))
+        bucket_ends = np.append(bucket_starts[1:], len(entry_part))
+
+        vertex_counts = np.diff(part_vertex_offsets(table))
+        shapes = vertex_counts > 1
+        if shapes.any():
+            # Typical on-screen size decides when parts are served as centroids (see lod.lod_for_view)
+            extents = np.maximum(bbox[shapes, 2] - bbox[shapes, 0], bbox[shapes, 3] - bbox[shapes, 1])
+            self.part_sizes.append(float(np.median(extents)))
+
+        bulk_operations = []
+        for start, end in zip(bucket_starts.tolist(), bucket_ends.tolist()):
+            bx, by = int(entry_bx[start]), int(entry_by[start])
+            parts = entry_part[start:end]
+            while len(parts):
+                # Split large buckets by part and vertex count, at least one part per document
+                vertices = np.cumsum(vertex_counts[parts[:MAX_PARTS_PER_DOC]])
+                size = max(int(np.searchsorted(vertices, MAX_VERTICES_PER_DOC, side="right")), 1)
+                seq = self.next_seq.get((bx, by), 0)
+                self.next_seq[(bx, by)] = seq + 1
+                fields = chunk_fields(table, parts[:size])
+                fields.update(lod_fields(decode_chunk(fields)))
+                bulk_operations.append(_bucket_document(self.file_id, self.metadata, bx, by, seq, fields))
+                parts = parts[size:]
+
+        if bulk_operations:
+            self.db.annotation_buckets.bulk_write(bulk_operations, ordered=False)
+
+    def finish(self, builder):
+        """
+        Records the index in the GridFS metadata, with the counts and class
+        dictionary of the TableBuilder that produced the batches.
+        """
+        self.db.fs.files.update_one({"_id": self.file_id}, {"$set": {"metadata.spatial_index": {
+            "version": INDEX_VERSION,
+            "bucket_size": BUCKET_SIZE,
+            "part_count": builder.part_count,
+            "bucket_count": len(self.next_seq),
+            "feature_count": len(builder.feature_ids),
+            "vertex_count": builder.vertex_count,
+            "part_size": float(np.median(self.part_sizes)) if self.part_sizes else None,
+            "classes": builder.classes,
+            "split_features": {str(fid): feature for fid, feature in builder.split_features.items()},
+        }}})
+        log_event("spatial_index_built", filename=self.metadata.get("filename"), parts=builder.part_count,
+                  buckets=len(self.next_seq), features=len(builder.feature_ids))
+
+
+def _bucket_document(file_id, metadata, bx, by, seq, fields):
+    return pymongo.InsertOne({
+        "file_id": file_id,
+        "dzi_file": metadata.get("dzi_file"),
+        "model_name": metadata.get("model_name"),
+        "bx": bx,
+        "by": by,
+        "seq": seq,
+        **fields,
+    })
+
+
+def is_indexed(metadata):
+    """
+    True when the GridFS metadata records an index built with the current layout.
+    """
+    spatial_index = (metadata or {}).get("spatial_index") or {}
+    return spatial_index.get("version") == INDEX_VERSION and spatial_index.get("bucket_size") == BUCKET_SIZE
+
+
+def index_metadata(db, file_id):
+    """
+    The spatial_index metadata of an annotation file (empty if it is not indexed).
+    """
+    file_doc = db.fs.files.find_one({"_id": file_id}, {"metadata.spatial_index": 1})
+    return ((file_doc or {}).get("metadata") or {}).get("spatial_index") or {}
+
+
+def _feature_label(chunk, local, spatial_index):
+    """
+    Id, class and own properties (None when its class holds them, see
+    columnar.TableBuilder) of a chunk's local feature; features cut across
+    ingest batches have theirs in the index metadata.
+    """
+    fid = int(chunk["fids"][local])
+    class_id = int(chunk["classes"][local])
+    if class_id == PENDING_CLASS:
+        split = spatial_index["split_features"][str(fid)]
+        return split["id"], split["class"], split.get("properties")
+    properties = chunk["properties"][local] if "properties" in chunk else None
+    return chunk["ids"][local], class_id, properties
+
+
+def query_spatial_table(db, file_doc, bounds=None, lod=0):
+    """
+    Returns the parts of one annotation file (its GridFS files document) that
+    overlap the bounds (x_min, y_min, x_max, y_max) as a columnar table, in file
+    order: feature_ids, feature_types (GEOMETRY_TYPES index at this lod) and
+    feature_classes per feature, feature_parts offsets into the parts, then
+    part_rings, ring_offsets and coords as in columnar.py. classes holds only
+    the classes these features use, and feature_classes index into it.
+    bounds=None returns every part; lod selects the level of detail (see lod.py).
+    """
+    if bounds is None:
+        return _select_parts(db, file_doc, None, lod, None)
+
+    x_min, y_min, x_max, y_max = bounds
+
+    def overlapping(chunk):
+        bboxes = chunk["bboxes"]
+        return (bboxes[:, 2] >= x_min) & (bboxes[:, 0] <= x_max) & (bboxes[:, 3] >= y_min) & (bboxes[:, 1] <= y_max)
+
+    return _select_parts(db, file_doc, bucket_range(x_min, y_min, x_max, y_max), lod, overlapping)
+
+
+def query_tile_table(db, file_doc, bucket_box, lod=0):
+    """
+    Like query_spatial_table, but returns the parts whose home bucket (the bucket
+    of their bounding box's minimum corner) lies in the inclusive bucket range
+    (bx_min, by_min, bx_max, by_max). Tiles made of whole buckets therefore hold
+    every part exactly once, in the tile where the part starts.
+    """
+    return _select_parts(db, file_doc, bucket_box, lod, _home_parts)
+
+
+def _home_parts(chunk):
+    """
+    Mask of the parts of a decoded bucket chunk whose home bucket is that chunk's.
+    """
+    bboxes = chunk["bboxes"].astype(np.float64)
+    home_bx, home_by, _, _ = bucket_range(bboxes[:, 0], bboxes[:, 1], bboxes[:, 0], bboxes[:, 1])
+    return (home_bx == chunk["bx"]) & (home_by == chunk["by"])
+
+
+def _decode_bucket(document, lod):
+    chunk = apply_lod(decode_chunk(document), document, lod)
+    chunk["bx"], chunk["by"] = document["bx"], document["by"]
+    return chunk
+
+
+def _chunk_size(chunks):
+    size = 0
+    for chunk in chunks:
+        size += sum(value.nbytes for value in chunk.values() if isinstance(value, np.ndarray))
+        size += 64 * len(chunk["ids"])  # Rough cost of the id objects
+        size += 512 * len(chunk.get("properties") or ())
+    return size + 256
+
+
+def _bucket_directory(db, file_doc):
+    """
+    Columns and rows of the buckets that hold documents of a file, as two arrays.
+    """
+    key = (file_doc["_id"], file_doc.get("uploadDate"), "buckets")
+    directory = chunk_cache.get(key)
+    if directory is None:
+        buckets = {(document["bx"], document["by"]) for document in db.annotation_buckets.find(
+            {"file_id": file_doc["_id"]}, {"_id": 0, "bx": 1, "by": 1})}
+        directory = np.array(sorted(buckets), dtype=np.int64).reshape(-1, 2)
+        chunk_cache.put(key, directory, directory.nbytes + 256)
+    return directory[:, 0], directory[:, 1]
+
+
+def _bucket_chunks(db, file_doc, bucket_box, lod):
+    """
+    Decoded chunks of a file's buckets within an inclusive bucket range (every
+    bucket if bucket_box is None) at a level of detail, read through chunk_cache.
+    Entries are keyed by GridFS file id and upload date, so a replaced
+    annotation file is never answered from the cache.
+    """
+    file_id = file_doc["_id"]
+    bxs, bys = _bucket_directory(db, file_doc)
+    if bucket_box is not None:
+        bx_min, by_min, bx_max, by_max = bucket_box
+        inside = (bxs >= bx_min) & (bxs <= bx_max) & (bys >= by_min) & (bys <= by_max)
+        bxs, bys = bxs[inside], bys[inside]
+
+    chunks = []
+    missing = []
+    for bx, by in zip(bxs.tolist(), bys.tolist()):
+        cached = chunk_cache.get((file_id, file_doc.get("uploadDate"), lod, bx, by))
+        if cached is None:
+            missing.append((bx, by))
+        else:
+            chunks.extend(cached)
+    if not missing:
+        return chunks
+
+    if len(missing) <= MAX_LISTED_BUCKETS:
+        query = {"file_id": file_id, "$or": [{"bx": bx, "by": by} for bx, by in missing]}
+    else:
+        query = {"file_id": file_id}
+        if bucket_box is not None:
+            query.update({"bx": {"$gte": int(bx_min), "$lte": int(bx_max)}, "by": {"$gte": int(by_min), "$lte": int(by_max)}})
+    wanted = set(missing)
+    documents = {}
+    read_bytes = 0
+    with phase("bucket_read"):
+        for document in db.annotation_buckets.find(query, lod_projection(lod)):
+            if (document["bx"], document["by"]) in wanted:
+                documents.setdefault((document["bx"], document["by"]), []).append(document)
+                read_bytes += sum(len(value) for value in document.values() if isinstance(value, bytes))
+    READ_BYTES.inc(read_bytes, source="annotation_buckets")
+    with phase("decode"):
+        for (bx, by), bucket_documents in documents.items():
+            bucket_chunks = [
+                _decode_bucket(document, lod) for document in sorted(bucket_documents, key=lambda d: d["seq"])
+            ]
+            chunk_cache.put((file_id, file_doc.get("uploadDate"), lod, bx, by), bucket_chunks, _chunk_size(bucket_chunks))
+            chunks.extend(bucket_chunks)
+    return chunks
+
+
+def invalidate_cached_file(file_id):
+    """
+    Drops every cached chunk of an annotation file (when it is deleted or re-indexed).
+    """
+    chunk_cache.discard_where(lambda key: key[0] == file_id)
+
+
+def _select_parts(db, file_doc, bucket_box, lod, select):
+    """
+    Gathers the parts that select(chunk) marks in the file's buckets within
+    bucket_box (all parts if select is None) into a query table.
+    """
+    spatial_index = (file_doc.get("metadata") or {}).get("spatial_index") or index_metadata(db, file_doc["_id"])
+    chunks = _bucket_chunks(db, file_doc, bucket_box, lod)
+    with phase("filter"):
+        return _gather_parts(chunks, spatial_index, lod, select)
+
+
+def _gather_parts(chunks, spatial_index, lod, select):
+    labels = {}  # fid -> (id, class, type, own properties)
+    pieces = []
+    for chunk in chunks:
+        selected = np.ones(len(chunk["pids"]), dtype=bool)
+        if select is not None:
+            selected &= select(chunk)
+        if lod == CENTROID_LOD:
+            # Parts without vertices have no centroid
+            selected &= ~np.isnan(chunk["coords"][:, 0])
+        parts = np.flatnonzero(selected)
+        if len(parts) == 0:
+            continue
+
+        part_locals = chunk["part_features"][parts]
+        for local in np.unique(part_locals).tolist():
+            fid = int(chunk["fids"][local])
+            if fid not in labels:
+                feature_id, class_id, properties = _feature_label(chunk, local, spatial_index)
+                geometry_type = lod_geometry_type(GEOMETRY_TYPES[chunk["types"][local]], lod)
+                labels[fid] = (feature_id, class_id, GEOMETRY_TYPES.index(geometry_type), properties)
+
+        rings, part_rings = gather_ranges(chunk["part_rings"].astype(np.int64), parts)
+        vertices, ring_offsets = gather_ranges(chunk["ring_offsets"].astype(np.int64), rings)
+        pieces.append((
+            chunk["pids"][parts], chunk["fids"][part_locals],
+            np.diff(part_rings), np.diff(ring_offsets), chunk["coords"][vertices],
+        ))
+
+    if not pieces:
+        return _query_table([], [], [], [0], [0], [0], np.zeros((0, 2), dtype=np.float32), [])
+
+    # Parts stored in several buckets are kept once; part numbers follow file order
+    pids, fids, ring_counts, ring_lengths, coords = (np.concatenate(column) for column in zip(*pieces))
+    _, order = np.unique(pids, return_index=True)
+    rings, part_rings = gather_ranges(lengths_to_offsets(ring_counts), order)
+    vertices, ring_offsets = gather_ranges(lengths_to_offsets(ring_lengths), rings)
+    feature_fids, feature_parts = np.unique(fids[order], return_index=True)
+
+    classes = spatial_index.get("classes", [])
+    feature_labels = [labels[fid] for fid in feature_fids.tolist()]
+    used_classes = sorted({label[1] for label in feature_labels if label[3] is None})
+    class_index = {class_id: index for index, class_id in enumerate(used_classes)}
+    table_classes = [classes[class_id] for class_id in used_classes]
+    feature_classes = []
+    for _, class_id, _, properties in feature_labels:
+        if properties is None:
+            feature_classes.append(class_index[class_id])
+        else:
+            # A feature with its own properties gets a class of its own in the query table
+            feature_classes.append(len(table_classes))
+            table_classes.append(properties)
+    return _query_table(
+        [label[0] for label in feature_labels],
+        [label[2] for label in feature_labels],
+        feature_classes,
+        np.append(feature_parts, len(order)), part_rings, ring_offsets, coords[vertices],
+        table_classes,
+    )
+
+
+def _query_table(feature_ids, feature_types, feature_classes, feature_parts, part_rings, ring_offsets, coords, classes):
+    return {
+        "feature_ids": feature_ids,
+        "feature_types": np.asarray(feature_types, dtype=np.uint8),
+        "feature_classes": np.asarray(feature_classes, dtype=np.uint32),
+        "feature_parts": np.asarray(feature_parts, dtype=np.int64),
+        "part_rings": np.asarray(part_rings, dtype=np.int64),
+        "ring_offsets": np.asarray(ring_offsets, dtype=np.int64),
+        "coords": coords,
+        "classes": classes,
+    }
+
+
+def table_features(table):
+    """
+    GeoJSON features of a query table (see query_spatial_table). Features keep
+    their original id, type and properties but only carry the queried parts.
+    """
+    features = []
+    feature_parts = table["feature_parts"].tolist()
+    for feature, feature_id in enumerate(table["feature_ids"]):
+        geometry_type = GEOMETRY_TYPES[table["feature_types"][feature]]
+        coordinates = [
+            part_coordinates(table, part, geometry_type)
+            for part in range(feature_parts[feature], feature_parts[feature + 1])
+        ]
+        if geometry_type in ("Point", "Polygon"):
+            coordinates = coordinates[0]
+        features.append({
+            "type": "Feature",
+            "id": feature_id,
+            "geometry": {"type": geometry_type, "coordinates": coordinates},
+            "properties": table["classes"][table["feature_classes"][feature]],
+        })
+    return features
+
+
+def query_spatial_index(db, file_doc, bounds=None, lod=0):
+    """
+    Returns the features of one annotation file whose parts overlap the bounds
+    (x_min, y_min, x_max, y_max), as GeoJSON (see query_spatial_table).
+    """
+    return table_features(query_spatial_table(db, file_doc, bounds, lod))
+
+
+def accumulate_index(db, file_id, accumulator):
+    """
+    Feeds every part of an indexed annotation file into a hexbin accumulator
+    (see hexbin.HexbinAccumulator), one bucket document at a time. A part stored
+    in several buckets is only added from the bucket of its bounding box's
+    minimum corner. Returns the file's feature ids, feature classes and class
+    dictionary for HexbinAccumulator.pyramid.
+    """
+    spatial_index = index_metadata(db, file_id)
+    feature_ids = [None] * spatial_index.get("feature_count", 0)
+    feature_classes = np.zeros(len(feature_ids), dtype=np.uint32)
+
+    for document in db.annotation_buckets.find({"file_id": file_id}, lod_projection(0)):
+        chunk = _decode_bucket(document, 0)
+        for local in range(len(chunk["fids"])):
+            fid = int(chunk["fids"][local])
+            feature_ids[fid], feature_classes[fid], _ = _feature_label(chunk, local, spatial_index)
+
+        parts = np.flatnonzero(_home_parts(chunk))
+        if len(parts) == 0:
+            continue
+        vertices, part_offsets = gather_ranges(
+            chunk["ring_offsets"][chunk["part_rings"]].astype(np.int64), parts
+        )
+        accumulator.add(
+            chunk["coords"][vertices], part_offsets, chunk["pids"][parts],
+            chunk["fids"][chunk["part_features"][parts]],
+        )
+
+    return feature_ids, feature_classes, spatial_index.get("classes", [])
+
+
+def iter_part_centroids(db, file_id):
+    """
+    Yields (centroids, classes) for every bucket document of an indexed
+    annotation file: the centroid of each part whose home bucket it is (so every
+    part comes once) and the class of its feature, an index into the file's class
+    dictionary (spatial_index["classes"]). Parts without vertices are left out.
+    """
+    spatial_index = index_metadata(db, file_id)
+    for document in db.annotation_buckets.find({"file_id": file_id}, lod_projection(CENTROID_LOD)):
+        chunk = _decode_bucket(document, CENTROID_LOD)
+        parts = np.flatnonzero(_home_parts(chunk) & ~np.isnan(chunk["coords"][:, 0]))
+        if len(parts) == 0:
+            continue
+        feature_classes = np.array(
+            [_feature_label(chunk, local, spatial_index)[1] for local in range(len(chunk["fids"]))], dtype=np.int64
+        )
+        yield chunk["coords"][parts], feature_classes[chunk["part_features"][parts]]
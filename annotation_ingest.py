@@ -0,0 +1,63 @@
+"""
+Streaming ingest of GeoJSON annotation files.
+
+The file is read from its GridFS (or upload) stream with geojson_stream, turned
+into columnar batches of about columnar.BATCH_VERTICES vertices, and every batch
+is written to the spatial index and added to the hexbin counts before the next
+one is read. Peak memory is one batch of geometry plus the per-feature ids and
+classes, however large the file is.
+"""
+from annotation_index import SpatialIndexWriter, accumulate_index
+from columnar import TableBuilder
+from geojson_stream import iter_geojson_events
+from hexbin import HexbinAccumulator
+
+
+def ingest_geojson_stream(db, file_doc, stream, resolutions=(), progress=None):
+    """
+    Builds the spatial index of a GridFS annotation file from a binary stream of
+    its GeoJSON. With resolutions, also returns its hexbin pyramid
+    ({resolution: hex_bins}, see hexbin.HexbinAccumulator.pyramid).
+    progress(done_bytes, total_bytes) is called after every batch when the
+    stream has a length (as GridFS files do).
+    """
+    metadata = file_doc.get("metadata", {})
+    accumulator = None
+    if resolutions:
+        accumulator = HexbinAccumulator(metadata["image_width"], metadata["image_height"], max(resolutions))
+    builder = TableBuilder()
+    writer = SpatialIndexWriter(db, file_doc)
+    total = getattr(stream, "length", None)
+
+    def flush():
+        table = builder.take()
+        writer.write(table)
+        if accumulator is not None:
+            accumulator.add_table(table)
+        if progress and total:
+            progress(stream.tell(), total)
+
+    for event in iter_geojson_events(stream):
+        if event[0] == "part":
+            builder.add_part(event[1], event[2])
+        else:
+            builder.end_feature(event[1])
+        if builder.ready():
+            flush()
+    flush()
+    writer.finish(builder)
+
+    if accumulator is None:
+        return None
+    return accumulator.pyramid(builder.feature_ids, builder.feature_classes, builder.classes, resolutions)
+
+
+def index_hex_pyramid(db, file_doc, resolutions):
+    """
+    Hexbin pyramid of an annotation file that is already indexed, read back one
+    bucket document at a time.
+    """
+    metadata = file_doc.get("metadata", {})
+    accumulator = HexbinAccumulator(metadata["image_width"], metadata["image_height"], max(resolutions))
+    feature_ids, feature_classes, classes = accumulate_index(db, file_doc["_id"], accumulator)
+    return accumulator.pyramid(feature_ids, feature_classes, classes, resolutions)
@@ -0,0 +1,70 @@
+"""
+Tile-aligned annotation serving.
+
+Besides viewport queries, annotations are served per fixed grid tile, the way
+DeepZoom serves image tiles: a tile is keyed by slide, model, level of detail
+and tile column/row, and holds the parts that start in it (see
+annotation_index.query_tile_table). Adjacent tiles never repeat a part, so a
+pan only fetches the tiles along the newly exposed edge. Tiles are
+TILE_BUCKETS index buckets wide at full detail and twice as wide at every
+coarser level, so a viewport needs about the same number of tiles at any zoom.
+
+Tile URLs carry the version of the annotation set (tile_version): the GridFS
+files of the slide and model and the layout they were indexed with. The content
+under a URL therefore never changes; tiles are sent with a strong ETag as
+immutable, and built tiles are kept in a bounded in-memory cache.
+"""
+import hashlib
+import json
+import os
+
+from annotation_index import BUCKET_SIZE, INDEX_VERSION
+from cache import ByteLRUCache
+from lod import LOD_TOLERANCES
+from metrics import register_cache
+
+TILE_BUCKETS = 1  # Tile edge at full detail, in index buckets
+TILE_CACHE_BYTES = int(os.getenv("ANNOTATION_TILE_CACHE_MB", "128")) * 1024 * 1024
+IMMUTABLE = "public, max-age=31536000, immutable"
+TILE_FORMATS = {"bin", "json"}
+
+tile_cache = ByteLRUCache(TILE_CACHE_BYTES)
+register_cache("annotation_tiles", tile_cache)
+
+
+def tile_size(lod):
+    """
+    Tile edge in level-0 image pixels at a level of detail.
+    """
+    return BUCKET_SIZE * (TILE_BUCKETS << lod)
+
+
+def tile_bucket_box(lod, tx, ty):
+    """
+    Inclusive bucket range (bx_min, by_min, bx_max, by_max) of a tile.
+    """
+    buckets = TILE_BUCKETS << lod
+    return tx * buckets, ty * buckets, (tx + 1) * buckets - 1, (ty + 1) * buckets - 1
+
+
+def tile_version(file_docs):
+    """
+    Version of the annotation set made of these GridFS files (with their
+    spatial_index metadata): changes when a file is added, replaced or indexed
+    with another layout.
+    """
+    files = sorted(
+        [str(file_doc["_id"]), file_doc["metadata"]["spatial_index"].get("part_count"),
+         file_doc["metadata"]["spatial_index"].get("vertex_count")]
+        for file_doc in file_docs
+    )
+    key = json.dumps([INDEX_VERSION, BUCKET_SIZE, TILE_BUCKETS, list(LOD_TOLERANCES), files])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def tile_etag(dzi_file, model_name, version, lod, tx, ty, tile_format):
+    """
+    Strong ETag (unquoted) of a tile; also its key in tile_cache.
+    """
+    key = json.dumps([dzi_file, model_name, version, lod, tx, ty, tile_format])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
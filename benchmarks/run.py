@@ -0,0 +1,477 @@
+"""
+End-to-end benchmarks for tiling, annotation ingestion and annotation queries.
+
+    python benchmarks/run.py [--cells 100,400] [--slide-size 4096x3072] [--viewports 512,2048,8192]
+                             [--queries 50] [--workers N] [--mongo mock|URI] [--only tiles,session,ingest,queries]
+                             [--tile-configs 128:jpeg,256:jpeg,256:webp] [--output FILE] [--compare FILE]
+
+Everything runs on synthetic data (see synthetic.py) in a scratch directory:
+
+- tiles: full DeepZoom pyramids of a pyramidal TIFF (tiler.generate_deepzoom)
+  and of a PNG patch (tiler.generate_deepzoom_patch), and cold on-demand
+  tiles of the TIFF (tile_server.get_tile). Reports tiles/sec.
+- session: the image tiles a viewer requests during a typical viewing session
+  (session_views: fit the slide, zoom in by halves to full resolution, pan
+  across), for each --tile-configs tile size, format and optional quality.
+  Reports the request count, bytes and render time of the session.
+- ingest: ingest_annotation_file on a CellViT-style file per --cells count
+  (GridFS write, streamed spatial index, hex bins). Reports features, parts
+  (cells) and vertices per second.
+- queries: /get_normalized_annotations and /get_hex_bins through the Flask test
+  client, for square viewports of each --viewports size (level-0 pixels) at
+  random positions. Reports p50/p99 latency in ms, JSON and binary.
+
+Every result also records the peak RSS of the stage. MongoDB is mongomock by
+default, which measures the application code plus mongomock's own overhead:
+mongomock scans the collection for every query, so a hexbin query takes about
+a second per few thousand stored hex bins. The default run takes a few minutes
+there, and the queries stage refuses --cells above MOCK_MAX_CELLS. Pass a URI
+(e.g. mongodb://localhost:27017) for a local mongod, where --cells defaults to
+2000,20000 and the benchmark uses its own database (MONGO_DB_NAME, default
+annotationsDB_bench) and drops it afterwards. Results are written as JSON;
+--compare prints the ratio of every metric to those of an earlier results file.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import synthetic  # noqa: E402
+
+MODEL_NAME = "cellvit"
+VIEWER_WIDTH = 1280
+STAGES = ("tiles", "session", "ingest", "queries")
+ON_DEMAND_TILES = 200  # Cold tiles rendered by tile_server.get_tile
+SESSION_VIEWPORT = (1600, 900)  # Screen pixels of the viewer in the session benchmark
+SESSION_PANS = 6  # Half-screen pans at full resolution
+MOCK_CELLS = "100,400"  # Default --cells; hexbin queries on mongomock scan every stored bin
+SERVER_CELLS = "2000,20000"
+MOCK_MAX_CELLS = 1000
+
+
+def reset_peak_rss():
+    """
+    Starts a new peak RSS measurement where the kernel allows it (Linux); elsewhere the process peak is kept.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def children_peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def latency_stats(seconds):
+    milliseconds = np.array(seconds) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(milliseconds, 50)), 3),
+        "p99_ms": round(float(np.percentile(milliseconds, 99)), 3),
+        "mean_ms": round(float(milliseconds.mean()), 3),
+        "requests": len(seconds),
+    }
+
+
+def result(benchmark, name, params, **metrics):
+    entry = {"benchmark": benchmark, "name": name, "params": params, "metrics": metrics}
+    print(f"{benchmark}/{name} {json.dumps(params)}: {json.dumps(metrics)}")
+    return entry
+
+
+def use_mongo(target, database_name):
+    """
+    Points mongo.py at mongomock ("mock") or at the MongoDB server of a URI.
+    """
+    os.environ["MONGO_DB_NAME"] = database_name
+    if target != "mock":
+        os.environ["MONGO_URI"] = target
+        import mongo
+        return mongo
+
+    import mongomock
+    import mongomock.gridfs
+    from mongomock.collection import BulkOperationBuilder
+
+    mongomock.gridfs.enable_gridfs_integration()
+    # pymongo >= 4.9 passes a sort option to bulk updates that mongomock does not know
+    add_replace, add_update = BulkOperationBuilder.add_replace, BulkOperationBuilder.add_update
+    BulkOperationBuilder.add_replace = lambda self, *args, sort=None, **kwargs: add_replace(self, *args, **kwargs)
+    BulkOperationBuilder.add_update = lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs)
+
+    import mongo
+    mongo.set_client(mongomock.MongoClient())
+    return mongo
+
+
+def bench_tiles(width, height, workers):
+    import tile_server
+    import tiler
+
+    results = []
+    os.makedirs(tile_server.UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs("output", exist_ok=True)
+    params = {"width": width, "height": height, "workers": workers}
+
+    slide_name = "synthetic.tiff"
+    slide_path = synthetic.write_tiff_slide(os.path.join(tile_server.UPLOAD_FOLDER, slide_name), width, height)
+    tiles_path = os.path.join("output", slide_name + "_files")
+    reset_peak_rss()
+    started = time.perf_counter()
+    tiler.generate_deepzoom(slide_path, os.path.join("output", slide_name + ".dzi"), tiles_path, workers=workers)
+    elapsed = time.perf_counter() - started
+    tiles = sum(len(files) for _, _, files in os.walk(tiles_path))
+    results.append(result(
+        "tiles", "deepzoom_tiff", params, tiles=tiles, seconds=round(elapsed, 3),
+        tiles_per_sec=round(tiles / elapsed, 1), peak_rss_mb=peak_rss_mb(), workers_peak_rss_mb=children_peak_rss_mb(),
+    ))
+
+    # Cold on-demand tiles: every tile is requested once, so each one is rendered
+    generator = tile_server.get_generator(slide_path)
+    level = generator.level_count - 1
+    cols, rows = generator.level_tiles[level]
+    addresses = [(col, row) for col in range(cols) for row in range(rows)]
+    random.Random(0).shuffle(addresses)
+    addresses = addresses[:ON_DEMAND_TILES]
+    reset_peak_rss()
+    timings = []
+    for col, row in addresses:
+        started = time.perf_counter()
+        tile_server.get_tile(f"{slide_name}_files/{level}/{col}_{row}.{tiler.TILE_FORMAT}")
+        timings.append(time.perf_counter() - started)
+    results.append(result(
+        "tiles", "on_demand_tiff", dict(params, level=level), tiles=len(addresses),
+        tiles_per_sec=round(len(addresses) / sum(timings), 1), peak_rss_mb=peak_rss_mb(), **latency_stats(timings),
+    ))
+
+    from PIL import Image
+    patch_name = "synthetic.png"
+    patch_path = synthetic.write_png_slide(os.path.join(tile_server.UPLOAD_FOLDER, patch_name), width, height)
+    tiles_path = os.path.join("output", patch_name + "_files")
+    reset_peak_rss()
+    started = time.perf_counter()
+    with Image.open(patch_path) as img:
+        tiler.generate_deepzoom_patch(img, os.path.join("output", patch_name + ".dzi"), tiles_path)
+    elapsed = time.perf_counter() - started
+    tiles = sum(len(files) for _, _, files in os.walk(tiles_path))
+    results.append(result(
+        "tiles", "deepzoom_png", params, tiles=tiles, seconds=round(elapsed, 3),
+        tiles_per_sec=round(tiles / elapsed, 1), peak_rss_mb=peak_rss_mb(),
+    ))
+    return results
+
+
+def session_views(width, height, viewport=SESSION_VIEWPORT, pans=SESSION_PANS):
+    """
+    The views of a typical viewing session as (scale, center x, center y), with
+    scale in screen pixels per level-0 pixel: the whole slide, zooming in by
+    factors of two on its center up to full resolution, then panning right.
+    """
+    view_width, view_height = viewport
+    scale = min(view_width / width, view_height / height, 1.0)
+    views = [(scale, width / 2, height / 2)]
+    while scale < 1.0:
+        scale = min(scale * 2, 1.0)
+        views.append((scale, width / 2, height / 2))
+    for pan in range(1, pans + 1):
+        views.append((1.0, min(width / 2 + pan * view_width / 2, width - view_width / 2), height / 2))
+    return views
+
+
+def session_tiles(generator, tile_size, views, viewport=SESSION_VIEWPORT):
+    """
+    The (level, col, row) of every tile the views need, each counted once as the
+    browser caches it: the level matching the scale of a view, and the level
+    below it, which the viewer shows while the sharper tiles load.
+    """
+    top_level = generator.level_count - 1
+    width, height = generator.level_dimensions[top_level]
+    tiles = set()
+    for scale, center_x, center_y in views:
+        best = top_level - int(np.floor(np.log2(1 / scale) + 1e-9))
+        half_width, half_height = viewport[0] / scale / 2, viewport[1] / scale / 2
+        for level in (best, best - 1):
+            if level < 0:
+                continue
+            level_scale = 2 ** (level - top_level)
+            level_width, level_height = generator.level_dimensions[level]
+            x0 = max(0, (center_x - half_width) * level_scale)
+            y0 = max(0, (center_y - half_height) * level_scale)
+            x1 = min(level_width, (center_x + half_width) * level_scale)
+            y1 = min(level_height, (center_y + half_height) * level_scale)
+            tiles.update(
+                (level, col, row)
+                for col in range(int(x0 // tile_size), int(np.ceil(x1 / tile_size)))
+                for row in range(int(y0 // tile_size), int(np.ceil(y1 / tile_size)))
+            )
+    return sorted(tiles)
+
+
+def bench_session(width, height, tile_configs):
+    import io
+
+    import openslide
+    import tile_server
+    import tiler
+
+    results = []
+    os.makedirs(tile_server.UPLOAD_FOLDER, exist_ok=True)
+    slide_path = os.path.join(tile_server.UPLOAD_FOLDER, "session.tiff")
+    synthetic.write_tiff_slide(slide_path, width, height)
+    slide = openslide.OpenSlide(slide_path)
+    views = session_views(width, height)
+    for config in tile_configs:
+        tile_size, tile_format, *quality = config.split(":")
+        tile_size = int(tile_size)
+        quality = int(quality[0]) if quality else tiler.TILE_QUALITY
+        generator = tiler.open_generator(slide, tile_size, tiler.TILE_OVERLAP)
+        addresses = session_tiles(generator, tile_size, views)
+        total_bytes = 0
+        started = time.perf_counter()
+        for level, col, row in addresses:
+            buffer = io.BytesIO()
+            tiler.save_tile(generator.get_tile(level, (col, row)), buffer, tile_format, quality)
+            total_bytes += buffer.tell()
+        elapsed = time.perf_counter() - started
+        results.append(result(
+            "session", f"{tile_size}_{tile_format}",
+            {"width": width, "height": height, "tile_size": tile_size, "format": tile_format, "quality": quality,
+             "overlap": tiler.TILE_OVERLAP, "views": len(views), "viewport": list(SESSION_VIEWPORT)},
+            requests=len(addresses), kilobytes=round(total_bytes / 1024, 1),
+            kilobytes_per_tile=round(total_bytes / 1024 / max(len(addresses), 1), 2),
+            render_ms_per_tile=round(elapsed * 1000 / max(len(addresses), 1), 3),
+        ))
+    slide.close()
+    return results
+
+
+def dataset_name(cells):
+    return f"synthetic-{cells}.tiff"
+
+
+def bench_ingest(cell_counts, width, height):
+    from geojson_routes import ingest_annotation_file
+    import mongo
+
+    results = []
+    os.makedirs("spool", exist_ok=True)
+    for cells in cell_counts:
+        dzi_file = dataset_name(cells)
+        spool_path = os.path.join("spool", f"{cells}.geojson")
+        synthetic.write_cellvit_geojson(spool_path, cells, width, height, seed=cells)
+        file_size = os.path.getsize(spool_path)
+
+        reset_peak_rss()
+        started = time.perf_counter()
+        ingest_annotation_file(
+            spool_path, f"{os.path.splitext(dzi_file)[0]}_{MODEL_NAME}.geojson", dzi_file, MODEL_NAME,
+            width, height, replace=True,
+        )
+        elapsed = time.perf_counter() - started
+        spatial_index = mongo.database.fs.files.find_one({"metadata.dzi_file": dzi_file})["metadata"]["spatial_index"]
+        results.append(result(
+            "ingest", "annotation_file", {"cells": cells, "width": width, "height": height},
+            seconds=round(elapsed, 3), file_mb=round(file_size / 2 ** 20, 2),
+            features_per_sec=round(spatial_index["feature_count"] / elapsed, 1),
+            parts_per_sec=round(spatial_index["part_count"] / elapsed, 1),
+            vertices_per_sec=round(spatial_index["vertex_count"] / elapsed, 1),
+            peak_rss_mb=peak_rss_mb(),
+        ))
+    return results
+
+
+def viewport_bounds(rng, size, width, height):
+    size = min(size, width, height)
+    x = rng.uniform(0, width - size)
+    y = rng.uniform(0, height - size)
+    return {"xMin": x, "xMax": x + size, "yMin": y, "yMax": y + size}
+
+
+def bench_queries(cell_counts, viewports, queries, width, height):
+    from flask import Flask
+    from geojson_routes import geojson_blueprint
+
+    app = Flask(__name__)
+    app.register_blueprint(geojson_blueprint)
+    client = app.test_client()
+
+    results = []
+    for cells in cell_counts:
+        dzi_file = dataset_name(cells)
+        for size in viewports:
+            zoom = width / min(size, width)
+            for response_format in ("json", "binary"):
+                params = {"cells": cells, "viewport": size, "format": response_format}
+                requests = {
+                    "viewport": ("/get_normalized_annotations", lambda bounds: {
+                        "filename": dzi_file + ".dzi", "bounds": bounds, "zoom": zoom,
+                        "modelName": MODEL_NAME, "viewerWidth": VIEWER_WIDTH, "format": response_format,
+                    }),
+                    "hexbin": ("/get_hex_bins", lambda bounds: {
+                        "dzi_file": dzi_file, "bounds": bounds, "zoom": zoom, "format": response_format,
+                    }),
+                }
+                for name, (path, body) in requests.items():
+                    rng = random.Random(size)
+                    reset_peak_rss()
+                    timings, sizes = [], []
+                    for _ in range(queries):
+                        payload = body(viewport_bounds(rng, size, width, height))
+                        started = time.perf_counter()
+                        response = client.post(path, json=payload)
+                        data = response.get_data()
+                        timings.append(time.perf_counter() - started)
+                        if response.status_code != 200:
+                            raise RuntimeError(f"{path} answered {response.status_code}: {data[:200]!r}")
+                        sizes.append(len(data))
+                    results.append(result(
+                        "queries", name, params, **latency_stats(timings),
+                        mean_response_kb=round(sum(sizes) / len(sizes) / 1024, 1), peak_rss_mb=peak_rss_mb(),
+                    ))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(entry):
+    return entry["benchmark"], entry["name"], json.dumps(entry["params"], sort_keys=True)
+
+
+def compare(results, baseline_path):
+    """
+    Prints every metric next to the same metric of an earlier run, with new/old ratios.
+    """
+    with open(baseline_path) as f:
+        baseline = {result_key(entry): entry for entry in json.load(f)["results"]}
+    print(f"Compared with {baseline_path} (ratio new/old):")
+    unmatched = 0
+    for entry in results:
+        old = baseline.get(result_key(entry))
+        if old is None:
+            unmatched += 1
+            continue
+        changes = [
+            f"{metric} {old['metrics'][metric]} -> {value} ({value / old['metrics'][metric]:.2f}x)"
+            for metric, value in entry["metrics"].items()
+            if isinstance(value, (int, float)) and old["metrics"].get(metric)
+        ]
+        print(f"  {entry['benchmark']}/{entry['name']} {json.dumps(entry['params'])}: " + "; ".join(changes))
+    if unmatched:
+        print(f"  {unmatched} results have no counterpart with the same parameters.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tiling, annotation ingestion and annotation queries.")
+    parser.add_argument("--cells", help=f"comma-separated cell counts of the annotation files "
+                                         f"(default {MOCK_CELLS} on mongomock, {SERVER_CELLS} on a server)")
+    parser.add_argument("--slide-size", default="4096x3072", help="WIDTHxHEIGHT of the synthetic slides")
+    parser.add_argument("--viewports", default="512,2048,8192", help="comma-separated viewport sizes in pixels")
+    parser.add_argument("--queries", type=int, default=50, help="requests per query benchmark")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="DeepZoom worker processes")
+    parser.add_argument("--mongo", default="mock", help="'mock' for mongomock, or a MongoDB URI")
+    parser.add_argument("--database", default=os.getenv("MONGO_DB_NAME", "annotationsDB_bench"),
+                        help="database used on a MongoDB server (dropped afterwards)")
+    parser.add_argument("--only", default=",".join(STAGES), help="comma-separated stages to run")
+    parser.add_argument("--tile-configs", default="128:jpeg,256:jpeg,256:webp,512:webp",
+                        help="comma-separated SIZE:FORMAT[:QUALITY] tile settings of the session benchmark")
+    parser.add_argument("--output", default=None, help="results file (default: bench_results_<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    width, height = (int(value) for value in args.slide_size.lower().split("x"))
+    cells = args.cells or (MOCK_CELLS if args.mongo == "mock" else SERVER_CELLS)
+    cell_counts = [int(value) for value in cells.split(",")]
+    viewports = [int(value) for value in args.viewports.split(",")]
+    stages = [stage for stage in args.only.split(",") if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    if "queries" in stages and "ingest" not in stages:
+        parser.error("the queries stage needs the ingest stage")
+    if args.mongo == "mock" and "queries" in stages and max(cell_counts) > MOCK_MAX_CELLS:
+        parser.error(f"hexbin queries over more than {MOCK_MAX_CELLS} cells take too long on mongomock; "
+                     f"pass --mongo with the URI of a MongoDB server, or --only tiles,session,ingest")
+    if args.mongo != "mock" and args.database == "annotationsDB":
+        parser.error("the benchmark database is dropped afterwards; pick another than annotationsDB")
+    output = os.path.abspath(args.output or f"bench_results_{time.strftime('%Y%m%d-%H%M%S')}.json")
+
+    mongo = use_mongo(args.mongo, args.database)
+    workdir = tempfile.mkdtemp(prefix="cell-annotator-bench-")
+    os.environ["JOBS_DB"] = os.path.join(workdir, "jobs.db")
+    os.chdir(workdir)
+    print(f"Benchmarking in {workdir} against {'mongomock' if args.mongo == 'mock' else args.mongo}.")
+
+    results = []
+    try:
+        if "tiles" in stages:
+            results += bench_tiles(width, height, args.workers)
+        if "session" in stages:
+            results += bench_session(width, height, args.tile_configs.split(","))
+        if "ingest" in stages:
+            results += bench_ingest(cell_counts, width, height)
+        if "queries" in stages:
+            results += bench_queries(cell_counts, viewports, args.queries, width, height)
+    finally:
+        if args.mongo != "mock":
+            mongo.get_client().drop_database(args.database)
+        if not args.keep:
+            os.chdir(REPO_DIR)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "mongo": "mongomock" if args.mongo == "mock" else "mongod",
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Synthetic inputs for the benchmarks: slides and CellViT-style annotation files.
+
+Slides are pink "tissue" blobs with noise on a white background, so tile
+encoding does real work, written as a PNG (the patch path) or a tiled,
+pyramidal TIFF that OpenSlide reads as a generic TIFF. Annotation files follow
+the CellViT export: one MultiPolygon feature per cell class, each cell a small
+closed ring, with cells clustered in the same blobs as the tissue.
+"""
+import json
+import math
+
+import numpy as np
+from PIL import Image
+
+CELL_CLASSES = [
+    ("Neoplastic", [255, 0, 0]),
+    ("Inflammatory", [34, 221, 77]),
+    ("Connective", [35, 92, 236]),
+    ("Dead", [254, 255, 0]),
+    ("Epithelial", [255, 159, 68]),
+]
+RING_POINTS = 16  # Vertices per cell outline, as in CellViT contours
+TIFF_TILE = 256
+
+
+def tissue_centers(width, height, seed=0, count=12):
+    """
+    (x, y, radius) of the tissue blobs, shared by the slide and its annotations.
+    """
+    rng = np.random.default_rng(seed)
+    radius = min(width, height) / 6
+    return [
+        (rng.uniform(0, width), rng.uniform(0, height), rng.uniform(0.5, 1.0) * radius)
+        for _ in range(count)
+    ]
+
+
+def slide_pixels(width, height, seed=0):
+    """
+    RGB array of a synthetic slide.
+    """
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    tissue = np.zeros((height, width), dtype=bool)
+    for x, y, radius in tissue_centers(width, height, seed):
+        tissue |= (xs - x) ** 2 + (ys - y) ** 2 < radius ** 2
+    pixels = np.full((height, width, 3), 245, dtype=np.uint8)
+    noise = rng.integers(-25, 25, size=(height, width, 1), dtype=np.int16)
+    stain = np.clip(np.array([214, 120, 170], dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+    pixels[tissue] = stain[tissue]
+    return pixels
+
+
+def write_png_slide(path, width, height, seed=0):
+    Image.fromarray(slide_pixels(width, height, seed)).save(path)
+    return path
+
+
+def write_tiff_slide(path, width, height, seed=0):
+    """
+    Tiled, deflate-compressed TIFF with a level per halving down to one tile.
+    """
+    import tifffile
+
+    level = slide_pixels(width, height, seed)
+    with tifffile.TiffWriter(path, bigtiff=width * height * 3 > 2 ** 31) as tif:
+        first = True
+        while True:
+            tif.write(level, tile=(TIFF_TILE, TIFF_TILE), compression='zlib', photometric='rgb',
+                      subfiletype=0 if first else 1)
+            first = False
+            if max(level.shape[:2]) <= TIFF_TILE:
+                break
+            level = level[::2, ::2]
+    return path
+
+
+def cell_rings(cells, width, height, seed=0):
+    """
+    Array (cells, RING_POINTS + 1, 2) of closed cell outlines and the class index of each cell.
+    """
+    rng = np.random.default_rng(seed + 1)
+    centers = tissue_centers(width, height, seed)
+    blob = rng.integers(0, len(centers), size=cells)
+    blobs = np.array(centers)[blob]
+    angle = rng.uniform(0, 2 * math.pi, size=cells)
+    distance = np.sqrt(rng.uniform(0, 1, size=cells)) * blobs[:, 2]
+    cx = np.clip(blobs[:, 0] + distance * np.cos(angle), 10, width - 10)
+    cy = np.clip(blobs[:, 1] + distance * np.sin(angle), 10, height - 10)
+    radius = rng.uniform(4, 9, size=cells)
+
+    steps = np.linspace(0, 2 * math.pi, RING_POINTS, endpoint=False)
+    jitter = rng.uniform(0.8, 1.2, size=(cells, RING_POINTS))
+    rings = np.empty((cells, RING_POINTS + 1, 2))
+    rings[:, :-1, 0] = cx[:, None] + radius[:, None] * jitter * np.cos(steps)
+    rings[:, :-1, 1] = cy[:, None] + radius[:, None] * jitter * np.sin(steps)
+    rings[:, -1] = rings[:, 0]
+    return np.round(rings, 1), rng.integers(0, len(CELL_CLASSES), size=cells)
+
+
+def write_cellvit_geojson(path, cells, width, height, seed=0):
+    """
+    Writes a CellViT-style FeatureCollection with about `cells` cells; returns the number of features.
+    """
+    rings, classes = cell_rings(cells, width, height, seed)
+    with open(path, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        for index, (name, color) in enumerate(CELL_CLASSES):
+            polygons = [[ring.tolist()] for ring in rings[classes == index]]
+            if index:
+                f.write(', ')
+            json.dump({
+                "type": "Feature",
+                "id": f"{name.lower()}-{seed}",
+                "geometry": {"type": "MultiPolygon", "coordinates": polygons},
+                "properties": {"objectType": "annotation", "classification": {"name": name, "color": color}},
+            }, f)
+        f.write(']}')
+    return len(CELL_CLASSES)
@@ -0,0 +1,321 @@
+"""
+Columnar layout for annotation geometry.
+
+A parsed GeoJSON file is converted once into flat arrays: one coordinate
+buffer, ring offsets into it, part offsets into the rings, the feature of each
+part, part bounding boxes, and per feature its id, geometry type and class.
+Feature properties are stored once per distinct value in a class dictionary
+(in practice the classification name and color of each class). Past
+MAX_CLASSES distinct values, a feature keeps its own properties in a
+per-feature column and its class in the dictionary is its classification alone.
+
+Tables are built incrementally (TableBuilder), so a file streamed from GridFS
+is converted in fixed-size batches rather than as one document. Arrays are
+written to MongoDB as raw bytes and read back with np.frombuffer, so reading a
+chunk does not copy or parse its coordinates.
+"""
+import json
+
+import numpy as np
+from bson.binary import Binary
+
+GEOMETRY_TYPES = ["Point", "MultiPoint", "Polygon", "MultiPolygon"]
+MAX_CLASSES = 1024  # Beyond this many distinct properties, only classifications are added to the dictionary
+BATCH_VERTICES = 1 << 18  # Vertices per streamed batch table
+PENDING_CLASS = np.iinfo(np.uint32).max  # Class of a feature that was still being read when its batch was cut
+
+
+def encode_features(features):
+    """
+    Converts GeoJSON features into a columnar table. Features without a supported
+    geometry are left out; the order of features, parts, rings and points is kept.
+    """
+    builder = TableBuilder(batch_vertices=None)
+    for feature in features:
+        geometry = feature.get("geometry")
+        if not geometry or geometry.get("type") not in GEOMETRY_TYPES or not geometry.get("coordinates"):
+            continue
+        geometry_type = geometry["type"]
+        parts = geometry["coordinates"] if geometry_type in ("MultiPoint", "MultiPolygon") else [geometry["coordinates"]]
+        for part in parts:
+            builder.add_part(geometry_type, part)
+        builder.end_feature(feature)
+    return builder.take()
+
+
+class TableBuilder:
+    """
+    Builds columnar tables from a stream of parts (see geojson_stream) in batches
+    of about batch_vertices vertices, so a file of any size is converted with
+    bounded memory. Part and feature numbers continue from batch to batch: a
+    batch table's part i is part part_start + i of the file, its feature j is
+    feature feature_start + j.
+
+    The id and class of a feature are known once the feature ends (CellViT writes
+    properties after the geometry), so a batch cut inside a feature has the
+    feature's class set to PENDING_CLASS; its id and class are kept in
+    split_features instead. The class dictionary keeps growing across batches;
+    after MAX_CLASSES distinct properties, new ones only add their classification
+    and the feature's own properties go in the table's feature_properties (None
+    for the features whose class holds them).
+    """
+
+    def __init__(self, batch_vertices=BATCH_VERTICES):
+        self.batch_vertices = batch_vertices
+        self.classes = []
+        self.class_of_key = {}
+        self.feature_ids = []
+        self.feature_classes = []
+        self.split_features = {}
+        self.part_count = 0
+        self.vertex_count = 0
+        self.current_vertices = None  # Vertices of the feature being read, None between features
+        self._reset(0)
+
+    def _reset(self, feature_start):
+        self.part_start = self.part_count
+        self.feature_start = feature_start
+        self.coordinates = []
+        self.ring_offsets = [0]
+        self.part_rings = [0]
+        self.part_feature = []
+        self.batch_types = []
+        self.batch_properties = []
+
+    def add_part(self, geometry_type, coordinates):
+        """
+        Appends one part of the current feature: a point for Point and MultiPoint,
+        a list of rings for Polygon and MultiPolygon.
+        """
+        if self.current_vertices is None:
+            self.current_vertices = 0
+            self.feature_ids.append(None)
+            self.feature_classes.append(PENDING_CLASS)
+            self.batch_types.append(GEOMETRY_TYPES.index(geometry_type))
+            self.batch_properties.append(None)
+        vertices = len(self.coordinates)
+
+        if geometry_type in ("Point", "MultiPoint"):
+            self.coordinates.append(coordinates)
+            self.ring_offsets.append(self.ring_offsets[-1] + 1)
+            self.part_rings.append(self.part_rings[-1] + 1)
+        else:
+            for ring in coordinates:
+                self.coordinates.extend(ring)
+                self.ring_offsets.append(self.ring_offsets[-1] + len(ring))
+            self.part_rings.append(self.part_rings[-1] + len(coordinates))
+        self.part_feature.append(len(self.feature_ids) - 1 - self.feature_start)
+
+        self.part_count += 1
+        self.current_vertices += len(self.coordinates) - vertices
+        self.vertex_count += len(self.coordinates) - vertices
+
+    def end_feature(self, feature):
+        """
+        Completes the current feature with its id and properties. A feature that
+        had no parts is left out.
+        """
+        if self.current_vertices is None:
+            return
+        fid = len(self.feature_ids) - 1
+        self.feature_ids[fid] = feature.get("id")
+        self.feature_classes[fid], properties = self._class_of(feature.get("properties") or {})
+        self.batch_properties[fid - self.feature_start] = properties
+        if fid in self.split_features:
+            self.split_features[fid] = {"id": self.feature_ids[fid], "class": self.feature_classes[fid]}
+            if properties is not None:
+                self.split_features[fid]["properties"] = properties
+        self.current_vertices = None
+
+    def _class_of(self, properties):
+        """
+        Dictionary class of a feature's properties, and the properties the feature
+        keeps itself: None, unless the dictionary is full and its class only
+        holds the classification.
+        """
+        key = json.dumps(properties, sort_keys=True)
+        own = None
+        if key not in self.class_of_key and len(self.classes) >= MAX_CLASSES:
+            classification = {"classification": properties["classification"]} if "classification" in properties else {}
+            if classification != properties:
+                own = properties
+            properties, key = classification, json.dumps(classification, sort_keys=True)
+        if key not in self.class_of_key:
+            self.class_of_key[key] = len(self.classes)
+            self.classes.append(properties)
+        return self.class_of_key[key], own
+
+    def ready(self):
+        """
+        True once the buffered batch should be taken. Outside of a feature that is
+        when it holds batch_vertices vertices; inside one only when that feature
+        alone has grown this large, so small features are not split.
+        """
+        if self.batch_vertices is None:
+            return False
+        if self.current_vertices is not None:
+            return self.current_vertices >= self.batch_vertices
+        return len(self.coordinates) >= self.batch_vertices
+
+    def take(self):
+        """
+        Returns the buffered parts as a table and starts the next batch.
+        """
+        feature_count = len(self.feature_ids)
+        feature_start = self.feature_start
+        feature_classes = np.array(self.feature_classes[feature_start:], dtype=np.uint32)
+        if self.current_vertices is not None:
+            # Cut inside a feature: it continues in the next batch
+            self.split_features.setdefault(feature_count - 1, None)
+
+        points = np.array(self.coordinates, dtype=np.float64).reshape(-1, 2)
+        # Whole-pixel (or float32-exact) coordinates are stored at half the size without loss
+        narrow = points.astype(np.float32)
+        if np.array_equal(narrow, points):
+            points = narrow
+
+        table = {
+            "coords": points,
+            "ring_offsets": np.array(self.ring_offsets, dtype=np.int64),
+            "part_rings": np.array(self.part_rings, dtype=np.int64),
+            "part_feature": np.array(self.part_feature, dtype=np.int64),
+            "part_start": self.part_start,
+            "feature_start": feature_start,
+            "feature_ids": self.feature_ids[feature_start:],
+            "feature_types": np.array(self.batch_types, dtype=np.uint8),
+            "feature_classes": feature_classes,
+            "feature_properties": self.batch_properties,
+            "classes": self.classes,
+        }
+        table["bbox"] = part_bboxes(table)
+
+        if self.current_vertices is None:
+            self._reset(feature_count)
+        else:
+            self._reset(feature_count - 1)
+            self.batch_types = [table["feature_types"][-1]]
+            self.batch_properties = [None]
+            self.current_vertices = 0
+        return table
+
+
+def part_vertex_offsets(table):
+    """
+    Offsets of each part's first vertex in the coordinate buffer (length parts + 1).
+    """
+    return table["ring_offsets"][table["part_rings"]]
+
+
+def part_bboxes(table):
+    """
+    [x_min, y_min, x_max, y_max] of every part, in the coordinate dtype.
+    """
+    coords = table["coords"]
+    offsets = part_vertex_offsets(table)
+    if len(offsets) < 2:
+        return np.zeros((0, 4), dtype=coords.dtype)
+    # Empty parts get whatever reduceat yields for them; they are never drawn
+    starts = np.minimum(offsets[:-1], max(len(coords) - 1, 0))
+    if len(coords) == 0:
+        return np.zeros((len(starts), 4), dtype=coords.dtype)
+    return np.concatenate([
+        np.minimum.reduceat(coords, starts, axis=0),
+        np.maximum.reduceat(coords, starts, axis=0),
+    ], axis=1)
+
+
+def lengths_to_offsets(lengths):
+    """
+    Offsets (length n + 1, starting at 0) of consecutive ranges with the given lengths.
+    """
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def gather_ranges(offsets, indices):
+    """
+    For ranges [offsets[i], offsets[i + 1]) of the given indices, returns the
+    concatenated positions and the offsets of the ranges within them.
+    """
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    new_offsets = lengths_to_offsets(lengths)
+    positions = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1] - starts, lengths)
+    return positions, new_offsets
+
+
+def chunk_fields(table, parts):
+    """
+    Serializes the given parts (sorted part indices) of a table into the binary
+    columns of one chunk document. Features are renumbered locally so a chunk
+    carries the id, type and class of every feature it references, and the
+    properties of those that keep their own; pids and fids are the numbers
+    within the whole file.
+    """
+    rings, part_rings = gather_ranges(table["part_rings"], parts)
+    vertices, ring_offsets = gather_ranges(table["ring_offsets"], rings)
+    fids, part_features = np.unique(table["part_feature"][parts], return_inverse=True)
+    coords = table["coords"]
+
+    fields = {
+        "dtype": coords.dtype.str,
+        "part_count": len(parts),
+        "vertex_count": len(vertices),
+        "fids": Binary((fids + table["feature_start"]).astype(np.uint32).tobytes()),
+        "ids": [table["feature_ids"][fid] for fid in fids.tolist()],
+        "types": Binary(table["feature_types"][fids].tobytes()),
+        "classes": Binary(table["feature_classes"][fids].astype(np.uint32).tobytes()),
+        "pids": Binary((parts + table["part_start"]).astype(np.uint32).tobytes()),
+        "part_features": Binary(part_features.ravel().astype(np.uint32).tobytes()),
+        "bboxes": Binary(table["bbox"][parts].tobytes()),
+        "part_rings": Binary(part_rings.astype(np.uint32).tobytes()),
+        "ring_offsets": Binary(ring_offsets.astype(np.uint32).tobytes()),
+        "coords": Binary(np.ascontiguousarray(coords[vertices]).tobytes()),
+    }
+    properties = [table["feature_properties"][fid] for fid in fids.tolist()]
+    if any(feature_properties is not None for feature_properties in properties):
+        fields["properties"] = properties
+    return fields
+
+
+def decode_chunk(document):
+    """
+    Read-only NumPy views over the binary columns of a chunk document. Columns
+    left out of the document by a projection are left out of the chunk.
+    """
+    dtype = np.dtype(document["dtype"])
+    columns = {
+        "fids": (np.uint32, None),
+        "types": (np.uint8, None),
+        "classes": (np.uint32, None),
+        "pids": (np.uint32, None),
+        "part_features": (np.uint32, None),
+        "bboxes": (dtype, 4),
+        "part_rings": (np.uint32, None),
+        "ring_offsets": (np.uint32, None),
+        "coords": (dtype, 2),
+    }
+    chunk = {"ids": document["ids"]}
+    if "properties" in document:
+        chunk["properties"] = document["properties"]
+    for name, (column_dtype, width) in columns.items():
+        if name in document:
+            values = np.frombuffer(document[name], dtype=column_dtype)
+            chunk[name] = values if width is None else values.reshape(-1, width)
+    return chunk
+
+
+def part_coordinates(chunk, part, geometry_type):
+    """
+    GeoJSON coordinates of one part of a decoded chunk: a point for Point and
+    MultiPoint features, a list of rings for Polygon and MultiPolygon features.
+    """
+    ring_offsets = chunk["ring_offsets"]
+    first_ring, end_ring = int(chunk["part_rings"][part]), int(chunk["part_rings"][part + 1])
+    if geometry_type in ("Point", "MultiPoint"):
+        return chunk["coords"][ring_offsets[first_ring]].tolist()
+    return [
+        chunk["coords"][ring_offsets[ring]:ring_offsets[ring + 1]].tolist()
+        for ring in range(first_ring, end_ring)
+    ]
@@ -2,10 +2,13 @@
 
 import React, { useState } from 'react';
 import axios from 'axios';
+import { chunkedUpload } from './chunkedUpload';
+import { waitForJob } from './jobs';
 
 const Upload = ({ onSuccess }) => {
   const [file, setFile] = useState(null);
   const [uploadType, setUploadType] = useState('wsi'); // 'wsi' or 'patch'
+  const [status, setStatus] = useState('');
 
   const handleFileChange = (event) => {
     setFile(event.target.files[0]);
@@ -17,19 +20,32 @@ const Upload = ({ onSuccess }) => {
       return;
     }
 
-    const formData = new FormData();
-    formData.append('file', file);
-
-    const endpoint = uploadType === 'patch'
-      ? `${process.env.REACT_APP_BACKEND_URL}/upload_patch`
-      : `${process.env.REACT_APP_BACKEND_URL}/upload`;
-
     try {
-      const response = await axios.post(endpoint, formData, {
-        headers: {
-          'Content-Type': 'multipart/form-data'
-        }
-      });
+      let response;
+      if (uploadType === 'patch') {
+        const formData = new FormData();
+        formData.append('file', file);
+        response = await axios.post(`${process.env.REACT_APP_BACKEND_URL}/upload_patch`, formData, {
+          headers: {
+            'Content-Type': 'multipart/form-data'
+          }
+        });
+      } else {
+        // Slides go up in resumable chunks; an identical slide already on the server is reused
+        response = await chunkedUpload(process.env.REACT_APP_BACKEND_URL, file, (done, total) => {
+          setStatus(`Uploading: ${Math.round((done / total) * 100)}%`);
+        });
+        setStatus('');
+      }
+
+      // 202 means the tiles are generated by a background job
+      if (response.status === 202 && response.data.job_id) {
+        await waitForJob(process.env.REACT_APP_BACKEND_URL, response.data.job_id, (job) => {
+          setStatus(`Converting: ${Math.round(job.progress * 100)}%`
+            + (job.eta_seconds != null ? ` (about ${Math.ceil(job.eta_seconds)}s left)` : ''));
+        });
+        setStatus('');
+      }
 
       if (response.data.dzi_path) {
         onSuccess(response.data.dzi_path);
@@ -37,6 +53,7 @@ const Upload = ({ onSuccess }) => {
         console.error('DZI path not found in response:', response.data);
       }
     } catch (error) {
+      setStatus('');
       console.error('Error uploading file:', error);
     }
   };
@@ -65,6 +82,7 @@ const Upload = ({ onSuccess }) => {
       </div>
       <input type="file" onChange={handleFileChange} />
       <button className='upload-btn' onClick={handleUpload}>Upload</button>
+      {status && <span style={{ marginLeft: '12px' }}>{status}</span>}
     </div>
   );
 };
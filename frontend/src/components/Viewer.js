@@ -4,6 +4,13 @@ import axios from 'axios';
 import * as PIXI from 'pixi.js';
 import { Application } from 'pixi.js';
 import './Viewer.css';
+import { waitForJob } from './jobs';
+import {
+  decodeHexBins, decodeJsonBody, featureCount, groupClassifications, hexBinClassifications, isWireMessage,
+  mergeHexBinPages, wireRequestConfig,
+} from './wireFormat';
+import { annotationLodForView, fetchAnnotationTiles, fetchTileInfo, tileUrlsForBounds } from './annotationTiles';
+import { fetchOverlayInfo, overlayTileSource } from './overlayTiles';
 // import * as h3 from 'h3-js';
 
 
@@ -23,9 +30,18 @@ const Viewer = ({ dziUrl, filename }) => {
   const [currentDziUrl, setCurrentDziUrl] = useState(dziUrl); // Manage the selected DZI URL
   const [annotationsByFile, setAnnotationsByFile] = useState({}); // Store annotations grouped by filename
   const [notification, setNotification] = useState('');
-  const hexBinsRef = useRef([]);
+  const hexBinsRef = useRef(null); // Decoded hex bins of the current resolution (see wireFormat.js)
+  const hexBinCacheRef = useRef({}); // Hex bins of the selected image by H3 resolution, with the bounds they cover
+  const hexResolutionsRef = useRef([]); // Resolutions stored for the selected image
+  const tileInfoRef = useRef(null); // Annotation tile descriptor of the selected image and model
   const [availableModels, setAvailableModels] = useState([]); // Store available models
   const [selectedModel, setSelectedModel] = useState(''); // Track selected model
+  // Raster overlay mode: the backend draws the annotations into image tiles shown as a tiled layer
+  const [rasterOverlay, setRasterOverlay] = useState(false);
+  const rasterOverlayRef = useRef(false); // Read by the OpenSeadragon handlers, which keep their first closure
+  const [overlayInfo, setOverlayInfo] = useState(null); // Overlay tile descriptor of the selected image and model
+  const [hiddenOverlayClasses, setHiddenOverlayClasses] = useState({}); // Class name -> true when hidden
+  const overlayItemRef = useRef(null); // The overlay's TiledImage in the viewer
 
   // Helper to determine if the current image is a patch
   const isPatch = selectedImage && (selectedImage.endsWith('.png.dzi') || selectedImage.endsWith('.png'));
@@ -49,8 +65,15 @@ const Viewer = ({ dziUrl, filename }) => {
     setCurrentDziUrl(`${process.env.REACT_APP_BACKEND_URL}/output/${selectedImage}`); // Update DZI URL
 
     const imageFilename = selectedImage.replace('.dzi', ''); // Remove .dzi from the filename
+    if (imageFilename.endsWith('.png')) {
+      // Patches keep their vector annotations, which are drawn with an offset
+      rasterOverlayRef.current = false;
+      setRasterOverlay(false);
+    }
 
-    await fetchHexBins(imageFilename, 2); // Fetch and store hex bins for this image
+    hexBinCacheRef.current = {};
+    hexResolutionsRef.current = [];
+    await fetchHexBins(imageFilename, 1); // Fetch and store hex bins for this image at the initial zoom
   };
 
   const fetchAvailableModels = async () => {
@@ -70,7 +93,24 @@ const Viewer = ({ dziUrl, filename }) => {
     setSelectedModel(event.target.value);
   };
 
+  const handleRasterOverlayChange = (event) => {
+    rasterOverlayRef.current = event.target.checked;
+    setRasterOverlay(event.target.checked);
+    setAnnotationsByFile({});
+    setAnnotations([]);
+    if (pixiAppRef.current) {
+      pixiAppRef.current.stage.removeChildren();
+      pixiAppRef.current.renderer.render(pixiAppRef.current.stage);
+    }
+    if (!event.target.checked && viewer) {
+      handlePanZoomEnd(); // Back to hex bins or vector annotations for the current view
+    }
+  };
+
   const renderHexBins = () => {
+    if (rasterOverlayRef.current) {
+      return; // The raster overlay shows the annotations at every zoom
+    }
     if (zoomValue > 7) {
       return; // Skip rendering hex bins
     }
@@ -80,65 +120,66 @@ const Viewer = ({ dziUrl, filename }) => {
     }
 
     const hexBins = hexBinsRef.current; // Read from ref
-    if (!Array.isArray(hexBins) || hexBins.length === 0) {
+    if (!hexBins || !hexBins.count) {
       console.warn("HexBins is not valid or empty:", hexBins);
       return;
     }
     // Create a new Graphics object
     const graphics = new PIXI.Graphics();
     setNotification('Zoom in to view individual annotations.');
-    hexBins.forEach((bin) => {
-      const { image_coordinates, classifications } = bin;
-
-      if (!Array.isArray(image_coordinates) || image_coordinates.length === 0) {
-        console.warn(`Invalid or empty image_coordinates for bin:`, bin);
-        return;
+    const { boundary, boundaryOffsets, classOffsets } = hexBins;
+    for (let bin = 0; bin < hexBins.count; bin++) {
+      if (boundaryOffsets[bin] === boundaryOffsets[bin + 1]) {
+        console.warn(`Invalid or empty image_coordinates for bin:`, hexBins.hex_ids[bin]);
+        continue;
       }
 
-      if (!classifications || Object.keys(classifications).length === 0) {
-        console.warn(`No classifications data for bin:`, bin);
-        return;
+      if (classOffsets[bin] === classOffsets[bin + 1]) {
+        console.warn(`No classifications data for bin:`, hexBins.hex_ids[bin]);
+        continue;
       }
 
       // Calculate the gradient color for the bin
-      const gradientColor = calculateGradientColor(classifications);
+      const gradientColor = calculateGradientColor(hexBins, bin);
 
       // Draw the hexbin
-      image_coordinates.forEach(([x, y], index) => {
+      for (let point = boundaryOffsets[bin]; point < boundaryOffsets[bin + 1]; point++) {
         // Transform image coordinates to viewport coordinates
-        const viewportPoint = viewer.viewport.imageToViewportCoordinates(x, y);
+        const viewportPoint = viewer.viewport.imageToViewportCoordinates(boundary[2 * point], boundary[2 * point + 1]);
 
         // Transform viewport coordinates to screen coordinates
         const screenPoint = viewer.viewport.viewportToViewerElementCoordinates(viewportPoint);
 
-        if (index === 0) {
+        if (point === boundaryOffsets[bin]) {
           graphics.moveTo(screenPoint.x, screenPoint.y);
         } else {
           graphics.lineTo(screenPoint.x, screenPoint.y);
         }
-      });
+      }
 
       graphics.closePath();
       graphics.beginFill(gradientColor, 0.3); // Use the calculated gradient color with transparency
       graphics.endFill();
-    });
+    }
 
     pixiAppRef.current.stage.addChild(graphics);
 
     pixiAppRef.current.renderer.render(pixiAppRef.current.stage);
   };
-  const calculateGradientColor = (classifications) => {
+  const calculateGradientColor = (hexBins, bin) => {
+    const { classOffsets, classCounts, classColors } = hexBins;
     let totalWeight = 0;
     let red = 0;
     let green = 0;
     let blue = 0;
 
-    Object.values(classifications).forEach(({ count, color }) => {
+    for (let k = classOffsets[bin]; k < classOffsets[bin + 1]; k++) {
+      const count = classCounts[k];
       totalWeight += count;
-      red += color[0] * count;
-      green += color[1] * count;
-      blue += color[2] * count;
-    });
+      red += classColors[3 * k] * count;
+      green += classColors[3 * k + 1] * count;
+      blue += classColors[3 * k + 2] * count;
+    }
 
     if (totalWeight === 0) return 0x666666; // Default gray if no data
 
@@ -206,9 +247,8 @@ const Viewer = ({ dziUrl, filename }) => {
       const initialVisibility = {};
       Object.entries(annotationsByFile).forEach(([filename, annotationGroup]) => {
         initialVisibility[filename] = {};
-        annotationGroup.forEach(({ properties }) => {
-          const type = properties.classification.name;
-          initialVisibility[filename][type] = true; // Default to visible
+        groupClassifications(annotationGroup).forEach(({ name }) => {
+          initialVisibility[filename][name] = true; // Default to visible
         });
       });
       setVisibleAnnotations(initialVisibility);
@@ -216,20 +256,32 @@ const Viewer = ({ dziUrl, filename }) => {
   }, [annotationsByFile]);
 
   const fetchNormalizedAnnotations = async (bounds, filename) => {
+    if (rasterOverlayRef.current) {
+      return {}; // Annotations come as overlay tiles instead
+    }
     const currentZoom = viewer.viewport.getZoom();
     if (!isPatch && currentZoom <= 7) {
       setNotification('Zoom in to view annotations.');
       return;
     }
+    if (!selectedModel) {
+      setNotification('Select a model to view annotations.');
+      return {};
+    }
     const actualFilename = filename.replace('.dzi', '');
+    const baseUrl = process.env.REACT_APP_BACKEND_MONGODB_URL;
     try {
       addBlur();
       setNotification('Loading Annotations...'); // Set loading before fetch
-      const response = await axios.post(
-        `${process.env.REACT_APP_BACKEND_MONGODB_URL}/get_normalized_annotations`,
-        { bounds, filename: actualFilename, zoom: currentZoom, modelName: selectedModel }
-      );
-      const data = response.data;
+      const infoKey = `${actualFilename}/${selectedModel}`;
+      if (!tileInfoRef.current || tileInfoRef.current.key !== infoKey) {
+        tileInfoRef.current = { key: infoKey, info: await fetchTileInfo(baseUrl, actualFilename, selectedModel) };
+      }
+      const { info } = tileInfoRef.current;
+      // Annotations come in fixed tiles at the level of detail (centroids, simplified or full contours)
+      // matching the zoom, so a pan only fetches the tiles that were not in view before
+      const lod = annotationLodForView(currentZoom, viewer.container.clientWidth, info);
+      const data = await fetchAnnotationTiles(tileUrlsForBounds(baseUrl, info, lod, bounds));
       if (!data || Object.keys(data).length === 0) {
         setAnnotationsByFile({});
         setNotification(`No annotations found for model '${selectedModel}'.`);
@@ -242,9 +294,8 @@ const Viewer = ({ dziUrl, filename }) => {
       const initialVisibility = {};
       Object.entries(data).forEach(([filename, annotationGroup]) => {
         initialVisibility[filename] = {};
-        annotationGroup.forEach(({ properties }) => {
-          const type = properties.classification.name;
-          initialVisibility[filename][type] = true; // Default all to visible
+        groupClassifications(annotationGroup).forEach(({ name }) => {
+          initialVisibility[filename][name] = true; // Default all to visible
         });
       });
       setVisibleAnnotations(initialVisibility);
@@ -254,6 +305,7 @@ const Viewer = ({ dziUrl, filename }) => {
       return data;
     } catch (error) {
       console.error('Error fetching normalized annotations:', error);
+      tileInfoRef.current = null; // The annotations may have changed; fetch the tile descriptor again
       setNotification('Error fetching annotations. Please try again.');
       removeBlur();
       return {};
@@ -267,21 +319,6 @@ const Viewer = ({ dziUrl, filename }) => {
 
 
 
-  const filteredGeometryHasData = (geometry) => {
-    if (!geometry.coordinates) return false;
-
-    if (geometry.type === "Polygon" || geometry.type === "MultiPolygon") {
-      return geometry.coordinates.length > 0 && geometry.coordinates.some((ring) => ring.length > 0);
-    }
-
-    if (geometry.type === "Point" || geometry.type === "MultiPoint") {
-      return geometry.coordinates.length > 0;
-    }
-
-    return false;
-  };
-
-
   const removeBlur = () => {
     const viewerElement = document.getElementById('openseadragon-viewer');
     viewerElement.classList.remove('blur');
@@ -339,29 +376,29 @@ const Viewer = ({ dziUrl, filename }) => {
 
       // Log annotation file processing
 
-      // Draw each annotation
-      annotationGroup.forEach((annotation, annotationIndex) => {
-        const { geometry, properties } = annotation;
+      // Draw each annotation straight from the decoded columns (see wireFormat.js)
+      const { classes, geometryTypes, featureTypes, featureClasses, featureParts, partRings, ringOffsets, coords } = annotationGroup;
+      for (let feature = 0; feature < featureCount(annotationGroup); feature++) {
+        const properties = classes[featureClasses[feature]];
+        const geometryType = geometryTypes[featureTypes[feature]];
 
-        if (!geometry || !filteredGeometryHasData(geometry)) {
-          console.warn(`Annotation ${annotationIndex} skipped: Invalid or empty geometry.`, annotation);
-          return;
+        if (featureParts[feature] === featureParts[feature + 1]) {
+          console.warn(`Annotation ${feature} skipped: Invalid or empty geometry.`, annotationGroup.featureIds[feature]);
+          continue;
         }
 
-        // Log geometry type
-
         // Check if the annotation type is visible
-        const annotationType = properties.classification.name;
+        const annotationType = properties?.classification?.name;
         const isVisible = fileVisibility[annotationType];
         if (!isVisible) {
-          return;
+          continue;
         }
 
         // Ensure the annotation has valid color information
         const color = properties?.classification?.color;
         if (!color) {
-          console.warn(`Annotation ${annotationIndex} skipped: Missing color information.`, annotation);
-          return;
+          console.warn(`Annotation ${feature} skipped: Missing color information.`, annotationGroup.featureIds[feature]);
+          continue;
         }
 
         // Create a new Graphics object for this annotation type
@@ -370,17 +407,16 @@ const Viewer = ({ dziUrl, filename }) => {
         // Convert RGB color to hexadecimal
         const hexColor = (color[0] << 16) + (color[1] << 8) + color[2];
 
-        if (geometry.type === "Polygon" || geometry.type === "MultiPolygon") {
-          // Handle Polygon and MultiPolygon
-          geometry.coordinates.forEach((polygon, polygonIndex) => {
-
-            polygon.forEach((ring, ringIndex) => {
+        if (geometryType === "Polygon" || geometryType === "MultiPolygon") {
+          // Handle Polygon and MultiPolygon: every part is a polygon, every ring a path
+          for (let part = featureParts[feature]; part < featureParts[feature + 1]; part++) {
+            for (let ring = partRings[part]; ring < partRings[part + 1]; ring++) {
 
               graphics.beginFill(hexColor, 0.6); // Add fill color with transparency
-              ring.forEach(([x, y], pointIndex) => {
+              for (let point = ringOffsets[ring]; point < ringOffsets[ring + 1]; point++) {
                 // Apply offset adjustment for patches in image coordinates
-                let xOffset = x;
-                let yOffset = y;
+                let xOffset = coords[2 * point];
+                let yOffset = coords[2 * point + 1];
                 if (isPatch) {
                   xOffset += 32;
                   yOffset += 32;
@@ -388,23 +424,24 @@ const Viewer = ({ dziUrl, filename }) => {
                 const viewportPoint = viewer.viewport.imageToViewportCoordinates(xOffset, yOffset);
                 const screenPoint = viewer.viewport.viewportToViewerElementCoordinates(viewportPoint);
 
-                if (pointIndex === 0) {
+                if (point === ringOffsets[ring]) {
                   graphics.moveTo(screenPoint.x, screenPoint.y);
                 } else {
                   graphics.lineTo(screenPoint.x, screenPoint.y);
                 }
-              });
+              }
 
               graphics.closePath();
               graphics.endFill(); // Close the fill
-            });
-          });
-        } else if (geometry.type === "Point" || geometry.type === "MultiPoint") {
-          // Draw points
-          geometry.coordinates.forEach(([x, y]) => {
+            }
+          }
+        } else if (geometryType === "Point" || geometryType === "MultiPoint") {
+          // Draw points: every part is a single vertex
+          for (let part = featureParts[feature]; part < featureParts[feature + 1]; part++) {
+            const point = ringOffsets[partRings[part]];
             // Apply offset adjustment for patches in image coordinates
-            let xOffset = x;
-            let yOffset = y;
+            let xOffset = coords[2 * point];
+            let yOffset = coords[2 * point + 1];
             if (isPatch) {
               xOffset += 24;
               yOffset += 24;
@@ -415,14 +452,14 @@ const Viewer = ({ dziUrl, filename }) => {
             graphics.beginFill(hexColor);
             graphics.drawCircle(screenPoint.x, screenPoint.y, 4); // Adjust radius as needed
             graphics.endFill();
-          });
+          }
         } else {
-          console.warn(`Unsupported geometry type: ${geometry.type}`);
+          console.warn(`Unsupported geometry type: ${geometryType}`);
         }
 
         // Add graphics to the stage
         pixiAppRef.current.stage.addChild(graphics);
-      });
+      }
     });
 
     pixiAppRef.current.renderer.render(pixiAppRef.current.stage);
@@ -456,10 +493,14 @@ const Viewer = ({ dziUrl, filename }) => {
   }, [zoomValue]);
 
   const handlePanZoomEnd = async () => {
+    if (rasterOverlayRef.current) {
+      return; // OpenSeadragon loads the overlay tiles of the view itself
+    }
     const currentZoom = viewer ? viewer.viewport.getZoom() : 0;
 
     if (!isPatch && currentZoom <= 7) {
-      // Only for WSIs: show hex bins at low zoom
+      // Only for WSIs: show hex bins at low zoom, at the resolution matching the zoom
+      if (selectedImage) await fetchHexBins(selectedImage.replace('.dzi', ''), currentZoom, getViewportBounds());
       pixiAppRef.current.stage.removeChildren();
       setAnnotations([]);
       renderHexBins();
@@ -470,16 +511,7 @@ const Viewer = ({ dziUrl, filename }) => {
 
       try {
         const annotationsByFile = await fetchNormalizedAnnotations(bounds, selectedImage);
-        setAnnotations((prevAnnotations) => {
-          const uniqueAnnotations = new Map(prevAnnotations.map((a) => [a.id, a]));
-
-          Object.entries(annotationsByFile).forEach(([filename, annotationGroup]) => {
-            annotationGroup.forEach((annotation) => {
-              uniqueAnnotations.set(annotation.id, annotation);
-            });
-          });
-          return Array.from(uniqueAnnotations.values());
-        });
+        setAnnotations(Object.values(annotationsByFile || {})); // One decoded group per annotation file
         setNotification('');
         drawAnnotationsWithPixi();
       } catch (error) {
@@ -532,9 +564,8 @@ const Viewer = ({ dziUrl, filename }) => {
       const initialVisibility = {};
       Object.entries(annotationsByFile).forEach(([filename, annotationGroup]) => {
         initialVisibility[filename] = {};
-        annotationGroup.forEach(({ properties }) => {
-          const type = properties.classification.name;
-          initialVisibility[filename][type] = true; // Default to visible
+        groupClassifications(annotationGroup).forEach(({ name }) => {
+          initialVisibility[filename][name] = true; // Default to visible
         });
       });
       setVisibleAnnotations(initialVisibility);
@@ -542,13 +573,8 @@ const Viewer = ({ dziUrl, filename }) => {
   }, [annotationsByFile]);
   useEffect(() => {
     const types = new Set(); // Use a set to ensure unique types
-    annotations.forEach((annotation) => {
-      const features = annotation.features || [];
-      features.forEach((feature) => {
-        if (feature.properties?.classification?.name) {
-          types.add(feature.properties.classification.name);
-        }
-      });
+    annotations.forEach((annotationGroup) => {
+      groupClassifications(annotationGroup).forEach(({ name }) => types.add(name));
     });
     setAnnotationTypes([...types]); // Convert the set to an array
     console.log("Updated annotation types:", [...types]);
@@ -653,18 +679,63 @@ const Viewer = ({ dziUrl, filename }) => {
     }
   };
 
-  const fetchHexBins = async (dziFile, resolution) => {
-    try {
-      const response = await axios.post(`${process.env.REACT_APP_BACKEND_MONGODB_URL}/get_hex_bins`, {
-        dzi_file: dziFile,
-        resolution: resolution,
-      });
+  // Same rule as the backend: one H3 resolution finer per sqrt(7) zoom factor, so hexagons keep their on-screen size
+  const hexResolutionForZoom = (zoom, resolutions) => {
+    const target = Math.min(...resolutions) + Math.log(Math.max(zoom, 1e-6)) / Math.log(Math.sqrt(7));
+    return resolutions.reduce((best, resolution) =>
+      Math.abs(resolution - target) < Math.abs(best - target) ? resolution : best
+    );
+  };
 
-      if (response.data && Array.isArray(response.data.hex_bins)) {
-        hexBinsRef.current = response.data.hex_bins; // Store in ref, not state
-      } else {
-        console.error("Invalid hex bin data received:", response.data);
-      }
+  // Hex bins are requested for the viewport plus this fraction of its size on every side, so small pans reuse them
+  const HEX_VIEW_MARGIN = 0.5;
+
+  const boundsCover = (outer, inner) =>
+    !outer || (inner && outer.xMin <= inner.xMin && outer.xMax >= inner.xMax && outer.yMin <= inner.yMin && outer.yMax >= inner.yMax);
+
+  // bounds (image coordinates) limits the hex bins to the viewport; without them the whole slide is fetched
+  const fetchHexBins = async (dziFile, zoom, bounds = null) => {
+    const resolutions = hexResolutionsRef.current;
+    const resolution = resolutions.length > 0 ? hexResolutionForZoom(zoom, resolutions) : null;
+    const cached = resolution !== null && hexBinCacheRef.current[resolution];
+    if (cached && boundsCover(cached.bounds, bounds)) {
+      hexBinsRef.current = cached.hexBins;
+      return;
+    }
+
+    const requestBounds = bounds && {
+      xMin: bounds.xMin - HEX_VIEW_MARGIN * (bounds.xMax - bounds.xMin),
+      xMax: bounds.xMax + HEX_VIEW_MARGIN * (bounds.xMax - bounds.xMin),
+      yMin: bounds.yMin - HEX_VIEW_MARGIN * (bounds.yMax - bounds.yMin),
+      yMax: bounds.yMax + HEX_VIEW_MARGIN * (bounds.yMax - bounds.yMin),
+    };
+    try {
+      // Large results come in pages; each response names the cursor of the next one
+      const pages = [];
+      let after = null;
+      do {
+        const pageResolution = pages.length > 0 ? pages[0].resolution : resolution;
+        const response = await axios.post(`${process.env.REACT_APP_BACKEND_MONGODB_URL}/get_hex_bins`, {
+          dzi_file: dziFile,
+          zoom: zoom,
+          ...(pageResolution !== null && { resolution: pageResolution }),
+          ...(requestBounds && { bounds: requestBounds }),
+          ...(after && { after: after }),
+        }, wireRequestConfig);
+
+        if (!isWireMessage(response.data)) {
+          console.error("Invalid hex bin data received:", decodeJsonBody(response.data));
+          return;
+        }
+        const page = decodeHexBins(response.data);
+        pages.push(page);
+        after = page.next;
+      } while (after);
+
+      const hexBins = mergeHexBinPages(pages);
+      hexResolutionsRef.current = hexBins.resolutions || [];
+      hexBinCacheRef.current[hexBins.resolution] = { bounds: requestBounds, hexBins };
+      hexBinsRef.current = hexBins; // Store in ref, not state
     } catch (error) {
       console.error("Error fetching hex bins:", error);
     }
@@ -673,7 +744,7 @@ const Viewer = ({ dziUrl, filename }) => {
 
 
 
-  const handleAnnotationUpload = async (file) => {
+  const handleAnnotationUpload = async (file, replace = false) => {
     if (!file) {
       alert('Please select an annotation file first!');
       return;
@@ -694,12 +765,24 @@ const Viewer = ({ dziUrl, filename }) => {
     formData.append('imageWidth', imageDimensions.width);
     formData.append('imageHeight', imageDimensions.height);
     formData.append('modelName', selectedModel); // Add model name
+    if (replace) {
+      formData.append('replace', 'true'); // Only the hex bins that change are rewritten
+    }
     try {
       const response = await axios.post(`${process.env.REACT_APP_BACKEND_MONGODB_URL}/link_annotation_to_dzi`, formData);
+      if (response.status === 202 && response.data.job_id) {
+        setNotification(`Processing annotation ${file.name}...`);
+        await waitForJob(process.env.REACT_APP_BACKEND_MONGODB_URL, response.data.job_id);
+        setNotification('');
+      }
+      hexBinCacheRef.current = {}; // New annotations change the hex bins
       alert(`Successfully uploaded annotation ${file.name}`);
     } catch (error) {
+      setNotification('');
       if (error.response && error.response.status === 409) {
-        alert('Annotation for this image and model already exists.');
+        if (window.confirm('Annotation for this image and model already exists. Replace it?')) {
+          await handleAnnotationUpload(file, true);
+        }
       } else {
         console.error('Error uploading annotation file:', error);
       }
@@ -724,6 +807,76 @@ const Viewer = ({ dziUrl, filename }) => {
     document.querySelector('input[type="file"]').value = ''; // Clear file input
   };
 
+  useEffect(() => {
+    // The overlay descriptor names the tile grid, the version in the tile URLs and the classes
+    setOverlayInfo(null);
+    setHiddenOverlayClasses({});
+    if (!rasterOverlay || !viewer || !selectedImage) {
+      return;
+    }
+    if (!selectedModel) {
+      setNotification('Select a model to view annotations.');
+      return;
+    }
+    let cancelled = false;
+    fetchOverlayInfo(process.env.REACT_APP_BACKEND_MONGODB_URL, selectedImage.replace('.dzi', ''), selectedModel)
+      .then((info) => {
+        if (!cancelled) {
+          setOverlayInfo(info);
+          setNotification('');
+        }
+      })
+      .catch((error) => {
+        console.error('Error fetching the annotation overlay:', error);
+        if (!cancelled) {
+          setNotification(`No annotations found for model '${selectedModel}'.`);
+        }
+      });
+    return () => {
+      cancelled = true;
+    };
+  }, [rasterOverlay, viewer, selectedImage, selectedModel]);
+
+  useEffect(() => {
+    // Every class filter is its own tile source; the layer is replaced when the filter changes
+    if (!viewer) {
+      return;
+    }
+    if (overlayItemRef.current) {
+      viewer.world.removeItem(overlayItemRef.current);
+      overlayItemRef.current = null;
+    }
+    if (!overlayInfo) {
+      return;
+    }
+    const shown = overlayInfo.classes.map(({ name }) => name).filter((name) => !hiddenOverlayClasses[name]);
+    if (shown.length === 0) {
+      return;
+    }
+    let removed = false;
+    viewer.addTiledImage({
+      tileSource: overlayTileSource(
+        process.env.REACT_APP_BACKEND_MONGODB_URL,
+        overlayInfo,
+        shown.length < overlayInfo.classes.length ? shown : null,
+      ),
+      success: (event) => {
+        if (removed) {
+          viewer.world.removeItem(event.item);
+        } else {
+          overlayItemRef.current = event.item;
+        }
+      },
+    });
+    return () => {
+      removed = true;
+    };
+  }, [viewer, overlayInfo, hiddenOverlayClasses]);
+
+  const handleToggleOverlayClass = (name) => {
+    setHiddenOverlayClasses((prevState) => ({ ...prevState, [name]: !prevState[name] }));
+  };
+
   useEffect(() => {
     // Only fetch if both image and model are selected
     if (selectedImage && selectedModel && viewer) {
@@ -757,6 +910,10 @@ const Viewer = ({ dziUrl, filename }) => {
             <option key={model} value={model}>{model}</option>
           ))}
         </select>
+        <label style={{ marginLeft: '24px' }}>
+          <input type="checkbox" checked={rasterOverlay} disabled={isPatch} onChange={handleRasterOverlayChange} />
+          Raster overlay
+        </label>
       </div>
       <div className="viewer-wrapper">
         <div className="viewer-box">
@@ -765,13 +922,36 @@ const Viewer = ({ dziUrl, filename }) => {
           </div>
           <div className="annotation-legend">
             <ul>
-              {zoomValue <= 7 ? (
+              {rasterOverlay ? (
+                // Legend for the raster overlay
+                overlayInfo ? (
+                  <div>
+                    <h4>Overlay Legend</h4>
+                    {overlayInfo.classes.map(({ name: type, color }, index) => (
+                      <li key={index} style={{ display: 'flex', alignItems: 'center', marginBottom: '5px' }}>
+                        <span
+                          style={{
+                            display: 'inline-block',
+                            width: '15px',
+                            height: '15px',
+                            backgroundColor: `rgb(${color[0]}, ${color[1]}, ${color[2]})`,
+                            marginRight: '10px',
+                          }}
+                        ></span>
+                        {type}
+                      </li>
+                    ))}
+                  </div>
+                ) : (
+                  <p>Loading overlay classifications...</p>
+                )
+              ) : zoomValue <= 7 ? (
                 // Legend for Hex Bins
-                hexBinsRef.current.length > 0 ? (
+                hexBinsRef.current?.count > 0 ? (
                   <div>
                     <h4>Cluster Legend</h4>
-                    {Object.entries(hexBinsRef.current[0].classifications).map(
-                      ([type, { color, count }], index) => (
+                    {hexBinClassifications(hexBinsRef.current, 0).map(
+                      ({ name: type, color, count }, index) => (
                         <li
                           key={index}
                           style={{ display: 'flex', alignItems: 'center', marginBottom: '5px' }}
@@ -796,11 +976,9 @@ const Viewer = ({ dziUrl, filename }) => {
               ) : (
                 // Legend for Individual Annotations
                 <ul>
-                  {Object.entries(annotationsByFile).some(([_, annotationGroup]) => annotationGroup.length > 0) ? (
+                  {Object.entries(annotationsByFile).some(([_, annotationGroup]) => featureCount(annotationGroup) > 0) ? (
                     Object.entries(annotationsByFile).map(([filename, annotationGroup]) =>
-                      annotationGroup.map(({ properties }, index) => {
-                        const type = properties.classification.name;
-                        const color = properties.classification.color;
+                      groupClassifications(annotationGroup).map(({ name: type, color }, index) => {
                         if (!color) return null;
                         return (
                           <li
@@ -840,18 +1018,35 @@ const Viewer = ({ dziUrl, filename }) => {
                 </p>
               </div>
             )}
+            {rasterOverlay && overlayInfo && (
+              <div>
+                <h4>Raster overlay</h4>
+                {overlayInfo.classes.map(({ name }, index) => (
+                  <div key={index}>
+                    <label>
+                      <input
+                        type="checkbox"
+                        checked={!hiddenOverlayClasses[name]}
+                        onChange={() => handleToggleOverlayClass(name)}
+                      />
+                      {name}
+                    </label>
+                  </div>
+                ))}
+              </div>
+            )}
             {Object.entries(annotationsByFile).map(([filename, annotationGroup]) => (
               <div key={filename}>
                 <h4>{((filename.replace('.geojson', '')).replace('cell_detection', 'Cell Centroids')).replace('cells', 'Cell Contours')}</h4>
-                {annotationGroup.map(({ properties }, index) => (
+                {groupClassifications(annotationGroup).map(({ name }, index) => (
                   <div key={index}>
                     <label>
                       <input
                         type="checkbox"
-                        checked={visibleAnnotations[filename]?.[properties.classification.name] || false}
-                        onChange={() => handleToggleAnnotation(filename, properties.classification.name)}
+                        checked={visibleAnnotations[filename]?.[name] || false}
+                        onChange={() => handleToggleAnnotation(filename, name)}
                       />
-                      {properties.classification.name}
+                      {name}
                     </label>
                   </div>
                 ))}
@@ -0,0 +1,77 @@
+import axios from 'axios';
+import { decodeAnnotations, mergeAnnotationGroups } from './wireFormat';
+
+// Decoded annotation tiles kept in memory, by URL; the browser HTTP cache holds more behind it
+const MAX_CACHED_TILES = 512;
+const tileCache = new Map();
+
+export const fetchTileInfo = async (baseUrl, dziFile, modelName) => {
+  const { data } = await axios.get(
+    `${baseUrl}/annotation_tiles/${encodeURIComponent(dziFile)}/${encodeURIComponent(modelName)}/info`
+  );
+  return data;
+};
+
+// Same rule as the backend (lod.lod_for_view): centroids when a typical cell is tiny on screen,
+// otherwise the coarsest simplification that stays within a couple of screen pixels
+export const annotationLodForView = (zoom, viewerWidth, info) => {
+  const scale = (zoom * viewerWidth) / info.image_width; // Screen pixels per image pixel
+  if (info.part_size && info.part_size * scale < info.centroid_size_px) {
+    return info.centroid_lod;
+  }
+  let lod = 0;
+  info.lod_tolerances.forEach((tolerance, index) => {
+    if (tolerance * scale <= info.screen_tolerance_px) {
+      lod = index + 1;
+    }
+  });
+  return lod;
+};
+
+// Tile URLs covering image-space bounds. A tile holds the cells that start in it, so the row and
+// column before the viewport are included for cells reaching into view from there.
+export const tileUrlsForBounds = (baseUrl, info, lod, bounds) => {
+  const size = info.tile_sizes[lod];
+  const lastX = Math.max(Math.ceil(info.image_width / size) - 1, 0);
+  const lastY = Math.max(Math.ceil(info.image_height / size) - 1, 0);
+  const clamp = (value, last) => Math.min(Math.max(value, 0), last);
+  const urls = [];
+  for (let y = clamp(Math.floor(bounds.yMin / size) - 1, lastY); y <= clamp(Math.floor(bounds.yMax / size), lastY); y++) {
+    for (let x = clamp(Math.floor(bounds.xMin / size) - 1, lastX); x <= clamp(Math.floor(bounds.xMax / size), lastX); x++) {
+      urls.push(baseUrl + info.tile_url.replace('{lod}', lod).replace('{x}', x).replace('{y}', y));
+    }
+  }
+  return urls;
+};
+
+const fetchTile = (url) => {
+  if (tileCache.has(url)) {
+    const tile = tileCache.get(url);
+    tileCache.delete(url); // Move to the most recently used end
+    tileCache.set(url, tile);
+    return tile;
+  }
+  const tile = axios.get(url, { responseType: 'arraybuffer' }).then((response) => decodeAnnotations(response.data));
+  tile.catch(() => tileCache.delete(url));
+  tileCache.set(url, tile);
+  if (tileCache.size > MAX_CACHED_TILES) {
+    tileCache.delete(tileCache.keys().next().value);
+  }
+  return tile;
+};
+
+// Fetches the tiles (only those not already held) and merges them into one group per annotation file
+export const fetchAnnotationTiles = async (urls) => {
+  const tiles = await Promise.all(urls.map(fetchTile));
+  const groupsByFile = {};
+  tiles.forEach((groups) => {
+    Object.entries(groups).forEach(([filename, group]) => {
+      (groupsByFile[filename] = groupsByFile[filename] || []).push(group);
+    });
+  });
+  const merged = {};
+  Object.entries(groupsByFile).forEach(([filename, groups]) => {
+    merged[filename] = mergeAnnotationGroups(groups);
+  });
+  return merged;
+};
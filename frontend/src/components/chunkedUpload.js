@@ -0,0 +1,76 @@
+import axios from 'axios';
+
+const MAX_RETRIES = 5;
+
+const wait = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// Upload id of an interrupted upload of this file, kept in the browser
+const sessionKey = (file) => `chunkedUpload:${file.name}:${file.size}:${file.lastModified}`;
+
+// The session of an interrupted upload of the same file, or null when there is none
+// (or the server no longer has it)
+const resumeSession = async (baseUrl, file) => {
+  const uploadId = window.localStorage.getItem(sessionKey(file));
+  if (!uploadId) {
+    return null;
+  }
+  try {
+    const { data: session } = await axios.get(`${baseUrl}/uploads/${uploadId}`);
+    if (session.filename === file.name && session.size === file.size && session.lastModified === file.lastModified) {
+      return session;
+    }
+  } catch (error) {
+    if (!error.response || error.response.status !== 404) {
+      throw error;
+    }
+  }
+  window.localStorage.removeItem(sessionKey(file));
+  return null;
+};
+
+// Sends a file through the resumable /uploads API, one chunk per request, and
+// resolves with the response of the last chunk (the same as /upload answers).
+// Starting the same file again in this browser continues from the bytes the
+// server already has; a failed chunk is retried from the offset the server reports.
+export const chunkedUpload = async (baseUrl, file, onProgress) => {
+  let session = await resumeSession(baseUrl, file);
+  if (!session) {
+    ({ data: session } = await axios.post(`${baseUrl}/uploads`, {
+      filename: file.name,
+      size: file.size,
+      lastModified: file.lastModified,
+    }));
+    window.localStorage.setItem(sessionKey(file), session.upload_id);
+  }
+  let { offset } = session;
+  let retries = 0;
+
+  for (;;) {
+    if (onProgress) {
+      onProgress(offset, file.size);
+    }
+    const chunk = file.slice(offset, Math.min(offset + session.chunk_size, file.size));
+    try {
+      const response = await axios.patch(`${baseUrl}/uploads/${session.upload_id}`, chunk, {
+        headers: { 'Content-Type': 'application/octet-stream', 'Upload-Offset': String(offset) },
+      });
+      if (response.data.offset === undefined || response.data.offset >= file.size) {
+        window.localStorage.removeItem(sessionKey(file));
+        return response;
+      }
+      offset = response.data.offset;
+      retries = 0;
+    } catch (error) {
+      if (error.response && error.response.status !== 409) {
+        throw error;
+      }
+      if (++retries > MAX_RETRIES) {
+        throw error;
+      }
+      await wait(1000 * 2 ** (retries - 1));
+      // Continue from what the server received, which may include part of the failed chunk
+      const { data: status } = await axios.get(`${baseUrl}/uploads/${session.upload_id}`);
+      offset = status.offset;
+    }
+  }
+};
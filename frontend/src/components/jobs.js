@@ -0,0 +1,18 @@
+import axios from 'axios';
+
+// Polls a background ingestion job until it finishes and resolves with its result
+export const waitForJob = async (baseUrl, jobId, onProgress, intervalMs = 1000) => {
+  for (;;) {
+    const { data: job } = await axios.get(`${baseUrl}/jobs/${jobId}`);
+    if (onProgress) {
+      onProgress(job);
+    }
+    if (job.status === 'done') {
+      return job.result;
+    }
+    if (job.status === 'failed' || job.status === 'cancelled') {
+      throw new Error(job.error || `Job ${job.status}`);
+    }
+    await new Promise((resolve) => setTimeout(resolve, intervalMs));
+  }
+};
@@ -0,0 +1,25 @@
+import axios from 'axios';
+
+export const fetchOverlayInfo = async (baseUrl, dziFile, modelName) => {
+  const { data } = await axios.get(
+    `${baseUrl}/overlay_tiles/${encodeURIComponent(dziFile)}/${encodeURIComponent(modelName)}/info`
+  );
+  return data;
+};
+
+// OpenSeadragon tile source of the raster annotation overlay (see overlay_tiles.py), on the same
+// DeepZoom grid as the slide. With classes (names), the tiles only show those classes; every
+// filter has its own URLs, so tiles of a filter seen before come from the browser cache.
+export const overlayTileSource = (baseUrl, info, classes = null) => {
+  const query = classes ? `?${classes.map((name) => `classes=${encodeURIComponent(name)}`).join('&')}` : '';
+  return {
+    width: info.width,
+    height: info.height,
+    tileSize: info.tile_size,
+    tileOverlap: info.overlap,
+    minLevel: 0,
+    maxLevel: info.max_level,
+    getTileUrl: (level, x, y) =>
+      baseUrl + info.tile_url.replace('{level}', level).replace('{x}', x).replace('{y}', y) + query,
+  };
+};
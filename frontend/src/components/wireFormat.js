@@ -0,0 +1,221 @@
+// Decoder for the backend's binary wire format (see wire.py): typed-array views over the response,
+// so annotations and hex bins are drawn without building an object per feature or per vertex
+export const WIRE_MIMETYPE = 'application/vnd.cell-annotator.wire';
+
+const MAGIC = 'CAW1';
+const TYPED_ARRAYS = {
+  '|u1': Uint8Array,
+  '<u2': Uint16Array,
+  '<i2': Int16Array,
+  '<u4': Uint32Array,
+  '<i4': Int32Array,
+  '<f4': Float32Array,
+  '<f8': Float64Array,
+};
+
+// Request options that ask for the wire format; a JSON error body is still returned as bytes
+export const wireRequestConfig = {
+  responseType: 'arraybuffer',
+  headers: { Accept: `${WIRE_MIMETYPE}, application/json;q=0.5` },
+};
+
+// Parses a JSON body that came back as an ArrayBuffer (error responses and fallbacks)
+export const decodeJsonBody = (buffer) => JSON.parse(new TextDecoder().decode(buffer));
+
+export const isWireMessage = (buffer) =>
+  buffer instanceof ArrayBuffer && buffer.byteLength >= 8 &&
+  new TextDecoder().decode(new Uint8Array(buffer, 0, 4)) === MAGIC;
+
+// Returns { header, arrays } with arrays as typed-array views of the buffer
+export const decodeWireMessage = (buffer) => {
+  if (!isWireMessage(buffer)) {
+    throw new Error('Not a wire format message');
+  }
+  const headerLength = new DataView(buffer).getUint32(4, true);
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+  const start = 8 + headerLength;
+  const arrays = {};
+  Object.entries(header.arrays).forEach(([name, { dtype, offset, length }]) => {
+    const TypedArray = TYPED_ARRAYS[dtype];
+    if (!TypedArray) {
+      throw new Error(`Unsupported wire dtype ${dtype}`);
+    }
+    arrays[name] = new TypedArray(buffer, start + offset, length);
+  });
+  return { header, arrays };
+};
+
+// Annotation response: { filename: group } where a group holds the file's features as columns.
+// coords are image pixels (x, y pairs); feature_parts, part_rings and ring_offsets are offsets.
+export const decodeAnnotations = (buffer) => {
+  const { header, arrays } = decodeWireMessage(buffer);
+  const groups = {};
+  header.files.forEach((file, index) => {
+    const column = (name) => arrays[`${index}/${name}`];
+    const quantized = column('coords');
+    const coords = new Float32Array(quantized.length);
+    const [originX, originY] = file.origin;
+    for (let i = 0; i < quantized.length; i += 2) {
+      coords[i] = originX + quantized[i] * file.quantum;
+      coords[i + 1] = originY + quantized[i + 1] * file.quantum;
+    }
+    groups[file.name] = {
+      featureIds: file.feature_ids,
+      classes: file.classes,
+      geometryTypes: header.geometry_types,
+      featureTypes: column('feature_types'),
+      featureClasses: column('feature_classes'),
+      featureParts: column('feature_parts'),
+      partRings: column('part_rings'),
+      ringOffsets: column('ring_offsets'),
+      coords,
+    };
+  });
+  return groups;
+};
+
+// Hex bin response: header fields (resolution, resolutions, next, hex_ids, class_names, feature_ids) and the arrays
+export const decodeHexBins = (buffer) => {
+  const { header, arrays } = decodeWireMessage(buffer);
+  return {
+    ...header,
+    count: arrays.annotation_counts.length,
+    annotationCounts: arrays.annotation_counts,
+    boundaryOffsets: arrays.boundary_offsets,
+    boundary: arrays.boundary,
+    classOffsets: arrays.class_offsets,
+    classIds: arrays.class_ids,
+    classCounts: arrays.class_counts,
+    classColors: arrays.class_colors,
+    featureOffsets: arrays.feature_offsets,
+    features: arrays.features,
+  };
+};
+
+// Number of features in an annotation group
+export const featureCount = (group) => (group ? group.featureTypes.length : 0);
+
+// Distinct classifications ({ name, color }) used by an annotation group
+export const groupClassifications = (group) => {
+  const seen = new Map();
+  (group?.classes || []).forEach((properties) => {
+    const classification = properties?.classification;
+    if (classification?.name && !seen.has(classification.name)) {
+      seen.set(classification.name, classification);
+    }
+  });
+  return Array.from(seen.values());
+};
+
+// Classifications ({ name, count, color }) of one hex bin of a decoded hex bin response
+export const hexBinClassifications = (hexBins, bin) => {
+  const classifications = [];
+  for (let k = hexBins.classOffsets[bin]; k < hexBins.classOffsets[bin + 1]; k++) {
+    classifications.push({
+      name: hexBins.class_names[hexBins.classIds[k]],
+      count: hexBins.classCounts[k],
+      color: [hexBins.classColors[3 * k], hexBins.classColors[3 * k + 1], hexBins.classColors[3 * k + 2]],
+    });
+  }
+  return classifications;
+};
+
+// Joins the decoded pages of one get_hex_bins result (see its next cursor) into one set of hex bins
+export const mergeHexBinPages = (pages) => {
+  if (pages.length === 1) {
+    return pages[0];
+  }
+  const classNames = [];
+  const classIndex = new Map();
+  const classIdMaps = pages.map((page) => page.class_names.map((name) => {
+    if (!classIndex.has(name)) {
+      classIndex.set(name, classNames.length);
+      classNames.push(name);
+    }
+    return classIndex.get(name);
+  }));
+  const concat = (TypedArray, arrays) => {
+    const merged = new TypedArray(arrays.reduce((sum, values) => sum + values.length, 0));
+    let position = 0;
+    arrays.forEach((values) => {
+      merged.set(values, position);
+      position += values.length;
+    });
+    return merged;
+  };
+  const count = pages.reduce((sum, page) => sum + page.count, 0);
+  const offsets = (name) => {
+    const merged = new Uint32Array(count + 1);
+    let position = 0;
+    let base = 0;
+    pages.forEach((page) => {
+      for (let bin = 0; bin < page.count; bin++) {
+        merged[position + bin] = page[name][bin] + base;
+      }
+      position += page.count;
+      base += page[name][page.count];
+    });
+    merged[position] = base;
+    return merged;
+  };
+  let featureBase = 0;
+  const features = pages.map((page) => {
+    const shifted = page.features.map((feature) => feature + featureBase);
+    featureBase += page.feature_ids.length;
+    return shifted;
+  });
+  return {
+    ...pages[pages.length - 1],
+    hex_ids: pages.flatMap((page) => page.hex_ids),
+    class_names: classNames,
+    feature_ids: pages.flatMap((page) => page.feature_ids),
+    count,
+    annotationCounts: concat(Uint32Array, pages.map((page) => page.annotationCounts)),
+    boundaryOffsets: offsets('boundaryOffsets'),
+    boundary: concat(Float32Array, pages.map((page) => page.boundary)),
+    classOffsets: offsets('classOffsets'),
+    classIds: concat(Uint32Array, pages.map((page, index) => page.classIds.map((id) => classIdMaps[index][id]))),
+    classCounts: concat(Uint32Array, pages.map((page) => page.classCounts)),
+    classColors: concat(Uint8Array, pages.map((page) => page.classColors)),
+    featureOffsets: offsets('featureOffsets'),
+    features: concat(Uint32Array, features),
+  };
+};
+
+// Concatenates annotation groups of one file (e.g. from several tiles) into one group
+export const mergeAnnotationGroups = (groups) => {
+  if (groups.length === 1) {
+    return groups[0];
+  }
+  const concat = (TypedArray, name, shift, isOffsets) => {
+    const total = groups.reduce((sum, group) => sum + group[name].length - (isOffsets ? 1 : 0), isOffsets ? 1 : 0);
+    const merged = new TypedArray(total);
+    let position = 0;
+    let base = 0;
+    groups.forEach((group) => {
+      const values = group[name];
+      const count = isOffsets ? values.length - 1 : values.length;
+      for (let i = 0; i < count; i++) {
+        merged[position + i] = values[i] + base;
+      }
+      position += count;
+      base += shift(group);
+    });
+    if (isOffsets) {
+      merged[position] = base;
+    }
+    return merged;
+  };
+  const none = () => 0;
+  return {
+    featureIds: groups.flatMap((group) => group.featureIds),
+    classes: groups.flatMap((group) => group.classes),
+    geometryTypes: groups[0].geometryTypes,
+    featureTypes: concat(Uint8Array, 'featureTypes', none, false),
+    featureClasses: concat(Uint32Array, 'featureClasses', (group) => group.classes.length, false),
+    featureParts: concat(Uint32Array, 'featureParts', (group) => group.partRings.length - 1, true),
+    partRings: concat(Uint32Array, 'partRings', (group) => group.ringOffsets.length - 1, true),
+    ringOffsets: concat(Uint32Array, 'ringOffsets', (group) => group.coords.length / 2, true),
+    coords: concat(Float32Array, 'coords', none, false),
+  };
+};
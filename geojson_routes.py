@@ -1,24 +1,43 @@
-from flask import Blueprint, request, jsonify
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
+from flask import Blueprint, Response, request, jsonify, send_file
 from pymongo.errors import PyMongoError
-from gridfs import GridFS
 from bson.objectid import ObjectId
+import logging
 import os
+import itertools
 import json
-import pymongo
-import h3
+import uuid
+from hexbin import HEX_RESOLUTIONS, resolution_for_zoom
+from hexbin_updates import drop_hex_bins
+from annotation_index import (
+    chunk_cache, index_metadata, invalidate_cached_file, is_indexed, query_spatial_index, query_spatial_table,
+    query_tile_table, table_features,
+)
+from annotation_tiles import (
+    IMMUTABLE, TILE_FORMATS, tile_bucket_box, tile_cache, tile_etag, tile_size, tile_version,
+)
+from annotation_ingest import ingest_geojson_stream
+from geojson_stream import GeoJSONStreamError
+from lod import CENTROID_LOD, CENTROID_SIZE_PX, LOD_TOLERANCES, SCREEN_TOLERANCE_PX, lod_for_scale, lod_for_view
+from metrics import READ_BYTES, log_event, log_exception, phase
+from mongo import database as db, grid_fs, hex_bins as hexbin_collection, roi_grids
+import precompute
+from overlay_tiles import (
+    OVERLAY_FORMAT, OVERLAY_FORMATS, encode_overlay, max_level, overlay_cache, overlay_classes, overlay_etag,
+    overlay_query_bounds, overlay_tile_box, overlay_version, render_overlay_tile,
+)
+from roi_stats import ROI_GRID_CELL, RegionError, delete_count_grid, region_stats, store_count_grid, summed_area_table
+from tile_server import OUTPUT_FOLDER, UPLOAD_FOLDER, dzi_settings, slide_mpp
+from jobs import find_active_job, job_accepted, submit_job
+from wire import MIMETYPE, annotation_message, binary_response, compressed_response, hex_bin_message, wants_binary
 # Load environment variables
 from dotenv import load_dotenv
 load_dotenv()
 
-# MongoDB setup
-mongo_uri = os.getenv("MONGO_URI")
-client = MongoClient(mongo_uri, server_api=ServerApi('1'))
-db = client.annotationsDB
-geojson_fs = GridFS(db)
-hexbin_collection = db.geojson_hex_bins
-grid_fs = GridFS(db)
+ANNOTATION_SPOOL = os.path.join('uploads', 'annotations')
+HEX_PAGE_SIZE = int(os.getenv("HEX_PAGE_SIZE", "20000"))  # Most hex bins get_hex_bins returns per response
+HEX_STREAM_CHUNK = 500  # Hex bins per chunk of a streamed get_hex_bins response
+# Fields get_hex_bins sends by default; the _id is the page cursor
+HEX_BIN_FIELDS = {"_id": 1, "hex_id": 1, "annotation_count": 1, "image_coordinates": 1, "classifications": 1}
 
 
 
@@ -32,14 +51,15 @@ geojson_blueprint = Blueprint('geojson', __name__)
 @geojson_blueprint.route('/link_annotation_to_dzi', methods=['POST'])
 def link_annotation_to_dzi():
     """
-    Uploads annotation file to GridFS, links it to the specified DZI file, and stores metadata.
-    Calls compute_hexagons_for_specific_file_and_dzi to process the uploaded data.
+    Accepts an annotation file for the specified DZI file and queues a job that stores it
+    in GridFS with its metadata and processes it (see ingest_annotation_file).
     """
     file = request.files['file']
     image_filename = request.form.get('dziFile')  # This is the image filename (e.g., gall-bladder-patch.png)
     model_name = request.form.get('modelName')     # New: model name from dropdown
     image_width = request.form.get('imageWidth')
     image_height = request.form.get('imageHeight')
+    replace = request.form.get('replace') == 'true'  # Replace an existing annotation of this image and model
 
     if not image_filename or not image_width or not image_height or not model_name:
         return jsonify({"error": "Image filename, model name, width, and height are required"}), 400
@@ -48,207 +68,162 @@ def link_annotation_to_dzi():
     base_image_name = os.path.splitext(image_filename)[0]
     annotation_filename = f"{base_image_name}_{model_name}.geojson"
 
+    # An ingest of the same annotation that is still queued or running is reported instead of repeated;
+    # this check saves spooling the upload, submit_job makes the atomic one
+    job_key = f"annotation:{annotation_filename}"
+    active_job = find_active_job(job_key)
+    if active_job:
+        return job_accepted(active_job["job_id"], filename=annotation_filename, dzi_file=image_filename)
+
     # Check for duplicate in GridFS
-    existing = geojson_fs.find_one({"filename": annotation_filename})
+    existing = grid_fs.find_one({"filename": annotation_filename})
     if existing:
-        return jsonify({"error": "Annotation for this image and model already exists."}), 409
-
-    # Check for duplicate in GridFS and delete if exists
-    # existing = geojson_fs.find_one({"filename": annotation_filename})
-    # if existing:
-    #     geojson_fs.delete(existing._id)
+        if existing.metadata.get("ingest_pending"):
+            # Left behind by an ingest that never finished
+            delete_annotation_file(existing._id)
+        elif not replace:
+            return jsonify({"error": "Annotation for this image and model already exists."}), 409
 
     try:
         image_width = int(image_width)
         image_height = int(image_height)
 
-        file_id = geojson_fs.put(file, filename=annotation_filename, metadata={
-            "filename": annotation_filename,
-            "dzi_file": image_filename,
+        # Spool the upload to disk; the GridFS write and hexbin computation run as a background job
+        os.makedirs(ANNOTATION_SPOOL, exist_ok=True)
+        spool_path = os.path.join(ANNOTATION_SPOOL, f"{uuid.uuid4().hex}.geojson")
+        file.save(spool_path)
+
+        job_id = submit_job("ingest_annotation", {
+            "spool_path": spool_path,
+            "annotation_filename": annotation_filename,
+            "image_filename": image_filename,
             "model_name": model_name,
             "image_width": image_width,
             "image_height": image_height,
-            "file_size": file.content_length,
-        })
+            "replace": replace,
+        }, job_key=job_key)
 
-        # Call compute_hexagons_for_specific_file_and_dzi with the uploaded file details
-        resolutions = [2]  # Example resolution; adjust as needed
-        compute_hexagons_for_specific_file_and_dzi(resolutions, annotation_filename, image_filename)
-
-        return jsonify({
-            "message": "Annotation file uploaded and linked to DZI successfully using GridFS.",
-            "filename": annotation_filename,
-            "dzi_file": image_filename,
-            "file_id": str(file_id),
-            "image_width": image_width,
-            "image_height": image_height,
-        }), 200
+        return job_accepted(
+            job_id,
+            message="Annotation file accepted; it is being linked to the DZI in the background.",
+            filename=annotation_filename,
+            dzi_file=image_filename,
+        )
 
     except PyMongoError as e:
-        print("PyMongoError:", e)
+        log_event("link_annotation_failed", level=logging.ERROR, filename=annotation_filename, error=str(e))
         return jsonify({"error": str(e)}), 500
     except Exception as e:
-        import traceback
-        print("Unexpected error in /link_annotation_to_dzi:")
-        traceback.print_exc()
+        log_exception("link_annotation_failed", filename=annotation_filename)
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
-def process_geojson(dzi_file, geojson_data, image_width, image_height, resolutions):
-    """
-    Process GeoJSON data to compute hexagons and store them in the hexbin collection.
-    """
-    # Handle both dict (FeatureCollection) and list (features) input
-    if isinstance(geojson_data, dict) and "features" in geojson_data:
-        features = geojson_data["features"]
-    elif isinstance(geojson_data, list):
-        features = geojson_data
-    else:
-        print("Invalid GeoJSON format: expected dict with 'features' or a list.")
-        return
-
-    for resolution in resolutions:
-        hex_bins = {}
-
-        for feature in features:
-            geometry = feature.get("geometry")
-            if not geometry:
-                continue
-
-            feature_id = feature.get("id")
-            if not feature_id:
-                print("Skipping feature without an ID.")
-                continue
-
-            # Extract classification and color
-            properties = feature.get("properties", {})
-            classification = properties.get("classification", {}).get("name", "Unknown")
-            color = properties.get("classification", {}).get("color", [255, 255, 255])  # Default to white
-
-            if geometry["type"] == "Point" or geometry["type"] == "MultiPoint":
-                coordinates = geometry["coordinates"]
-                if geometry["type"] == "Point":
-                    coordinates = [coordinates]
-
-                for x, y in coordinates:
-                    lat, lon = normalize_to_lat_lon(x, y, image_width, image_height)
-                    hex_id = h3.latlng_to_cell(lat, lon, resolution)
-                    add_to_hex_bins(hex_bins, hex_id, feature_id, classification, color)
-
-            elif geometry["type"] in ["Polygon", "MultiPolygon"]:
-                polygons = geometry["coordinates"]
-                if geometry["type"] == "Polygon":
-                    polygons = [polygons]
-
-                for polygon in polygons:
-                    for ring in polygon:
-                        for x, y in ring:
-                            lat, lon = normalize_to_lat_lon(x, y, image_width, image_height)
-                            hex_id = h3.latlng_to_cell(lat, lon, resolution)
-                            add_to_hex_bins(hex_bins, hex_id, feature_id, classification, color)
-
-        print(f"Resolution {resolution}: Generated {len(hex_bins)} hex bins for {dzi_file}.")
-
-        # Batch insert hex bins into MongoDB
-        bulk_operations = []
-        for hex_id, hex_data in hex_bins.items():
-            hex_boundary = h3.cell_to_boundary(hex_id)
-            image_coordinates = [
-                lat_lon_to_image_coordinates(lat, lon, image_width, image_height)
-                for lat, lon in hex_boundary
-            ]
 
-            bulk_operations.append(
-                pymongo.InsertOne({
-                    "dzi_file": dzi_file,
-                    "hex_id": hex_id,
-                    "feature_ids": list(set(hex_data["feature_ids"])),
-                    "annotation_count": hex_data["annotation_count"],
-                    "resolution": resolution,
-                    "image_coordinates": image_coordinates,
-                    "classifications": hex_data["classifications"],
-                })
-            )
 
-        if bulk_operations:
-            try:
-                hexbin_collection.bulk_write(bulk_operations)
-            except Exception as e:
-                print(f"Error during bulk write: {e}")
-def compute_hexagons_for_specific_file_and_dzi(resolutions, filename, dzi_file):
+def ingest_annotation_file(spool_path, annotation_filename, image_filename, model_name, image_width, image_height,
+                           replace=False, progress=None):
     """
-    Compute hexagons for a specific document in GridFS identified by metadata.filename and metadata.dzi_file.
+    Job body for /link_annotation_to_dzi: stores the spooled upload in GridFS, then
+    calls precompute.compute_hexagons_for_specific_file_and_dzi to process the uploaded data.
+    When replacing, the previous file is removed first but its hex bins are kept,
+    so only the hexes where the new file differs are updated. When processing
+    fails, the file and its hex bins are removed and the error is raised, so the job fails.
     """
-    # Find the specific file document in GridFS
-    file_doc = db.fs.files.find_one({"metadata.filename": filename, "metadata.dzi_file": dzi_file})
-
-    if not file_doc:
-        print(f"File with metadata.filename '{filename}' and metadata.dzi_file '{dzi_file}' not found in GridFS.")
-        return
-
-    file_id = file_doc.get("_id")
-
-    if not file_id:
-        print("Skipping incomplete file document in GridFS.")
-        return
+    report = progress or (lambda done, total: None)
+    if replace:
+        existing = grid_fs.find_one({"filename": annotation_filename})
+        if existing:
+            delete_annotation_file(existing._id)
+    # Progress counts bytes: once for the GridFS write, once for the streamed ingest
+    file_size = os.path.getsize(spool_path)
+    report(0, 2 * file_size)
+
+    with open(spool_path, 'rb') as f:
+        file_id = grid_fs.put(f, filename=annotation_filename, metadata={
+            "filename": annotation_filename,
+            "dzi_file": image_filename,
+            "model_name": model_name,
+            "image_width": image_width,
+            "image_height": image_height,
+            "file_size": file_size,
+            "ingest_pending": True,
+        })
+    report(file_size, 2 * file_size)
 
-    # Retrieve the file content from GridFS
+    # A file that cannot be processed is removed again, so it can be uploaded anew, and fails the job
     try:
-        file_data = grid_fs.get(file_id).read()
-        geojson_data = json.loads(file_data)
-    except Exception as e:
-        print(f"Error reading file from GridFS: {e}")
-        return
-
-    # Extract image dimensions from metadata
-    metadata = file_doc.get("metadata", {})
-    image_width = metadata.get("image_width")
-    image_height = metadata.get("image_height")
-
-    if not (image_width and image_height):
-        print(f"Skipping file {filename} due to missing image dimensions.")
-        return
-
-    # Process GeoJSON data
-    process_geojson(dzi_file, geojson_data, image_width, image_height, resolutions)
-
-    print(f"Hexagon computation complete for file '{filename}' with DZI file '{dzi_file}'.")
-def add_to_hex_bins(hex_bins, hex_id, feature_id, classification, color):
-    if hex_id not in hex_bins:
-        hex_bins[hex_id] = {
-            "feature_ids": [],
-            "annotation_count": 0,
-            "classifications": {},
-        }
-    hex_bins[hex_id]["feature_ids"].append(feature_id)
-    hex_bins[hex_id]["annotation_count"] += 1
-    if classification not in hex_bins[hex_id]["classifications"]:
-        hex_bins[hex_id]["classifications"][classification] = {"count": 0, "color": color}
-    hex_bins[hex_id]["classifications"][classification]["count"] += 1
-def normalize_to_lat_lon(x, y, image_width, image_height):
-    normalized_x = x / image_width
-    normalized_y = y / image_height
-    latitude = normalized_y * 180 - 90
-    longitude = normalized_x * 360 - 180
-    return latitude, longitude
-def lat_lon_to_image_coordinates(lat, lon, image_width, image_height):
-    x = ((lon + 180) / 360) * image_width
-    y = ((lat + 90) / 180) * image_height
-    return x, y
+        precompute.compute_hexagons_for_specific_file_and_dzi(
+            HEX_RESOLUTIONS, annotation_filename, image_filename,
+            progress=lambda done, total: report(file_size + done, 2 * file_size),
+        )
+        file_doc = db.fs.files.find_one({"_id": file_id})
+        if file_doc and is_indexed(file_doc.get("metadata")):
+            store_count_grid(db, roi_grids, file_doc)
+        db.fs.files.update_one({"_id": file_id}, {"$unset": {"metadata.ingest_pending": ""}})
+    except Exception:
+        drop_hex_bins(hexbin_collection, image_filename, filename=annotation_filename)
+        delete_annotation_file(file_id)
+        raise
+    finally:
+        os.remove(spool_path)
+    report(2 * file_size, 2 * file_size)
+
+    return {
+        "message": "Annotation file uploaded and linked to DZI successfully using GridFS.",
+        "filename": annotation_filename,
+        "dzi_file": image_filename,
+        "file_id": str(file_id),
+        "image_width": image_width,
+        "image_height": image_height,
+    }
+
+
+def delete_annotation_file(file_id):
+    """
+    Removes an annotation file from GridFS together with its spatial index buckets and count grid.
+    """
+    grid_fs.delete(file_id)
+    db.annotation_buckets.delete_many({"file_id": file_id})
+    delete_count_grid(roi_grids, file_id)
+    invalidate_cached_file(file_id)
 
 
+def indexed_annotation_files(dzi_file, model_name=None):
+    """
+    GridFS file documents of a slide's annotations, for one model if given (the
+    filter runs in MongoDB). Files uploaded before the current index layout
+    existed are indexed first.
+    """
+    query = {"metadata.dzi_file": dzi_file}
+    if model_name:
+        query["metadata.model_name"] = model_name
+    file_docs = list(db.fs.files.find(query))
+    for file_doc in file_docs:
+        if not is_indexed(file_doc.get("metadata")):
+            ingest_geojson_stream(db, file_doc, grid_fs.get(file_doc["_id"]))
+            READ_BYTES.inc(file_doc.get("length", 0), source="gridfs")
+            file_doc["metadata"]["spatial_index"] = index_metadata(db, file_doc["_id"])
+    return file_docs
+
 
 @geojson_blueprint.route('/get_normalized_annotations', methods=['POST'])
 def get_normalized_annotations():
     """
     Fetches and filters annotations within viewport bounds for a specified DZI file from GridFS.
+    The level of detail follows the zoom (see lod.lod_for_view); "lod" in the request overrides it.
+    Answers in the binary wire format (see wire.py) when the client asks for it.
     """
     data = request.json
+    binary = wants_binary(data)
     bounds = data.get('bounds')
     dzi_file = data.get('filename')  # filename is the dzi_file
     zoom = data.get('zoom', 8)  # Default to 8 if not provided
     model_name = data.get('modelName')
+    viewer_width = data.get('viewerWidth')
+    requested_lod = data.get('lod')
 
     if not bounds or not dzi_file:
         return jsonify({"error": "Bounds and DZI file are required"}), 400
+    if requested_lod is not None and requested_lod not in range(CENTROID_LOD + 1):
+        return jsonify({"error": f"lod must be an integer from 0 (full detail) to {CENTROID_LOD} (centroids)"}), 400
 
     # Detect if this is a patch
     is_patch = dzi_file.endswith('.png') or dzi_file.endswith('.png.dzi')
@@ -258,67 +233,40 @@ def get_normalized_annotations():
     y_min, y_max = round(bounds.get('yMin', 6), 6), round(bounds.get('yMax', 6), 6)
 
     try:
-        # Retrieve files associated with the specified DZI file from GridFS
-        file_cursor = geojson_fs.find({"metadata.dzi_file": dzi_file})
-        file_list = list(file_cursor)
-
-        if not file_list:
+        # Retrieve the selected model's files for the specified DZI file from GridFS
+        try:
+            with phase("files"):
+                file_list = indexed_annotation_files(dzi_file, model_name)
+        except GeoJSONStreamError:
+            return jsonify({"error": "Invalid GeoJSON format"}), 400
+
+        if not file_list and not db.fs.files.find_one({"metadata.dzi_file": dzi_file}, {"_id": 1}):
             return jsonify({"error": "No annotations found for the specified DZI file"}), 404
 
         grouped_annotations = {}
 
-        for file_obj in file_list:
-            # Only process files for the selected model
-            if model_name and file_obj.metadata.get("model_name") != model_name:
-                continue
-            file_name = file_obj.metadata.get("filename", "Unknown File")
-            geojson_data = json.loads(file_obj.read().decode('utf-8'))
-
-            # Ensure geojson_data is a list or a dictionary containing 'features'
-            if isinstance(geojson_data, dict):
-                features = geojson_data.get('features', [])
-            elif isinstance(geojson_data, list):
-                features = geojson_data  # Assume each item is a feature
-            else:
-                return jsonify({"error": "Invalid GeoJSON format"}), 400
+        for file_doc in file_list:
+            metadata = file_doc["metadata"]
+            file_name = metadata.get("filename", "Unknown File")
 
-            filtered_features = []
+            if requested_lod is not None:
+                lod = requested_lod
+            else:
+                image_width = metadata.get("image_width")
+                part_size = metadata["spatial_index"].get("part_size")
+                lod = lod_for_view(zoom, image_width, part_size, viewer_width) if image_width else 0
 
             # If patch, skip bounds filtering and return all features
-            if is_patch:
-                filtered_features = features
+            query_bounds = None if is_patch else (x_min, y_min, x_max, y_max)
+            if binary:
+                grouped_annotations[file_name] = query_spatial_table(db, file_doc, query_bounds, lod)
             else:
-                for feature in features:
-                    geometry = feature.get('geometry', {})
-                    coordinates = geometry.get('coordinates', [])
-
-                    # Filter features based on bounds
-                    if geometry.get('type') in ['Point', 'MultiPoint']:
-                        filtered_points = [
-                            point for point in coordinates
-                            if x_min <= point[0] <= x_max and y_min <= point[1] <= y_max
-                        ]
-                        if filtered_points:
-                            feature['geometry']['coordinates'] = filtered_points
-                            filtered_features.append(feature)
-
-                    elif geometry.get('type') in ['Polygon', 'MultiPolygon']:
-                        filtered_polygons = []
-                        for polygon in coordinates:
-                            filtered_rings = [
-                                [point for point in ring if x_min <= point[0] <= x_max and y_min <= point[1] <= y_max]
-                                for ring in polygon
-                            ]
-                            filtered_rings = [ring for ring in filtered_rings if ring]
-                            if filtered_rings:
-                                filtered_polygons.append(filtered_rings)
-                        if filtered_polygons:
-                            feature['geometry']['coordinates'] = filtered_polygons
-                            filtered_features.append(feature)
-
-            grouped_annotations[file_name] = filtered_features
-
-        return jsonify(grouped_annotations), 200
+                grouped_annotations[file_name] = query_spatial_index(db, file_doc, query_bounds, lod)
+
+        with phase("serialize"):
+            if binary:
+                return binary_response(annotation_message(grouped_annotations))
+            return jsonify(grouped_annotations), 200
 
     except PyMongoError as e:
         return jsonify({"error": str(e)}), 500
@@ -326,26 +274,366 @@ def get_normalized_annotations():
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
 
+@geojson_blueprint.route('/annotation_tiles/<dzi_file>/<model_name>/info', methods=['GET'])
+def annotation_tile_info(dzi_file, model_name):
+    """
+    Describes the annotation tiles of a slide and model, like a .dzi describes
+    image tiles: the current version (part of every tile URL), the tile size at
+    each level of detail and what the viewer needs to pick a level from its zoom
+    (see lod.lod_for_view).
+    """
+    try:
+        file_docs = indexed_annotation_files(dzi_file, model_name)
+    except GeoJSONStreamError:
+        return jsonify({"error": "Invalid GeoJSON format"}), 400
+    except PyMongoError as e:
+        return jsonify({"error": str(e)}), 500
+    if not file_docs:
+        return jsonify({"error": "No annotations found for the specified DZI file and model"}), 404
+
+    version = tile_version(file_docs)
+    metadata = file_docs[0]["metadata"]
+    part_sizes = [file_doc["metadata"]["spatial_index"].get("part_size") for file_doc in file_docs]
+    part_sizes = [part_size for part_size in part_sizes if part_size]
+    response = jsonify({
+        "version": version,
+        "files": [file_doc["metadata"].get("filename") for file_doc in file_docs],
+        "image_width": metadata.get("image_width"),
+        "image_height": metadata.get("image_height"),
+        "part_size": max(part_sizes) if part_sizes else None,
+        "lod_tolerances": list(LOD_TOLERANCES),
+        "centroid_lod": CENTROID_LOD,
+        "screen_tolerance_px": SCREEN_TOLERANCE_PX,
+        "centroid_size_px": CENTROID_SIZE_PX,
+        "tile_sizes": [tile_size(lod) for lod in range(CENTROID_LOD + 1)],
+        "tile_url": f"/annotation_tiles/{dzi_file}/{model_name}/{version}/{{lod}}/{{x}}_{{y}}.bin",
+    })
+    response.set_etag(version)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+@geojson_blueprint.route('/annotation_tiles/<dzi_file>/<model_name>/<version>/<int:lod>/<int:tx>_<int:ty>.<tile_format>', methods=['GET'])
+def annotation_tile(dzi_file, model_name, version, lod, tx, ty, tile_format):
+    """
+    One annotation tile: the parts of the slide's annotations for a model that
+    start in tile (tx, ty) of the grid at a level of detail (see annotation_tiles.py),
+    in the binary wire format (.bin) or as GeoJSON features per file (.json).
+    The content under a URL never changes, so the response is immutable.
+    """
+    if tile_format not in TILE_FORMATS:
+        return jsonify({"error": f"Tile format must be one of {sorted(TILE_FORMATS)}"}), 404
+    if lod > CENTROID_LOD:
+        return jsonify({"error": f"lod must be an integer from 0 (full detail) to {CENTROID_LOD} (centroids)"}), 400
+
+    etag = tile_etag(dzi_file, model_name, version, lod, tx, ty, tile_format)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = tile_cache.get(etag)
+        if body is None:
+            try:
+                file_docs = indexed_annotation_files(dzi_file, model_name)
+            except GeoJSONStreamError:
+                return jsonify({"error": "Invalid GeoJSON format"}), 400
+            except PyMongoError as e:
+                return jsonify({"error": str(e)}), 500
+            if not file_docs:
+                return jsonify({"error": "No annotations found for the specified DZI file and model"}), 404
+            if tile_version(file_docs) != version:
+                return jsonify({"error": "Annotation tile version is out of date; fetch the tile info again"}), 404
+
+            bucket_box = tile_bucket_box(lod, tx, ty)
+            tables = {
+                file_doc["metadata"].get("filename"): query_tile_table(db, file_doc, bucket_box, lod)
+                for file_doc in file_docs
+            }
+            with phase("serialize"):
+                if tile_format == "bin":
+                    body = annotation_message(tables)
+                else:
+                    body = json.dumps({name: table_features(table) for name, table in tables.items()}).encode("utf-8")
+            tile_cache.put(etag, body)
+        response = compressed_response(body, MIMETYPE if tile_format == "bin" else "application/json")
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = IMMUTABLE
+    return response
+
+
+def overlay_grid(dzi_file, file_docs):
+    """
+    (width, height, tile_size, overlap) of the DeepZoom grid the overlay tiles
+    of a slide follow: the annotated image size and the slide's .dzi tile settings.
+    """
+    metadata = file_docs[0]["metadata"]
+    tile_size, overlap, _ = dzi_settings(os.path.join(OUTPUT_FOLDER, f"{dzi_file}.dzi"))
+    return int(metadata["image_width"]), int(metadata["image_height"]), tile_size, overlap
+
+
+@geojson_blueprint.route('/overlay_tiles/<dzi_file>/<model_name>/info', methods=['GET'])
+def overlay_tile_info(dzi_file, model_name):
+    """
+    Describes the raster overlay of a slide's annotations for a model (see
+    overlay_tiles.py) as an OpenSeadragon tile source: the grid, the version that
+    is part of every tile URL and the classes that can be filtered on.
+    """
+    try:
+        file_docs = indexed_annotation_files(dzi_file, model_name)
+    except GeoJSONStreamError:
+        return jsonify({"error": "Invalid GeoJSON format"}), 400
+    except PyMongoError as e:
+        return jsonify({"error": str(e)}), 500
+    if not file_docs:
+        return jsonify({"error": "No annotations found for the specified DZI file and model"}), 404
+
+    width, height, tile_size, overlap = overlay_grid(dzi_file, file_docs)
+    version = overlay_version(tile_version(file_docs), tile_size, overlap)
+    classes = {}
+    for file_doc in file_docs:
+        for properties in file_doc["metadata"]["spatial_index"].get("classes", []):
+            classification = (properties or {}).get("classification") or {}
+            if classification.get("name") and classification.get("color"):
+                classes.setdefault(classification["name"], classification["color"])
+    response = jsonify({
+        "version": version,
+        "width": width,
+        "height": height,
+        "tile_size": tile_size,
+        "overlap": overlap,
+        "max_level": max_level(width, height),
+        "format": OVERLAY_FORMAT,
+        "classes": [{"name": name, "color": color} for name, color in sorted(classes.items())],
+        "tile_url": f"/overlay_tiles/{dzi_file}/{model_name}/{version}/{{level}}/{{x}}_{{y}}.{OVERLAY_FORMAT}",
+    })
+    response.set_etag(version)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+@geojson_blueprint.route('/overlay_tiles/<dzi_file>/<model_name>/<version>/<int:level>/<int:col>_<int:row>.<tile_format>', methods=['GET'])
+def overlay_tile(dzi_file, model_name, version, level, col, row, tile_format):
+    """
+    One raster overlay tile: the slide's annotations for a model drawn on tile
+    (col, row) of a DeepZoom level, as a transparent PNG or WebP. Repeated
+    "classes" query parameters limit the tile to those classes. The content
+    under a URL never changes, so the response is immutable.
+    """
+    if tile_format not in OVERLAY_FORMATS:
+        return jsonify({"error": f"Tile format must be one of {sorted(OVERLAY_FORMATS)}"}), 404
+    classes = overlay_classes(request.args.getlist("classes"))
+
+    etag = overlay_etag(dzi_file, model_name, version, level, col, row, tile_format, classes)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = overlay_cache.get(etag)
+        if body is None:
+            try:
+                file_docs = indexed_annotation_files(dzi_file, model_name)
+            except GeoJSONStreamError:
+                return jsonify({"error": "Invalid GeoJSON format"}), 400
+            except PyMongoError as e:
+                return jsonify({"error": str(e)}), 500
+            if not file_docs:
+                return jsonify({"error": "No annotations found for the specified DZI file and model"}), 404
+            width, height, tile_size, overlap = overlay_grid(dzi_file, file_docs)
+            if overlay_version(tile_version(file_docs), tile_size, overlap) != version:
+                return jsonify({"error": "Overlay tile version is out of date; fetch the overlay info again"}), 404
+            tile = overlay_tile_box(width, height, tile_size, overlap, level, col, row)
+            if tile is None:
+                return jsonify({"error": "Tile is outside the pyramid"}), 404
+
+            scale, box = tile
+            bounds = overlay_query_bounds(scale, box)
+            tables = [
+                query_spatial_table(db, file_doc, bounds, lod_for_scale(scale, file_doc["metadata"]["spatial_index"].get("part_size")))
+                for file_doc in file_docs
+            ]
+            with phase("render"):
+                body = encode_overlay(render_overlay_tile(tables, scale, box, classes), tile_format)
+            overlay_cache.put(etag, body)
+        response = Response(body, mimetype=OVERLAY_FORMATS[tile_format])
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = IMMUTABLE
+    return response
+
+
+@geojson_blueprint.route('/roi_stats', methods=['POST'])
+def get_roi_stats():
+    """
+    Class counts, proportions and densities inside regions of a slide, for each
+    annotation file of a model, read from the files' count grids (see roi_stats.py).
+    regions is a list of {"bounds": {"xMin", "xMax", "yMin", "yMax"}} rectangles
+    or GeoJSON Polygons, MultiPolygons or Features (whose properties.name is
+    returned), in level-0 image coordinates. Densities per mm² use mpp (microns
+    per pixel) when given, otherwise the slide's own resolution if it records one.
+    """
+    data = request.json or {}
+    dzi_file = data.get("dzi_file")
+    model_name = data.get("model_name")
+    regions = data.get("regions")
+    if not dzi_file or not model_name:
+        return jsonify({"error": "DZI file and model name are required"}), 400
+    if not isinstance(regions, list) or not regions:
+        return jsonify({"error": "regions must be a non-empty list"}), 400
+    try:
+        mpp = float(data["mpp"]) if data.get("mpp") else slide_mpp(os.path.join(UPLOAD_FOLDER, dzi_file))
+    except (TypeError, ValueError):
+        return jsonify({"error": "mpp must be a number"}), 400
+
+    try:
+        file_docs = indexed_annotation_files(dzi_file, model_name)
+        if not file_docs:
+            return jsonify({"error": "No annotations found for the specified DZI file and model"}), 404
+        tables = {
+            file_doc["metadata"].get("filename"): summed_area_table(db, roi_grids, file_doc)
+            for file_doc in file_docs
+        }
+    except GeoJSONStreamError:
+        return jsonify({"error": "Invalid GeoJSON format"}), 400
+    except PyMongoError as e:
+        return jsonify({"error": str(e)}), 500
+
+    results = []
+    try:
+        for region in regions:
+            properties = region.get("properties") if isinstance(region, dict) else None
+            results.append({
+                "name": (properties or {}).get("name"),
+                "files": {name: region_stats(table, region, mpp) for name, table in tables.items()},
+            })
+    except RegionError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "dzi_file": dzi_file,
+        "model_name": model_name,
+        "grid_cell": ROI_GRID_CELL,
+        "mpp": mpp,
+        "regions": results,
+    })
+
+
+@geojson_blueprint.route('/annotation_cache_stats', methods=['GET'])
+def annotation_cache_stats():
+    """
+    Size, hit, miss and eviction counts of the decoded-bucket, annotation tile and overlay tile caches.
+    """
+    return jsonify({"buckets": chunk_cache.stats(), "tiles": tile_cache.stats(), "overlay_tiles": overlay_cache.stats()})
+
+
+@geojson_blueprint.route('/export_annotation/<path:filename>', methods=['GET'])
+def export_annotation(filename):
+    """
+    Downloads an annotation file as the GeoJSON that was originally uploaded.
+    """
+    grid_out = grid_fs.find_one({"filename": filename})
+    if grid_out is None:
+        return jsonify({"error": "Annotation file not found"}), 404
+    READ_BYTES.inc(grid_out.length, source="gridfs")
+    return send_file(grid_out, mimetype="application/geo+json", as_attachment=True, download_name=filename)
+
+
+@geojson_blueprint.route('/delete_annotation/<path:filename>', methods=['DELETE'])
+def delete_annotation(filename):
+    """
+    Deletes an annotation file with its spatial index and its contribution to the slide's hex bins.
+    """
+    grid_out = grid_fs.find_one({"filename": filename})
+    if grid_out is None:
+        return jsonify({"error": "Annotation file not found"}), 404
+    if find_active_job(f"annotation:{filename}"):
+        return jsonify({"error": "Annotation file is being ingested"}), 409
+    try:
+        removed = drop_hex_bins(hexbin_collection, grid_out.metadata.get("dzi_file"), filename=filename)
+        delete_annotation_file(grid_out._id)
+    except PyMongoError as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"message": "Annotation file deleted", "filename": filename, "hex_bins_removed": removed})
+
+
+def hex_bin_query(dzi_file, resolution, bounds=None):
+    """
+    geojson_hex_bins filter for a slide and resolution, limited to the hexes
+    whose bbox intersects image-space bounds ({xMin, xMax, yMin, yMax}) if given.
+    """
+    query = {"dzi_file": dzi_file, "resolution": int(resolution)}
+    if bounds:
+        query.update({
+            "bbox.x_min": {"$lte": float(bounds["xMax"])},
+            "bbox.x_max": {"$gte": float(bounds["xMin"])},
+            "bbox.y_min": {"$lte": float(bounds["yMax"])},
+            "bbox.y_max": {"$gte": float(bounds["yMin"])},
+        })
+    return query
+
+
+def stream_hex_bins(first, cursor, limit, **fields):
+    """
+    Yields a get_hex_bins JSON response chunk by chunk while reading the cursor:
+    the fields, up to limit hex bins, and "next", the cursor of the following
+    page (None on the last page).
+    """
+    yield json.dumps(fields)[:-1] + ', "hex_bins": ['  # The fields' object, left open
+    count, last_id, chunk = 0, None, []
+    for hex_bin in itertools.chain([first], cursor):
+        if count == limit:
+            break
+        last_id = hex_bin.pop("_id")
+        chunk.append(json.dumps(hex_bin))
+        count += 1
+        if len(chunk) == HEX_STREAM_CHUNK:
+            yield ("," if count > len(chunk) else "") + ",".join(chunk)
+            chunk = []
+    else:
+        last_id = None
+    if chunk:
+        yield ("," if count > len(chunk) else "") + ",".join(chunk)
+    yield '], "next": ' + json.dumps(str(last_id) if last_id else None) + "}"
+
+
 @geojson_blueprint.route('/get_hex_bins', methods=['POST'])
 def get_hex_bins():
     """
-    Retrieves hex bins for a specified DZI file and resolution. Provides metadata for files if no hex bins are found.
+    Retrieves hex bins for a specified DZI file and resolution. Instead of a resolution,
+    the viewer zoom can be given to get the resolution matching it. With bounds, only
+    the hexes intersecting the viewport are returned.
+    Results come in pages of at most limit (and HEX_PAGE_SIZE) hex bins; "next" is passed
+    back as after to get the following page. feature_ids are left out unless
+    include_feature_ids is set (see /hex_bin_features for one hex).
+    Provides metadata for files if no hex bins are found.
+    Hex bins are sent in the binary wire format (see wire.py) when the client asks for it.
     """
     try:
         data = request.json
         dzi_file = data.get("dzi_file")
         resolution = data.get("resolution")
-
-        if not dzi_file or not resolution:
-            return jsonify({"error": "DZI file and resolution are required"}), 400
-
-        # Query MongoDB for hex bins
-        hex_bins = list(hexbin_collection.find(
-            {"dzi_file": dzi_file, "resolution": int(resolution)},
-            {"_id": 0, "hex_id": 1, "annotation_count": 1, "feature_ids": 1, "image_coordinates": 1, "classifications": 1}
-        ))
-
-        if not hex_bins:
+        zoom = data.get("zoom")
+        bounds = data.get("bounds")
+        after = data.get("after")
+        limit = min(int(data.get("limit") or HEX_PAGE_SIZE), HEX_PAGE_SIZE)
+
+        if not dzi_file or not (resolution or zoom):
+            return jsonify({"error": "DZI file and resolution or zoom are required"}), 400
+        if bounds and not all(key in bounds for key in ("xMin", "xMax", "yMin", "yMax")):
+            return jsonify({"error": "Bounds need xMin, xMax, yMin and yMax"}), 400
+        if after and not ObjectId.is_valid(after):
+            return jsonify({"error": "Invalid page cursor"}), 400
+
+        resolutions = sorted(hexbin_collection.distinct("resolution", {"dzi_file": dzi_file}))
+        if not resolution:
+            resolution = resolution_for_zoom(float(zoom), resolutions or HEX_RESOLUTIONS)
+
+        # Query MongoDB for hex bins, one page in _id order
+        query = hex_bin_query(dzi_file, resolution, bounds)
+        if after:
+            query["_id"] = {"$gt": ObjectId(after)}
+        projection = dict(HEX_BIN_FIELDS, feature_ids=1) if data.get("include_feature_ids") else HEX_BIN_FIELDS
+        cursor = hexbin_collection.find(query, projection).sort("_id", 1).limit(limit + 1)
+        first = next(cursor, None)
+
+        if first is None and not resolutions:
             # If no hex bins, retrieve metadata from GridFS
             gridfs_files = list(db.fs.files.find({"metadata.dzi_file": dzi_file}))
 
@@ -368,18 +656,63 @@ def get_hex_bins():
                 "file_metadata": metadata
             }), 200
 
-        return jsonify({"hex_bins": hex_bins}), 200
+        if first is not None and not wants_binary(data):
+            # JSON is written out while the cursor is read instead of being built in memory
+            return Response(
+                stream_hex_bins(first, cursor, limit, resolution=int(resolution), resolutions=resolutions),
+                mimetype="application/json",
+            )
+
+        # The binary message is built in memory, which a page (at most HEX_PAGE_SIZE hex bins) bounds
+        hex_bins = [] if first is None else list(itertools.chain([first], cursor))
+        next_page = str(hex_bins[limit - 1]["_id"]) if len(hex_bins) > limit else None
+        hex_bins = hex_bins[:limit]
+        for hex_bin in hex_bins:
+            del hex_bin["_id"]
+        if wants_binary(data):
+            return binary_response(hex_bin_message(
+                hex_bins, resolution=int(resolution), resolutions=resolutions, next=next_page,
+            ))
+        return jsonify({"hex_bins": hex_bins, "resolution": int(resolution), "resolutions": resolutions, "next": None}), 200
 
     except PyMongoError as e:
         return jsonify({"error": str(e)}), 500
     except Exception as e:
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
+
+@geojson_blueprint.route('/hex_bin_features/<dzi_file>/<int:resolution>/<hex_id>', methods=['GET'])
+def hex_bin_features(dzi_file, resolution, hex_id):
+    """
+    Drill-down for one hex: the ids of the features it counts, per annotation
+    file (only the given model's with ?model=).
+    """
+    query = {"dzi_file": dzi_file, "resolution": resolution, "hex_id": hex_id}
+    if request.args.get("model"):
+        query["model_name"] = request.args["model"]
+    try:
+        hex_bins = list(hexbin_collection.find(
+            query, {"_id": 0, "filename": 1, "model_name": 1, "annotation_count": 1, "feature_ids": 1},
+        ))
+    except PyMongoError as e:
+        return jsonify({"error": str(e)}), 500
+    if not hex_bins:
+        return jsonify({"error": "Hex bin not found"}), 404
+
+    return jsonify({
+        "hex_id": hex_id,
+        "resolution": resolution,
+        "annotation_count": sum(hex_bin.get("annotation_count", 0) for hex_bin in hex_bins),
+        "feature_ids": [feature_id for hex_bin in hex_bins for feature_id in hex_bin.get("feature_ids") or []],
+        "files": hex_bins,
+    })
+
 @geojson_blueprint.route('/annotation_model_mapping', methods=['GET'])
 def annotation_model_mapping():
     # Build mapping: {image_filename: [model1, model2, ...]}
     mapping = {}
-    for file_doc in db.fs.files.find({"filename": {"$regex": r".+_.+\\.geojson$"}}):
+    # Only the filename is read, so the scan stays within the filename index
+    for file_doc in db.fs.files.find({"filename": {"$regex": r"_.+\.geojson$"}}, {"_id": 0, "filename": 1}):
         filename = file_doc["filename"]
         # Extract image and model
         if "_" in filename:
@@ -0,0 +1,183 @@
+"""
+Incremental GeoJSON reader.
+
+Reads a FeatureCollection (or a bare list of features) from a binary stream
+such as an upload or a GridFS file, without loading the document. Geometry is
+emitted one part at a time (one point of a MultiPoint, one polygon of a
+MultiPolygon), so a CellViT export whose whole class is a single MultiPolygon
+is never held in memory either. Only the small values around the geometry
+(ids, properties) are decoded whole.
+
+iter_geojson_events yields, in document order:
+    ("part", geometry_type, coordinates)   for every part of the current feature
+    ("feature", feature)                   when a feature ends; its geometry only keeps "type"
+"""
+import codecs
+import json
+
+READ_SIZE = 1 << 20  # Characters decoded per read from the stream
+STREAMED_TYPES = ("MultiPoint", "MultiPolygon")  # Geometry types emitted element by element
+WHOLE_TYPES = ("Point", "Polygon")  # Geometry types that are a single part
+
+
+class GeoJSONStreamError(ValueError):
+    pass
+
+
+class _Reader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.consumed = 0
+
+    def fill(self, size=READ_SIZE):
+        if self.eof:
+            return False
+        if self.pos > READ_SIZE:
+            self.consumed += self.pos
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        data = self.stream.read(size)
+        if not data:
+            self.eof = True
+            self.buffer += self.decoder.decode(b"", final=True)
+            return False
+        self.buffer += self.decoder.decode(data) if isinstance(data, bytes) else data
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise GeoJSONStreamError("Unexpected end of GeoJSON")
+
+    def expect(self, characters):
+        character = self.peek()
+        if character not in characters:
+            raise GeoJSONStreamError(f"Expected one of {characters!r} at offset {self.consumed + self.pos}, got {character!r}")
+        self.pos += 1
+        return character
+
+    def value(self):
+        """
+        Decodes the next complete JSON value. A value that reaches the end of the
+        buffer may be cut (a number, or a truncated container), so more input is
+        read and decoding retried, doubling the read each time.
+        """
+        self.peek()
+        size = READ_SIZE
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise GeoJSONStreamError(f"Invalid JSON value at offset {self.consumed + self.pos}")
+            self.fill(size)
+            size *= 2
+
+    def array(self):
+        """
+        Iterates over the elements of an array; the caller consumes each element.
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(",]") == "]":
+                return
+
+    def members(self):
+        """
+        Iterates over the keys of an object; the caller consumes each value.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise GeoJSONStreamError(f"Expected an object key at offset {self.consumed + self.pos}")
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+
+def iter_geojson_events(stream):
+    """
+    Yields part and feature events (see module docstring) from a binary or text stream.
+    """
+    reader = _Reader(stream)
+    start = reader.peek()
+    if start == "[":
+        for _ in reader.array():
+            yield from _feature_events(reader)
+    elif start == "{":
+        found = False
+        for key in reader.members():
+            if key == "features":
+                found = True
+                for _ in reader.array():
+                    yield from _feature_events(reader)
+            else:
+                reader.value()
+        if not found:
+            raise GeoJSONStreamError("Invalid GeoJSON format: expected dict with 'features' or a list.")
+    else:
+        raise GeoJSONStreamError("Invalid GeoJSON format: expected dict with 'features' or a list.")
+
+
+def _feature_events(reader):
+    feature = {}
+    if reader.peek() != "{":
+        reader.value()  # Not a feature object
+        return
+    for key in reader.members():
+        if key == "geometry":
+            feature["geometry"] = yield from _geometry_events(reader)
+        else:
+            feature[key] = reader.value()
+    yield ("feature", feature)
+
+
+def _geometry_events(reader):
+    if reader.peek() != "{":
+        return reader.value()  # null geometry
+
+    geometry_type = None
+    stashed = None
+    for key in reader.members():
+        if key == "type":
+            geometry_type = reader.value()
+        elif key == "coordinates" and geometry_type in STREAMED_TYPES and reader.peek() == "[":
+            for _ in reader.array():
+                yield ("part", geometry_type, reader.value())
+        elif key == "coordinates" and geometry_type in WHOLE_TYPES:
+            coordinates = reader.value()
+            if coordinates:
+                yield ("part", geometry_type, coordinates)
+        elif key == "coordinates":
+            # The type is not known yet (or not supported): keep the coordinates until it is
+            stashed = reader.value()
+        else:
+            reader.value()
+
+    if stashed and geometry_type in WHOLE_TYPES:
+        yield ("part", geometry_type, stashed)
+    elif stashed and geometry_type in STREAMED_TYPES:
+        for part in stashed:
+            yield ("part", geometry_type, part)
+    return {"type": geometry_type}
@@ -0,0 +1,473 @@
+"""
+Array-based hexbin aggregation shared by the upload path and precompute.py.
+
+Vertices come from columnar annotation tables (see columnar.py), one batch at a
+time (see HexbinAccumulator). Coordinates are normalized to lat/lon in bulk,
+assigned to H3 cells in batches (see assign_cells), and the per-cell counts are
+grouped reductions over integer keys instead of nested dict updates per vertex.
+At the finest resolution the resulting documents are the same as the ones the
+per-vertex loop produced. Coarser resolutions are rolled up from the finest
+with cell_to_parent, and H3 children do not exactly tile their parent, so a
+coarse bin counts the vertices whose fine cell rolls up to it: its counts can
+differ from assigning every vertex directly at that resolution.
+"""
+import logging
+import math
+import os
+from itertools import repeat
+
+import h3
+import numpy as np
+from dotenv import load_dotenv
+from h3.api import basic_int as h3_int
+
+from columnar import part_vertex_offsets
+from metrics import log_event
+
+load_dotenv()
+
+# Resolutions precomputed for every annotation file; the coarsest one is shown with the whole slide in view
+HEX_RESOLUTIONS = sorted({int(resolution) for resolution in os.getenv("HEX_RESOLUTIONS", "2,3,4").split(",")})
+HEXBIN_VERSION = 1  # Bump when the aggregation changes, so precompute.py recomputes stored hex bins
+RESOLUTION_SCALE = math.sqrt(7)  # Ratio of hexagon edge lengths between consecutive H3 resolutions
+
+DEFAULT_COLOR = [255, 255, 255]  # Default to white
+
+MIN_POINTS_PER_BLOCK = 64  # Below this density, plain scalar H3 calls are cheaper than guessing
+BATCH_SIZE = 1 << 20  # Points per edge test batch, bounds temporary memory
+EARTH_RADIUS_KM = 6371.0
+EDGE_EPSILON = 1e-9  # Points this close to a cell edge (in radians) are resolved by H3 itself
+
+# Fields identifying a geojson_hex_bins document: one hex of one annotation file at one resolution
+HEX_BIN_KEY = ("dzi_file", "resolution", "hex_id", "filename")
+
+
+def normalize_to_lat_lon(x, y, image_width, image_height):
+    normalized_x = x / image_width
+    normalized_y = y / image_height
+    latitude = normalized_y * 180 - 90
+    longitude = normalized_x * 360 - 180
+    return latitude, longitude
+
+
+def lat_lon_to_image_coordinates(lat, lon, image_width, image_height):
+    x = ((lon + 180) / 360) * image_width
+    y = ((lat + 90) / 180) * image_height
+    return x, y
+
+
+def _unit_vectors(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def _edge_normals(cells):
+    """
+    Inward normals of the great circles through the edges of each cell, shape (n, 6, 3).
+    Cells that are not plain hexagons (pentagons, or cells split by an icosahedron
+    edge whose boundary has extra vertices) are flagged so they always fall back.
+    """
+    boundaries = [h3_int.cell_to_boundary(cell) for cell in cells.tolist()]
+    usable = np.array([len(boundary) == 6 for boundary in boundaries], dtype=bool)
+    usable &= ~np.fromiter(map(h3_int.is_pentagon, cells.tolist()), dtype=bool, count=len(cells))
+    corners = np.zeros((len(cells), 6, 2))
+    if usable.any():
+        corners[usable] = np.array([boundary for boundary, ok in zip(boundaries, usable) if ok])
+    vertices = _unit_vectors(corners[..., 0], corners[..., 1])
+    normals = np.cross(vertices, np.roll(vertices, -1, axis=1))
+    # Orient every normal towards the cell center, i.e. the inside of the hexagon
+    centers = vertices.sum(axis=1)
+    normals *= np.sign(np.einsum("nej,nj->ne", normals, centers))[..., None]
+    lengths = np.linalg.norm(normals, axis=-1, keepdims=True)
+    return np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0), usable
+
+
+def _with_neighbors(cell):
+    """
+    The cell followed by its neighbors, padded with the cell itself next to pentagons.
+    """
+    neighbors = [neighbor for neighbor in h3_int.grid_disk(cell, 1) if neighbor != cell]
+    return [cell] + neighbors + [cell] * (6 - len(neighbors))
+
+
+def _scalar_cells(lat, lon, resolution):
+    cells = np.empty(len(lat), dtype=np.uint64)
+    for start in range(0, len(lat), BATCH_SIZE):
+        batch = slice(start, start + BATCH_SIZE)
+        cells[batch] = np.fromiter(
+            map(h3_int.latlng_to_cell, lat[batch].tolist(), lon[batch].tolist(), repeat(resolution)),
+            dtype=np.uint64, count=len(lat[batch]),
+        )
+    return cells
+
+
+def assign_cells(lat, lon, resolution):
+    """
+    Returns the H3 cell (as uint64) of every coordinate.
+
+    H3 has no batched point-to-cell call, so each point's cell is guessed from a
+    grid about one hexagon edge wide (one H3 call per grid block) and confirmed by
+    testing the point against the edges of the guessed cell and its neighbors.
+    Points within EDGE_EPSILON of an edge, or next to a pentagon or an icosahedron
+    edge, get the scalar H3 call, so the result is identical to calling H3 for
+    every point. When there are too few points per grid block for the guesses to
+    pay off (sparse annotations, fine resolutions), every point gets the scalar call.
+    """
+    step = np.degrees(h3.average_hexagon_edge_length(resolution, unit="km") / EARTH_RADIUS_KM)
+    rows = np.floor(lat / step).astype(np.int64)
+    cols = np.floor(lon / step).astype(np.int64)
+    _, block_first, block_of_point = np.unique((rows << 32) + cols, return_index=True, return_inverse=True)
+    if len(block_first) * MIN_POINTS_PER_BLOCK > len(lat):
+        return _scalar_cells(lat, lon, resolution)
+
+    block_cells = _scalar_cells(
+        np.clip((rows[block_first] + 0.5) * step, -90, 90), (cols[block_first] + 0.5) * step, resolution
+    )
+
+    # Every guessed cell with its six neighbors, as indices into one table of edge normals
+    guesses, guess_of_block = np.unique(block_cells, return_inverse=True)
+    options = np.array([_with_neighbors(cell) for cell in guesses.tolist()], dtype=np.uint64)
+    table, option_index = np.unique(options, return_inverse=True)
+    option_index = option_index.reshape(options.shape)
+    normals, usable = _edge_normals(table)
+    guess_of_point = guess_of_block.ravel()[block_of_point.ravel()]
+
+    cells = np.zeros(len(lat), dtype=np.uint64)
+    resolved = np.zeros(len(lat), dtype=bool)
+    for start in range(0, len(lat), BATCH_SIZE):
+        batch = np.arange(start, min(start + BATCH_SIZE, len(lat)))
+        points = _unit_vectors(lat[batch], lon[batch])
+        batch_options = option_index[guess_of_point[batch]]
+        pending = np.arange(len(batch))
+        for column in range(batch_options.shape[1]):
+            option = batch_options[pending, column]
+            inside = usable[option] & (
+                np.einsum("nej,nj->ne", normals[option], points[pending]) > EDGE_EPSILON
+            ).all(axis=1)
+            found = batch[pending[inside]]
+            cells[found] = table[option[inside]]
+            resolved[found] = True
+            pending = pending[~inside]
+            if len(pending) == 0:
+                break
+
+    fallback = np.flatnonzero(~resolved)
+    cells[fallback] = _scalar_cells(lat[fallback], lon[fallback], resolution)
+    return cells
+
+
+def class_dictionary(classes):
+    """
+    Merges a class dictionary (the properties of each class, see columnar.py) by
+    classification name. Returns the merged class of every entry, the class names
+    and the classification color of every entry.
+    """
+    class_ids = {}
+    dictionary_class = []
+    dictionary_color = []
+    for properties in classes:
+        classification = properties.get("classification", {})
+        dictionary_class.append(class_ids.setdefault(classification.get("name", "Unknown"), len(class_ids)))
+        dictionary_color.append(classification.get("color", DEFAULT_COLOR))
+    return dictionary_class, list(class_ids), dictionary_color
+
+
+class HexbinAccumulator:
+    """
+    Collects hexbin counts at one resolution from batches of vertices. Only the
+    distinct (cell, feature) pairs are kept, with their vertex count and the
+    position of their first vertex, so memory follows the number of pairs and not
+    the number of vertices. Classes are applied in pyramid(), once every feature
+    is complete.
+    """
+
+    def __init__(self, image_width, image_height, resolution):
+        self.image_width = image_width
+        self.image_height = image_height
+        self.resolution = resolution
+        self.batches = []
+        self.grouped_size = 0
+
+    def add(self, coords, part_offsets, pids, fids):
+        """
+        Adds the vertices of parts: coords[part_offsets[i]:part_offsets[i + 1]] are
+        the vertices of part pids[i], which belongs to feature fids[i].
+        """
+        vertex_counts = np.diff(part_offsets)
+        if vertex_counts.sum() == 0:
+            return
+        vertex_part = np.repeat(np.arange(len(vertex_counts)), vertex_counts)
+        # Vertex order within the file: by part, then by position in the part
+        first = (np.asarray(pids, dtype=np.int64)[vertex_part] << 32) + (
+            np.arange(len(vertex_part)) - part_offsets[vertex_part] + part_offsets[0]
+        )
+        coords = coords[part_offsets[0]:part_offsets[-1]]
+        lat, lon = normalize_to_lat_lon(
+            coords[:, 0].astype(np.float64), coords[:, 1].astype(np.float64), self.image_width, self.image_height
+        )
+        cells = assign_cells(lat, lon, self.resolution)
+
+        self.batches.append(_group_pairs(
+            cells, np.asarray(fids, dtype=np.int64)[vertex_part], np.ones(len(cells), dtype=np.int64), first
+        ))
+        # Regroup once the batches have doubled, which keeps merging linear overall
+        if sum(len(batch[0]) for batch in self.batches) > 2 * max(self.grouped_size, BATCH_SIZE):
+            self._merge()
+
+    def add_table(self, table):
+        """
+        Adds every part of a columnar table (or streamed batch, see columnar.TableBuilder).
+        """
+        part_count = len(table["part_feature"])
+        self.add(
+            table["coords"], part_vertex_offsets(table),
+            table["part_start"] + np.arange(part_count), table["feature_start"] + table["part_feature"],
+        )
+
+    def _merge(self):
+        if len(self.batches) > 1:
+            self.batches = [_group_pairs(*(np.concatenate(column) for column in zip(*self.batches)))]
+        self.grouped_size = len(self.batches[0][0]) if self.batches else 0
+
+    def pyramid(self, feature_ids, feature_classes, classes, resolutions):
+        """
+        Returns {resolution: hex_bins} for the accumulator's resolution and coarser
+        ones, which are rolled up from it with cell_to_parent. feature_ids and
+        feature_classes cover every feature of the file, classes is its class
+        dictionary (see columnar.py). Features without an id are left out.
+        """
+        resolutions = sorted(set(resolutions), reverse=True)
+        if resolutions[0] != self.resolution:
+            raise ValueError(f"Hexbins were accumulated at resolution {self.resolution}, not {resolutions[0]}")
+        self._merge()
+        if not self.batches:
+            return {resolution: {} for resolution in resolutions}
+        pair_cell, pair_feature, pair_count, pair_first = self.batches[0]
+
+        has_id = np.array([bool(feature_id) for feature_id in feature_ids], dtype=bool)
+        if not has_id.all():
+            log_event("features_without_id", level=logging.WARNING, skipped=int((~has_id).sum()))
+            keep = has_id[pair_feature]
+            pair_cell, pair_feature, pair_count, pair_first = (
+                pair_cell[keep], pair_feature[keep], pair_count[keep], pair_first[keep]
+            )
+
+        dictionary_class, class_names, dictionary_color = class_dictionary(classes)
+        labels = {
+            "feature_ids": feature_ids,
+            "feature_classes": np.array(dictionary_class, dtype=np.int64)[np.asarray(feature_classes, dtype=np.int64)]
+            if len(feature_classes) else np.zeros(0, dtype=np.int64),
+            "feature_properties": np.asarray(feature_classes, dtype=np.int64),
+            "class_colors": dictionary_color,
+            "class_names": class_names,
+        }
+
+        level = _aggregate(pair_cell, pair_feature, pair_count, pair_first, labels)
+        pyramid = {}
+        for resolution in resolutions:
+            if resolution != resolutions[0]:
+                level = _roll_up(level, resolution, labels)
+            pyramid[resolution] = _hex_bins(level, labels)
+        return pyramid
+
+
+def _group_pairs(cells, features, counts, first):
+    """
+    Sums counts and keeps the smallest first position per distinct (cell, feature)
+    pair; the pairs come out sorted by cell, then feature.
+    """
+    order = np.lexsort((features, cells))
+    cells, features = cells[order], features[order]
+    starts = np.ones(len(cells), dtype=bool)
+    starts[1:] = (cells[1:] != cells[:-1]) | (features[1:] != features[:-1])
+    starts = np.flatnonzero(starts)
+    return (
+        cells[starts],
+        features[starts],
+        np.add.reduceat(counts[order], starts),
+        np.minimum.reduceat(first[order], starts),
+    )
+
+
+def _first_of_groups(groups, first, values):
+    """
+    For groups 0..n-1, the smallest first position of each group and the value
+    of the entry that has it.
+    """
+    order = np.lexsort((first, groups))
+    starts = np.flatnonzero(np.diff(groups[order], prepend=-1))
+    return first[order][starts], values[order][starts]
+
+
+def _aggregate(pair_cell, pair_feature, pair_count, pair_first, labels):
+    """
+    Groups (cell, feature) pairs by cell into arrays: per cell counts, per (cell,
+    class) counts and the distinct (cell, feature) pairs. The first vertex position
+    is kept for cells and (cell, class) pairs, since it decides dict order, and the
+    feature of that vertex for (cell, class) pairs, since it decides colors.
+    """
+    n_classes = max(len(labels["class_names"]), 1)
+
+    cells, cell_of_pair = np.unique(pair_cell, return_inverse=True)
+    cell_of_pair = cell_of_pair.ravel()
+    first = np.full(len(cells), np.iinfo(np.int64).max)
+    np.minimum.at(first, cell_of_pair, pair_first)
+
+    class_keys, class_of_pair = np.unique(
+        cell_of_pair * n_classes + labels["feature_classes"][pair_feature], return_inverse=True
+    )
+    class_of_pair = class_of_pair.ravel()
+    class_first, class_feature = _first_of_groups(class_of_pair, pair_first, pair_feature)
+
+    return {
+        "cells": cells,
+        "first": first,
+        "counts": np.bincount(cell_of_pair, weights=pair_count, minlength=len(cells)).astype(np.int64),
+        "class_cell": class_keys // n_classes,
+        "class_id": class_keys % n_classes,
+        "class_first": class_first,
+        "class_feature": class_feature,
+        "class_count": np.bincount(class_of_pair, weights=pair_count, minlength=len(class_keys)).astype(np.int64),
+        "feature_cell": cell_of_pair,
+        "feature_id": pair_feature,
+    }
+
+
+def _roll_up(level, resolution, labels):
+    """
+    Derives the aggregates of a coarser resolution by merging child cells into
+    their parents, without going back to the vertices.
+    """
+    n_classes = max(len(labels["class_names"]), 1)
+    n_features = max(len(labels["feature_ids"]), 1)
+
+    parent_cells = np.fromiter(
+        map(h3_int.cell_to_parent, level["cells"].tolist(), repeat(resolution)),
+        dtype=np.uint64, count=len(level["cells"]),
+    )
+    cells, parent_of_cell = np.unique(parent_cells, return_inverse=True)
+    parent_of_cell = parent_of_cell.ravel()
+    first = np.full(len(cells), np.iinfo(np.int64).max)
+    np.minimum.at(first, parent_of_cell, level["first"])
+
+    class_keys, class_of_child = np.unique(
+        parent_of_cell[level["class_cell"]] * n_classes + level["class_id"], return_inverse=True
+    )
+    class_of_child = class_of_child.ravel()
+    class_first, class_feature = _first_of_groups(class_of_child, level["class_first"], level["class_feature"])
+
+    feature_keys = np.unique(parent_of_cell[level["feature_cell"]] * n_features + level["feature_id"])
+
+    return {
+        "cells": cells,
+        "first": first,
+        "counts": np.bincount(parent_of_cell, weights=level["counts"], minlength=len(cells)).astype(np.int64),
+        "class_cell": class_keys // n_classes,
+        "class_id": class_keys % n_classes,
+        "class_first": class_first,
+        "class_feature": class_feature,
+        "class_count": np.bincount(class_of_child, weights=level["class_count"], minlength=len(class_keys)).astype(np.int64),
+        "feature_cell": feature_keys // n_features,
+        "feature_id": feature_keys % n_features,
+    }
+
+
+def _hex_bins(level, labels):
+    """
+    Converts aggregate arrays into {hex_id: {"feature_ids", "annotation_count", "classifications"}},
+    with cells and classifications in the order their first vertex was seen.
+    """
+    cells = level["cells"]
+    feature_bounds = np.searchsorted(level["feature_cell"], np.arange(len(cells) + 1))
+    hex_ids = [h3_int.int_to_str(cell) for cell in cells.tolist()]
+
+    hex_bins = {}
+    for cell_index in np.argsort(level["first"], kind="stable").tolist():
+        features = level["feature_id"][feature_bounds[cell_index]:feature_bounds[cell_index + 1]]
+        hex_bins[hex_ids[cell_index]] = {
+            "feature_ids": [labels["feature_ids"][feature] for feature in features.tolist()],
+            "annotation_count": int(level["counts"][cell_index]),
+            "classifications": {},
+        }
+
+    for key_index in np.lexsort((level["class_first"], level["class_cell"])).tolist():
+        feature = int(level["class_feature"][key_index])
+        hex_bins[hex_ids[level["class_cell"][key_index]]]["classifications"][
+            labels["class_names"][level["class_id"][key_index]]
+        ] = {
+            "count": int(level["class_count"][key_index]),
+            "color": labels["class_colors"][labels["feature_properties"][feature]],
+        }
+
+    return hex_bins
+
+
+def compute_hex_pyramid(table, image_width, image_height, resolutions):
+    """
+    Returns {resolution: hex_bins} for all resolutions of a whole columnar table
+    (see columnar.encode_features) in one pass over the vertices. Only the finest
+    resolution is computed from the geometry, coarser ones are rolled up from it.
+    """
+    accumulator = HexbinAccumulator(image_width, image_height, max(resolutions))
+    accumulator.add_table(table)
+    return accumulator.pyramid(table["feature_ids"], table["feature_classes"], table["classes"], resolutions)
+
+
+def compute_hex_bins(table, image_width, image_height, resolution):
+    """
+    Aggregates a columnar table into the hex bins of a single resolution,
+    matching the dicts add_to_hex_bins used to build one vertex at a time.
+    """
+    return compute_hex_pyramid(table, image_width, image_height, [resolution])[resolution]
+
+
+def resolution_for_zoom(zoom, resolutions):
+    """
+    Picks the resolution whose hexagons keep the on-screen size the coarsest
+    resolution has at zoom 1, i.e. one resolution finer per sqrt(7) zoom factor.
+    """
+    target = min(resolutions) + math.log(max(zoom, 1e-6)) / math.log(RESOLUTION_SCALE)
+    return min(resolutions, key=lambda resolution: (abs(resolution - target), resolution))
+
+
+def hex_bin_bbox(image_coordinates):
+    """
+    Bounding box {x_min, y_min, x_max, y_max} of a hexagon boundary in image coordinates.
+    """
+    xs = [x for x, _ in image_coordinates]
+    ys = [y for _, y in image_coordinates]
+    return {"x_min": min(xs), "y_min": min(ys), "x_max": max(xs), "y_max": max(ys)}
+
+
+def hex_bin_geometry(hex_id, image_width, image_height):
+    """
+    The image_coordinates (boundary) and bbox fields of a hexagon's document.
+    """
+    image_coordinates = [
+        lat_lon_to_image_coordinates(lat, lon, image_width, image_height)
+        for lat, lon in h3.cell_to_boundary(hex_id)
+    ]
+    return {"image_coordinates": image_coordinates, "bbox": hex_bin_bbox(image_coordinates)}
+
+
+def hex_bin_documents(dzi_file, hex_bins, resolution, image_width, image_height, filename=None, model_name=None):
+    """
+    Builds the geojson_hex_bins documents for one resolution of an annotation
+    file. A document is identified by HEX_BIN_KEY; its bbox lets hex bins be
+    queried by viewport.
+    """
+    documents = []
+    for hex_id, hex_data in hex_bins.items():
+        documents.append({
+            "dzi_file": dzi_file,
+            "filename": filename,
+            "model_name": model_name,
+            "hex_id": hex_id,
+            "feature_ids": hex_data["feature_ids"],
+            "annotation_count": hex_data["annotation_count"],
+            "resolution": resolution,
+            **hex_bin_geometry(hex_id, image_width, image_height),
+            "classifications": hex_data["classifications"],
+        })
+    return documents
@@ -0,0 +1,288 @@
+"""
+Incremental maintenance of the geojson_hex_bins collection.
+
+Hex bins are stored per annotation file (see hexbin.HEX_BIN_KEY), so every
+file's - and through it every model's - contribution to a slide can be
+updated, dropped or rebuilt on its own. Stored bins are never rewritten
+wholesale: hex_bin_delta compares the bins a file should have with the bins it
+has, and apply_hex_bin_delta turns the difference into $inc updates of the
+vertex and class counts and $push/$pull updates of the feature ids, only
+for the hexes that changed. Storing a file again (a replaced upload), adding or
+removing features and repairing drift all go through it; hexes and classes
+whose count drops to zero are removed. The first bins of a file are simply
+inserted.
+
+check_hex_bins compares the stored bins of a file with a fresh aggregation of
+its spatial index. Run as a script, this module checks (and with --repair
+fixes, or with --drop removes) the hex bins of a slide:
+
+    python hexbin_updates.py <dzi_file> [--model NAME] [--repair] [--drop]
+"""
+import argparse
+import json
+import logging
+import sys
+from collections import Counter
+
+import pymongo
+
+from annotation_index import is_indexed
+from annotation_ingest import index_hex_pyramid
+from hexbin import HEX_RESOLUTIONS, HEXBIN_VERSION, hex_bin_documents, hex_bin_geometry
+from metrics import log_event
+from mongo import get_db
+
+EMPTY_BIN = {"annotation_count": 0, "classifications": {}, "feature_ids": []}
+CLEANUP_BATCH = 10000  # Hex ids per query for the hexes whose counts went down
+
+
+def _counted(feature_ids):
+    return Counter(json.dumps(feature_id) for feature_id in feature_ids)
+
+
+def hex_bin_delta(new_bins, old_bins):
+    """
+    Changes that turn old_bins into new_bins (both {hex_id: {"annotation_count",
+    "classifications", "feature_ids"}}, as in a hexbin pyramid level or read by
+    stored_hex_bins): {hex_id: {"count", "classes": {name: {"count", "color"}},
+    "add_features", "remove_features"}} with count differences, for the hexes
+    that differ. When a hex lists a feature id more than once (features without
+    an id), its whole new list is given as "feature_ids" instead.
+    """
+    delta = {}
+    for hex_id in new_bins.keys() | old_bins.keys():
+        new = new_bins.get(hex_id) or EMPTY_BIN
+        old = old_bins.get(hex_id) or EMPTY_BIN
+
+        new_classes, old_classes = new.get("classifications") or {}, old.get("classifications") or {}
+        classes = {}
+        for name in new_classes.keys() | old_classes.keys():
+            new_class = new_classes.get(name) or {"count": 0}
+            old_class = old_classes.get(name) or {"count": 0}
+            if new_class["count"] != old_class["count"] or new_class.get("color") != old_class.get("color"):
+                classes[name] = {
+                    "count": new_class["count"] - old_class["count"],
+                    "color": new_class.get("color", old_class.get("color")),
+                }
+
+        change = {"count": new.get("annotation_count", 0) - old.get("annotation_count", 0), "classes": classes}
+        new_features, old_features = _counted(new.get("feature_ids") or []), _counted(old.get("feature_ids") or [])
+        if new_features != old_features:
+            if max(new_features.values(), default=1) > 1 or max(old_features.values(), default=1) > 1:
+                change["feature_ids"] = new.get("feature_ids") or []
+            else:
+                change["add_features"] = [json.loads(key) for key in new_features if key not in old_features]
+                change["remove_features"] = [json.loads(key) for key in old_features if key not in new_features]
+
+        if change["count"] or classes or len(change) > 2:
+            delta[hex_id] = change
+    return delta
+
+
+def _field_name(name):
+    # Class names become part of update paths
+    if not isinstance(name, str) or not name or "." in name or name.startswith("$"):
+        raise ValueError(f"Classification name {name!r} cannot be updated in place")
+    return name
+
+
+def apply_hex_bin_delta(collection, dzi_file, filename, model_name, resolution, delta, image_width, image_height):
+    """
+    Applies a hex_bin_delta to the stored hex bins of one annotation file at
+    one resolution. Raises ValueError, before writing anything, for a class
+    name that cannot be used in an update path (see store_hex_pyramid).
+    """
+    operations = []
+    shrunk = []
+    for hex_id, change in delta.items():
+        key = {"dzi_file": dzi_file, "resolution": resolution, "hex_id": hex_id, "filename": filename}
+        update = {
+            "$inc": {"annotation_count": change["count"]},
+            "$setOnInsert": {"model_name": model_name, **hex_bin_geometry(hex_id, image_width, image_height)},
+        }
+        for name, classification in change["classes"].items():
+            update["$inc"][f"classifications.{_field_name(name)}.count"] = classification["count"]
+            update.setdefault("$set", {})[f"classifications.{name}.color"] = classification["color"]
+        if "feature_ids" in change:
+            update.setdefault("$set", {})["feature_ids"] = change["feature_ids"]
+        elif change.get("remove_features"):
+            operations.append(pymongo.UpdateOne(key, {"$pull": {"feature_ids": {"$in": change["remove_features"]}}}))
+        if change.get("add_features"):
+            update["$push"] = {"feature_ids": {"$each": change["add_features"]}}
+        operations.append(pymongo.UpdateOne(key, update, upsert=True))
+        if change["count"] < 0 or any(c["count"] < 0 for c in change["classes"].values()):
+            shrunk.append(hex_id)
+
+    if operations:
+        collection.bulk_write(operations)
+
+    # Hexes the file no longer has a vertex in, and classes it no longer has in a hex, are removed
+    cleanup = []
+    for start in range(0, len(shrunk), CLEANUP_BATCH):
+        hex_ids = shrunk[start:start + CLEANUP_BATCH]
+        for document in collection.find(
+            {"dzi_file": dzi_file, "resolution": resolution, "hex_id": {"$in": hex_ids}, "filename": filename},
+            {"annotation_count": 1, "classifications": 1},
+        ):
+            if document.get("annotation_count", 0) <= 0:
+                cleanup.append(pymongo.DeleteOne({"_id": document["_id"]}))
+                continue
+            empty = [name for name, c in (document.get("classifications") or {}).items() if c.get("count", 0) <= 0]
+            if empty:
+                cleanup.append(pymongo.UpdateOne(
+                    {"_id": document["_id"]}, {"$unset": {f"classifications.{name}": "" for name in empty}},
+                ))
+    if cleanup:
+        collection.bulk_write(cleanup, ordered=False)
+
+
+def stored_hex_bins(collection, dzi_file, filename, resolution):
+    """
+    The stored hex bins of one annotation file at one resolution, in the form of a pyramid level.
+    """
+    return {
+        document["hex_id"]: document
+        for document in collection.find(
+            {"dzi_file": dzi_file, "resolution": resolution, "filename": filename},
+            {"_id": 0, "hex_id": 1, "annotation_count": 1, "classifications": 1, "feature_ids": 1},
+        )
+    }
+
+
+def store_hex_pyramid(collection, dzi_file, filename, model_name, pyramid, image_width, image_height, resolutions):
+    """
+    Stores the hexbin pyramid ({resolution: hex_bins}) of one annotation file.
+    A file without stored bins at a resolution (its first ingest) has them
+    inserted as they are; otherwise only the hexes that differ from what is
+    stored are written. When class names rule out in-place updates, the
+    file's hex bins at that resolution are replaced as a whole.
+    """
+    for resolution in resolutions:
+        hex_bins = pyramid[resolution]
+        stored = stored_hex_bins(collection, dzi_file, filename, resolution)
+        if not stored:
+            log_event("hex_bins_stored", dzi=dzi_file, filename=filename, resolution=resolution,
+                      hex_bins=len(hex_bins), changed=len(hex_bins), first_ingest=True)
+            _insert_hex_bins(collection, dzi_file, filename, model_name, resolution, hex_bins, image_width, image_height)
+            continue
+        delta = hex_bin_delta(hex_bins, stored)
+        log_event("hex_bins_stored", dzi=dzi_file, filename=filename, resolution=resolution,
+                  hex_bins=len(hex_bins), changed=len(delta), first_ingest=False)
+        try:
+            apply_hex_bin_delta(
+                collection, dzi_file, filename, model_name, resolution, delta, image_width, image_height,
+            )
+        except ValueError as e:
+            log_event("hex_bins_replaced", level=logging.WARNING, dzi=dzi_file, filename=filename,
+                      resolution=resolution, reason=str(e))
+            collection.delete_many({"dzi_file": dzi_file, "resolution": resolution, "filename": filename})
+            _insert_hex_bins(collection, dzi_file, filename, model_name, resolution, hex_bins, image_width, image_height)
+
+
+def _insert_hex_bins(collection, dzi_file, filename, model_name, resolution, hex_bins, image_width, image_height):
+    documents = hex_bin_documents(dzi_file, hex_bins, resolution, image_width, image_height, filename, model_name)
+    if documents:
+        collection.insert_many(documents, ordered=False)
+
+
+def hex_bin_stamp(resolutions):
+    """
+    Recorded as metadata.hex_bins of a GridFS annotation file once its hex bins
+    are stored; the bins are current while it matches.
+    """
+    return {"version": HEXBIN_VERSION, "resolutions": sorted(int(resolution) for resolution in resolutions)}
+
+
+def drop_hex_bins(collection, dzi_file, filename=None, model_name=None):
+    """
+    Removes the hex bins one annotation file (or every file of a model) contributes to a slide.
+    """
+    query = {"dzi_file": dzi_file}
+    if filename:
+        query["filename"] = filename
+    if model_name:
+        query["model_name"] = model_name
+    return collection.delete_many(query).deleted_count
+
+
+def check_hex_bins(db, file_doc, resolutions=None):
+    """
+    Compares the stored hex bins of an indexed annotation file with a fresh
+    aggregation of its spatial index. Returns {resolution: hex_bin_delta} for
+    the resolutions that differ, so an empty dict means the stored bins are
+    consistent.
+    """
+    metadata = file_doc["metadata"]
+    if resolutions is None:
+        stored = db.geojson_hex_bins.distinct(
+            "resolution", {"dzi_file": metadata["dzi_file"], "filename": metadata["filename"]},
+        )
+        resolutions = sorted(set(HEX_RESOLUTIONS) | set(stored))
+    pyramid = index_hex_pyramid(db, file_doc, resolutions)
+    differences = {}
+    for resolution in resolutions:
+        delta = hex_bin_delta(
+            pyramid[resolution],
+            stored_hex_bins(db.geojson_hex_bins, metadata["dzi_file"], metadata["filename"], resolution),
+        )
+        if delta:
+            differences[resolution] = delta
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check, repair or drop the hex bins of a slide.")
+    parser.add_argument("dzi_file")
+    parser.add_argument("--model", help="only the annotation file of this model")
+    parser.add_argument("--repair", action="store_true", help="write the differences found to the stored bins")
+    parser.add_argument("--drop", action="store_true", help="remove the hex bins first (with --repair, a rebuild)")
+    args = parser.parse_args()
+
+    database = get_db()
+    hexbin_collection = database.geojson_hex_bins
+
+    query = {"metadata.dzi_file": args.dzi_file}
+    if args.model:
+        query["metadata.model_name"] = args.model
+
+    if args.drop:
+        removed = drop_hex_bins(hexbin_collection, args.dzi_file, model_name=args.model)
+        database.fs.files.update_many(query, {"$unset": {"metadata.hex_bins": ""}})
+        print(f"Removed {removed} hex bins.")
+
+    file_docs = list(database.fs.files.find(query))
+
+    # Bins of annotation files that no longer exist
+    orphans = set(hexbin_collection.distinct("filename", {"dzi_file": args.dzi_file})) - {
+        file_doc["metadata"].get("filename") for file_doc in database.fs.files.find({"metadata.dzi_file": args.dzi_file})
+    }
+    inconsistent = bool(orphans)
+    for orphan in sorted(orphans, key=str):
+        print(f"Hex bins of {orphan}, which is not an annotation file of {args.dzi_file}.")
+        if args.repair:
+            drop_hex_bins(hexbin_collection, args.dzi_file, filename=orphan)
+
+    for file_doc in file_docs:
+        metadata = file_doc["metadata"]
+        if not is_indexed(metadata):
+            print(f"Skipping {metadata['filename']}: not indexed yet.")
+            continue
+        differences = check_hex_bins(database, file_doc)
+        for resolution, delta in differences.items():
+            print(f"{metadata['filename']}: {len(delta)} hex bins differ at resolution {resolution}.")
+        if not differences:
+            print(f"{metadata['filename']}: consistent.")
+        elif args.repair:
+            for resolution, delta in differences.items():
+                apply_hex_bin_delta(
+                    hexbin_collection, metadata["dzi_file"], metadata["filename"], metadata.get("model_name"),
+                    resolution, delta, metadata["image_width"], metadata["image_height"],
+                )
+            database.fs.files.update_one(
+                {"_id": file_doc["_id"]}, {"$set": {"metadata.hex_bins": hex_bin_stamp(HEX_RESOLUTIONS)}},
+            )
+            print(f"{metadata['filename']}: repaired.")
+        else:
+            inconsistent = True
+
+    sys.exit(1 if inconsistent and not args.repair else 0)
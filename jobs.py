@@ -0,0 +1,333 @@
+"""
+Background ingestion jobs.
+
+Slide tiling and annotation ingestion run in a local process pool instead of
+the Flask request. Every job has a row in a SQLite job table (JOBS_DB) holding
+its status, progress and result, so status survives restarts and is shared by
+all server processes on the host. INGEST_WORKERS bounds how many jobs run at
+once per server process, leaving the request workers free for the viewer.
+
+The pool starts with the first request or job. Jobs found queued or running
+for a server process that no longer exists are picked up again then: tiling resumes from the tiler journal,
+an interrupted annotation ingest is marked failed so it can be uploaded again.
+"""
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+from flask import Blueprint, jsonify, request
+
+from metrics import log_event, log_exception
+from tiler import TILE_WORKERS
+
+load_dotenv()
+
+JOBS_DB = os.getenv("JOBS_DB", "jobs.db")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+PROGRESS_INTERVAL = 0.5  # Seconds between progress writes from a running job
+
+ACTIVE_STATUSES = ("queued", "running")
+RESUMABLE_KINDS = ("tile_slide", "tile_patch")
+
+jobs_blueprint = Blueprint('jobs', __name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+_futures = {}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _connect():
+    connection = sqlite3.connect(JOBS_DB, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            job_key TEXT,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL,
+            done_units INTEGER DEFAULT 0,
+            total_units INTEGER DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            cancel_requested INTEGER DEFAULT 0,
+            owner_pid INTEGER,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL
+        )
+    """)
+    connection.execute("CREATE INDEX IF NOT EXISTS jobs_key_status ON jobs (job_key, status)")
+    return connection
+
+
+def _update(job_id, **fields):
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with _connect() as connection:
+        connection.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+def get_job(job_id):
+    with _connect() as connection:
+        row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _job_dict(row) if row else None
+
+
+def _job_dict(row):
+    job = {
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "done": row["done_units"],
+        "total": row["total_units"],
+        "progress": row["done_units"] / row["total_units"] if row["total_units"] else 0.0,
+        "eta_seconds": None,
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+    }
+    if row["status"] == "running" and row["started_at"] and 0 < job["progress"] < 1:
+        elapsed = time.time() - row["started_at"]
+        job["eta_seconds"] = round(elapsed * (1 - job["progress"]) / job["progress"], 1)
+    return job
+
+
+def find_active_job(job_key):
+    with _connect() as connection:
+        row = connection.execute(
+            "SELECT * FROM jobs WHERE job_key = ? AND status IN (?, ?) ORDER BY created_at DESC LIMIT 1",
+            (job_key, *ACTIVE_STATUSES),
+        ).fetchone()
+    return _job_dict(row) if row else None
+
+
+def submit_job(kind, params, job_key=None):
+    """
+    Records a job and queues it on the pool. A job with the same key that is
+    still queued or running is returned instead of starting a second one; the
+    check and the insert share one write transaction, so concurrent requests
+    (from any server process) cannot both start it.
+    """
+    job_id = uuid.uuid4().hex
+    connection = _connect()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        if job_key:
+            active = connection.execute(
+                "SELECT id FROM jobs WHERE job_key = ? AND status IN (?, ?) ORDER BY created_at DESC LIMIT 1",
+                (job_key, *ACTIVE_STATUSES),
+            ).fetchone()
+            if active:
+                connection.rollback()
+                return active["id"]
+        connection.execute(
+            "INSERT INTO jobs (id, kind, job_key, params, status, owner_pid, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, job_key, json.dumps(params), "queued", os.getpid(), time.time()),
+        )
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    _submit(job_id)
+    return job_id
+
+
+def _submit(job_id):
+    future = _get_pool().submit(run_job, job_id)
+    _futures[job_id] = future
+    future.add_done_callback(lambda _: _futures.pop(job_id, None))
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned workers start without the parent's Mongo client and Flask state
+            _pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            threading.Thread(target=recover_jobs, daemon=True).start()
+        return _pool
+
+
+@jobs_blueprint.before_app_request
+def start_job_pool():
+    """
+    Starts the pool and recovers interrupted jobs with the first request the
+    server handles, rather than when the app is imported.
+    """
+    if _pool is None:
+        _get_pool()
+
+
+def recover_jobs():
+    """
+    Takes over queued or running jobs whose server process has exited.
+    """
+    with _connect() as connection:
+        rows = connection.execute(
+            "SELECT id, kind, owner_pid FROM jobs WHERE status IN (?, ?)", ACTIVE_STATUSES
+        ).fetchall()
+
+    for row in rows:
+        if row["owner_pid"] == os.getpid() or _process_alive(row["owner_pid"]):
+            continue
+        resumable = row["kind"] in RESUMABLE_KINDS
+        with _connect() as connection:
+            claimed = connection.execute(
+                "UPDATE jobs SET owner_pid = ?, status = ?, error = ? WHERE id = ? AND owner_pid = ? AND status IN (?, ?)",
+                (
+                    os.getpid(),
+                    "queued" if resumable else "failed",
+                    None if resumable else "Interrupted by a server restart; upload the file again.",
+                    row["id"], row["owner_pid"], *ACTIVE_STATUSES,
+                ),
+            ).rowcount
+        if claimed and resumable:
+            log_event("job_resumed", job_id=row["id"], kind=row["kind"])
+            _submit(row["id"])
+
+
+def _process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def cancel_job(job_id):
+    """
+    Cancels a queued job right away; a running job stops at its next progress report.
+    """
+    job = get_job(job_id)
+    if not job or job["status"] not in ACTIVE_STATUSES:
+        return job
+    future = _futures.get(job_id)
+    if future is not None and future.cancel():
+        _update(job_id, status="cancelled", finished_at=time.time())
+    else:
+        _update(job_id, cancel_requested=1)
+    return get_job(job_id)
+
+
+def run_job(job_id):
+    """
+    Pool entry point: runs the handler of one job and records its outcome.
+    """
+    with _connect() as connection:
+        row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None or row["status"] not in ACTIVE_STATUSES:
+        return
+    if row["cancel_requested"]:
+        _update(job_id, status="cancelled", finished_at=time.time())
+        return
+
+    _update(job_id, status="running", started_at=time.time())
+    last_report = [0.0]
+
+    def report(done, total):
+        now = time.time()
+        if now - last_report[0] < PROGRESS_INTERVAL and done < total:
+            return
+        last_report[0] = now
+        with _connect() as connection:
+            connection.execute("UPDATE jobs SET done_units = ?, total_units = ? WHERE id = ?", (done, total, job_id))
+            cancel_requested = connection.execute(
+                "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()[0]
+        if cancel_requested:
+            raise JobCancelled()
+
+    try:
+        result = JOB_HANDLERS[row["kind"]](json.loads(row["params"]), report)
+        _update(job_id, status="done", result=json.dumps(result), finished_at=time.time())
+    except JobCancelled:
+        log_event("job_cancelled", job_id=job_id, kind=row["kind"])
+        _update(job_id, status="cancelled", finished_at=time.time())
+    except Exception as e:
+        log_exception("job_failed", job_id=job_id, kind=row["kind"])
+        _update(job_id, status="failed", error=str(e), finished_at=time.time())
+
+
+def _run_tile_slide(params, report):
+    from tile_server import convert_slide
+    convert_slide(params["file_path"], params["dzi_path"], params["tiles_path"], progress=report,
+                  workers=TILE_WORKERS)
+    return {"dzi_path": params["dzi_name"]}
+
+
+def _run_tile_patch(params, report):
+    from PIL import Image
+    from tiler import generate_deepzoom_patch
+    with Image.open(params["file_path"]) as img:
+        generate_deepzoom_patch(img, params["dzi_path"], params["tiles_path"], progress=report,
+                                workers=TILE_WORKERS)
+    return {"dzi_path": params["dzi_name"]}
+
+
+def _run_ingest_annotation(params, report):
+    from geojson_routes import ingest_annotation_file
+    return ingest_annotation_file(progress=report, **params)
+
+
+JOB_HANDLERS = {
+    "tile_slide": _run_tile_slide,
+    "tile_patch": _run_tile_patch,
+    "ingest_annotation": _run_ingest_annotation,
+}
+
+
+@jobs_blueprint.route('/jobs', methods=['GET'])
+def list_jobs():
+    """
+    Lists the most recent jobs, optionally filtered by ?status=.
+    """
+    status = request.args.get('status')
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    query, args = "SELECT * FROM jobs", ()
+    if status:
+        query, args = query + " WHERE status = ?", (status,)
+    with _connect() as connection:
+        rows = connection.execute(query + " ORDER BY created_at DESC LIMIT ?", (*args, limit)).fetchall()
+    return jsonify({"jobs": [_job_dict(row) for row in rows]})
+
+
+@jobs_blueprint.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@jobs_blueprint.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    job = cancel_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+def job_accepted(job_id, **extra):
+    """
+    Standard 202 response for an endpoint that queued a job.
+    """
+    return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}", **extra}), 202
@@ -0,0 +1,159 @@
+"""
+Levels of detail for annotation geometry.
+
+Every bucket document of the spatial index also stores its rings simplified at
+LOD_TOLERANCES (in level-0 image pixels) and one centroid per part. A viewport
+query picks a level from the zoom, so zoomed-out views receive points or a few
+vertices per cell instead of every contour vertex, at no extra cost per request.
+
+Levels are numbered from fine to coarse: 0 is the full geometry, 1..n are the
+simplified rings at LOD_TOLERANCES[level - 1], CENTROID_LOD is one point per part.
+"""
+import numpy as np
+from bson.binary import Binary
+
+LOD_TOLERANCES = (2, 8)  # Image pixels; a simplified vertex is off by at most tolerance * sqrt(2)
+CENTROID_LOD = len(LOD_TOLERANCES) + 1
+SCREEN_TOLERANCE_PX = 2.0  # Largest simplification tolerance allowed on screen
+CENTROID_SIZE_PX = 6.0  # Typical parts smaller than this on screen are drawn as centroids
+DEFAULT_VIEWER_WIDTH = 1280  # Screen pixels, when the viewer does not send its width
+MIN_RING_VERTICES = 4  # A closed triangle
+
+
+def simplify_rings(coords, ring_offsets, tolerance):
+    """
+    Simplifies rings by keeping a vertex only where it leaves the tolerance-sized
+    grid square of the vertex before it; first and last vertices are always kept,
+    and rings keep at least MIN_RING_VERTICES vertices when they had as many.
+    Returns the kept vertex positions and the new ring offsets.
+    """
+    lengths = np.diff(ring_offsets)
+    if len(coords) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(len(ring_offsets), dtype=np.int64)
+    grid = np.floor(coords.astype(np.float64) / tolerance).astype(np.int64)
+    keep = np.ones(len(coords), dtype=bool)
+    keep[1:] = (grid[1:] != grid[:-1]).any(axis=1)
+    nonempty = lengths > 0
+    keep[ring_offsets[:-1][nonempty]] = True
+    keep[ring_offsets[1:][nonempty] - 1] = True
+
+    # Rings simplified below a triangle keep four evenly spaced vertices instead
+    ring_of_vertex = np.repeat(np.arange(len(lengths)), lengths)
+    kept = np.bincount(ring_of_vertex[keep], minlength=len(lengths))
+    short = np.flatnonzero((kept < MIN_RING_VERTICES) & (lengths >= MIN_RING_VERTICES))
+    if len(short):
+        steps = np.arange(MIN_RING_VERTICES) / (MIN_RING_VERTICES - 1)
+        positions = ring_offsets[short][:, None] + np.round((lengths[short] - 1)[:, None] * steps).astype(np.int64)
+        keep[positions.ravel()] = True
+
+    vertices = np.flatnonzero(keep)
+    new_offsets = np.zeros(len(ring_offsets), dtype=np.int64)
+    np.cumsum(np.bincount(ring_of_vertex[vertices], minlength=len(lengths)), out=new_offsets[1:])
+    return vertices, new_offsets
+
+
+def part_centroids(coords, ring_offsets, part_rings):
+    """
+    Mean vertex of each part's outer ring (without the closing vertex), as float64.
+    Parts without vertices get NaN.
+    """
+    part_count = len(part_rings) - 1
+    sums = np.zeros((len(coords) + 1, 2))
+    np.cumsum(coords.astype(np.float64), axis=0, out=sums[1:])
+    has_ring = np.diff(part_rings) > 0
+    outer = np.minimum(part_rings[:-1], len(ring_offsets) - 2)
+    starts = np.where(has_ring, ring_offsets[outer], 0)
+    ends = np.where(has_ring, ring_offsets[outer + 1], 0)
+    counts = ends - starts
+    totals = sums[ends] - sums[starts]
+
+    closed = counts > 1
+    closed[closed] = (coords[starts[closed]] == coords[ends[closed] - 1]).all(axis=1)
+    totals[closed] -= coords[ends[closed] - 1]
+    counts = counts - closed
+
+    centroids = np.full((part_count, 2), np.nan)
+    np.divide(totals, counts[:, None], out=centroids, where=counts[:, None] > 0)
+    return centroids
+
+
+def lod_fields(chunk):
+    """
+    The level-of-detail columns for a decoded chunk (see columnar.decode_chunk).
+    """
+    coords = chunk["coords"]
+    ring_offsets = chunk["ring_offsets"].astype(np.int64)
+    fields = {
+        "centroids": Binary(part_centroids(coords, ring_offsets, chunk["part_rings"].astype(np.int64)).tobytes()),
+    }
+    for level, tolerance in enumerate(LOD_TOLERANCES, start=1):
+        vertices, offsets = simplify_rings(coords, ring_offsets, tolerance)
+        fields[f"lod{level}_ring_offsets"] = Binary(offsets.astype(np.uint32).tobytes())
+        fields[f"lod{level}_coords"] = Binary(np.ascontiguousarray(coords[vertices]).tobytes())
+    return fields
+
+
+def lod_projection(lod):
+    """
+    MongoDB projection that leaves out the geometry columns a level does not use.
+    """
+    projection = {"_id": 0}
+    for level in range(1, len(LOD_TOLERANCES) + 1):
+        if level != lod:
+            projection[f"lod{level}_ring_offsets"] = 0
+            projection[f"lod{level}_coords"] = 0
+    if lod != CENTROID_LOD:
+        projection["centroids"] = 0
+    if lod != 0:
+        projection["ring_offsets"] = 0
+        projection["coords"] = 0
+    return projection
+
+
+def apply_lod(chunk, document, lod):
+    """
+    Replaces the geometry of a decoded chunk with the given level. At CENTROID_LOD
+    every part becomes a single one-vertex ring.
+    """
+    if lod == CENTROID_LOD:
+        part_count = len(chunk["pids"])
+        chunk["coords"] = np.frombuffer(document["centroids"], dtype=np.float64).reshape(-1, 2)
+        chunk["ring_offsets"] = np.arange(part_count + 1, dtype=np.uint32)
+        chunk["part_rings"] = np.arange(part_count + 1, dtype=np.uint32)
+    elif lod:
+        chunk["coords"] = np.frombuffer(document[f"lod{lod}_coords"], dtype=chunk["bboxes"].dtype).reshape(-1, 2)
+        chunk["ring_offsets"] = np.frombuffer(document[f"lod{lod}_ring_offsets"], dtype=np.uint32)
+    return chunk
+
+
+def lod_geometry_type(geometry_type, lod):
+    """
+    Geometry type of a feature served at a level: centroids turn polygons into points.
+    """
+    if lod == CENTROID_LOD:
+        return {"Polygon": "Point", "MultiPolygon": "MultiPoint"}.get(geometry_type, geometry_type)
+    return geometry_type
+
+
+def lod_for_view(zoom, image_width, part_size, viewer_width=None):
+    """
+    Picks the level for a viewer zoom (OpenSeadragon zoom, 1 = image width fills
+    the viewer): centroids when a typical part (part_size image pixels) is under
+    CENTROID_SIZE_PX on screen, otherwise the coarsest simplification whose
+    tolerance stays within SCREEN_TOLERANCE_PX on screen, otherwise the full geometry.
+    """
+    scale = float(zoom) * (viewer_width or DEFAULT_VIEWER_WIDTH) / image_width  # Screen pixels per image pixel
+    return lod_for_scale(scale, part_size)
+
+
+def lod_for_scale(scale, part_size):
+    """
+    Like lod_for_view, for a scale given in screen (or output) pixels per image pixel.
+    """
+    if part_size and part_size * scale < CENTROID_SIZE_PX:
+        return CENTROID_LOD
+    lod = 0
+    for level, tolerance in enumerate(LOD_TOLERANCES, start=1):
+        if tolerance * scale <= SCREEN_TOLERANCE_PX:
+            lod = level
+    return lod
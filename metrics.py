@@ -0,0 +1,344 @@
+"""
+Request metrics, phase timers, structured logging and an opt-in request profiler.
+
+Metrics are kept in memory per process and exposed in the Prometheus text
+format on /metrics:
+
+- http_request_duration_seconds{method, route, status}: latency histogram per
+  route (the URL rule, e.g. /output/<path:filename>, so labels stay bounded).
+- http_response_bytes_total{method, route}: response body bytes, streamed
+  bodies included.
+- request_phase_duration_seconds{route, phase}: time spent in the phases that
+  code marks with `with phase("name"):`; a request's phases are also sent back
+  in its Server-Timing header, so browser dev tools show the breakdown.
+- storage_read_bytes_total{source}: bytes read from GridFS files and from
+  annotation bucket documents.
+- cache_*{cache}: size, hits, misses, evictions and hit ratio of every cache
+  passed to register_cache.
+
+Background jobs run in their own processes, so their counters (e.g. the tiles
+written by generate_deepzoom) are only visible there, and in their logs.
+
+With PROFILE_REQUESTS=1, a request with ?profile=1 is sampled every
+PROFILE_INTERVAL_MS while its view runs; the stacks are written to PROFILE_DIR
+as collapsed stacks (one "frame;frame;frame count" line each, the input of
+flamegraph.pl and speedscope) and the file is named in the X-Profile header.
+
+log_event writes one JSON object per line to the "cell_annotator" logger;
+RateLimitedLog drops events that come faster than its interval and reports
+how many were dropped with the next one it writes.
+"""
+import bisect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, g, has_request_context, request
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+# Seconds; Prometheus' default latency buckets with a 30s bucket for slide conversion
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, 30.0)
+TEXT_FORMAT = "text/plain; version=0.0.4; charset=utf-8"
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+logger = logging.getLogger("cell_annotator")
+if not logger.handlers:
+    # Every process (server, job and precompute workers) logs the same way without further setup
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+_metrics = []
+_caches = {}
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels.get(name, "")) for name in self.labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, tuple(labels), tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_label_text(self.labels + ('le',), key + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {counts[-1]}")
+                lines.append(f"{self.name}_count{_label_text(self.labels, key)} {cumulative}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time from the start of a request to its response.", ("method", "route", "status"),
+)
+RESPONSE_BYTES = Counter("http_response_bytes_total", "Bytes of response bodies.", ("method", "route"))
+PHASE_SECONDS = Histogram(
+    "request_phase_duration_seconds", "Time spent in the marked phases of a request.", ("route", "phase"),
+)
+READ_BYTES = Counter("storage_read_bytes_total", "Bytes read from GridFS files and annotation buckets.", ("source",))
+TILES_WRITTEN = Counter("deepzoom_tiles_written_total", "DeepZoom tiles written by pyramid generation.")
+
+
+def register_cache(name, cache):
+    """
+    Exposes the stats() of a cache.ByteLRUCache under cache=name.
+    """
+    _caches[name] = cache
+
+
+def _cache_lines():
+    gauges = {
+        "cache_hits_total": ("counter", "Cache lookups answered from the cache.", "hits"),
+        "cache_misses_total": ("counter", "Cache lookups not in the cache.", "misses"),
+        "cache_evictions_total": ("counter", "Entries evicted to stay within the budget.", "evictions"),
+        "cache_entries": ("gauge", "Entries in the cache.", "entries"),
+        "cache_bytes": ("gauge", "Bytes held by the cache.", "bytes"),
+        "cache_max_bytes": ("gauge", "Byte budget of the cache.", "max_bytes"),
+    }
+    stats = {name: cache.stats() for name, cache in sorted(_caches.items())}
+    lines = []
+    for metric, (kind, help_text, field) in gauges.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+        lines += [f'{metric}{{cache="{name}"}} {values[field]}' for name, values in stats.items()]
+    lines += ["# HELP cache_hit_ratio Hits over lookups since start.", "# TYPE cache_hit_ratio gauge"]
+    for name, values in stats.items():
+        lookups = values["hits"] + values["misses"]
+        lines.append(f'cache_hit_ratio{{cache="{name}"}} {values["hits"] / lookups if lookups else 0}')
+    return lines
+
+
+def render():
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    lines += _cache_lines()
+    return "\n".join(lines) + "\n"
+
+
+def _route():
+    if has_request_context():
+        return request.url_rule.rule if request.url_rule else "unmatched"
+    return ""
+
+
+@contextmanager
+def phase(name):
+    """
+    Times a phase of the current request (or of background work, with an empty route).
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        PHASE_SECONDS.observe(elapsed, route=_route(), phase=name)
+        if has_request_context():
+            phases = g.setdefault("phases", {})
+            phases[name] = phases.get(name, 0.0) + elapsed
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread from a background thread and counts the collapsed stacks.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]))
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+    if PROFILE_REQUESTS and request.args.get("profile") == "1":
+        g.profiler = SamplingProfiler(threading.get_ident()).start()
+
+
+def _counted_body(body, method, route):
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        RESPONSE_BYTES.inc(size, method=method, route=route)
+
+
+def _after_request(response):
+    route = _route()
+    started = g.pop("request_started", None)
+    if started is not None:
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - started, method=request.method, route=route, status=response.status_code,
+        )
+    if response.content_length is not None or not response.is_streamed:
+        RESPONSE_BYTES.inc(response.content_length or 0, method=request.method, route=route)
+    else:
+        response.response = _counted_body(response.response, request.method, route)
+
+    phases = g.pop("phases", None)
+    if phases:
+        response.headers["Server-Timing"] = ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in phases.items()
+        )
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint}-{os.getpid()}-"
+                                         f"{threading.get_ident()}.txt")
+        with open(path, "w") as f:
+            f.write(profiler.collapsed())
+        response.headers["X-Profile"] = path
+        response.headers["X-Profile-Samples"] = str(profiler.samples)
+    return response
+
+
+def instrument(app):
+    """
+    Times every request of a Flask app and enables ?profile=1 when PROFILE_REQUESTS is set.
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+@metrics_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render(), mimetype=TEXT_FORMAT)
+
+
+def log_event(event, level=logging.INFO, **fields):
+    """
+    Logs one event as a JSON object: {"event": event, **fields}.
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps({"event": event, **fields}, default=str))
+
+
+def log_exception(event, **fields):
+    """
+    log_event at ERROR level with the traceback of the exception being handled.
+    """
+    logger.exception(json.dumps({"event": event, **fields}, default=str))
+
+
+class RateLimitedLog:
+    """
+    log_event for frequent events: at most one event per interval seconds is
+    written (force=True always writes), with the number of events dropped since
+    the last one.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._last = None
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def log(self, event, force=False, level=logging.INFO, **fields):
+        now = time.monotonic()
+        with self._lock:
+            if not force and self._last is not None and now - self._last < self.interval:
+                self._suppressed += 1
+                return
+            self._last = now
+            suppressed, self._suppressed = self._suppressed, 0
+        if suppressed:
+            fields["suppressed"] = suppressed
+        log_event(event, level=level, **fields)
@@ -0,0 +1,143 @@
+"""
+MongoDB access shared by the server, the background jobs and the scripts.
+
+The client is created on first use instead of at import, so importing the app
+does not wait on the network, and every process gets its own: a process
+forked after the client exists (gunicorn --preload workers, fork-started
+pools) opens a new one instead of using the parent's sockets. One client per
+process holds the connection pool, tuned with the environment variables in
+POOL_SETTINGS (pymongo's defaults apply to those not set).
+
+database, grid_fs, hex_bins and roi_grids stand in for the database, the
+GridFS store of annotation files, the geojson_hex_bins collection and the GridFS
+store of count grids (see roi_stats.py); they resolve to the
+current process's client whenever they are used, so modules can hold them at
+import time.
+"""
+import os
+import threading
+
+from dotenv import load_dotenv
+from gridfs import GridFS, GridFSBucket
+from pymongo.mongo_client import MongoClient
+from pymongo.server_api import ServerApi
+
+load_dotenv()
+
+DATABASE_NAME = os.getenv("MONGO_DB_NAME", "annotationsDB")
+
+# Environment variable -> MongoClient option (integers, timeouts in milliseconds)
+POOL_SETTINGS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+}
+
+_client = None
+_client_pid = None
+_handles = {}
+_lock = threading.Lock()
+
+
+def _after_fork():
+    # The parent's client must not be used (or closed) here; the next call opens this process's own
+    global _client, _client_pid, _lock
+    _client, _client_pid = None, None
+    _handles.clear()
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def client_options():
+    """
+    MongoClient pool and timeout options set in the environment.
+    """
+    return {option: int(os.environ[name]) for name, option in POOL_SETTINGS.items() if os.getenv(name)}
+
+
+def get_client():
+    """
+    The MongoClient of the current process, created on first use.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _lock:
+            if _client is None or _client_pid != os.getpid():
+                mongo_uri = os.getenv("MONGO_URI")
+                if not mongo_uri:
+                    raise ValueError("MONGO_URI not found in environment variables.")
+                _handles.clear()
+                _client = MongoClient(mongo_uri, server_api=ServerApi('1'), connect=False, **client_options())
+                _client_pid = os.getpid()
+    return _client
+
+
+def set_client(client):
+    """
+    Makes client the MongoClient of the current process (a stand-in such as mongomock, for the benchmarks).
+    """
+    global _client, _client_pid
+    with _lock:
+        _handles.clear()
+        _client, _client_pid = client, os.getpid()
+
+
+def get_db():
+    return get_client()[DATABASE_NAME]
+
+
+def _handle(name, factory):
+    get_client()
+    handle = _handles.get(name)
+    if handle is None:
+        handle = _handles.setdefault(name, factory(get_db()))
+    return handle
+
+
+def get_grid_fs():
+    """
+    The GridFS store of annotation files, shared by the process.
+    """
+    return _handle("grid_fs", GridFS)
+
+
+def get_bucket():
+    """
+    GridFSBucket over the same files, for streaming uploads and downloads.
+    """
+    return _handle("bucket", GridFSBucket)
+
+
+def get_roi_grids():
+    """
+    The GridFS store of annotation count grids, apart from the annotation files.
+    """
+    return _handle("roi_grids", lambda db: GridFS(db, collection="roi_grids"))
+
+
+class _Lazy:
+    """
+    Forwards attribute and item access to the handle factory() returns at the time of use.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
+
+    def __getitem__(self, name):
+        return self._factory()[name]
+
+
+database = _Lazy(get_db)
+grid_fs = _Lazy(get_grid_fs)
+hex_bins = _Lazy(lambda: get_db().geojson_hex_bins)
+roi_grids = _Lazy(get_roi_grids)
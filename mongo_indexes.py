@@ -0,0 +1,180 @@
+"""
+MongoDB indexes for the query paths of the application.
+
+INDEXES lists the compound indexes each collection needs:
+
+- fs.files: annotation files of a slide (and model), as read by
+  get_normalized_annotations, the annotation tiles and get_hex_bins; the
+  metadata.filename + dzi_file lookup of compute_hexagons_for_specific_file_and_dzi;
+  and filename + uploadDate (the index GridFS itself uses) for the find_one by
+  filename of link_annotation_to_dzi and export, and annotation_model_mapping.
+- geojson_hex_bins: a unique index on HEX_BIN_KEY, which makes storing hex
+  bins an idempotent upsert and also serves the single-hex lookups of
+  /hex_bin_features, and one on the hexagon bbox under {dzi_file, resolution}
+  for the viewport-bounded queries of get_hex_bins.
+- annotation_buckets: the bucket lookups of annotation_index.
+- roi_grids.files: the count grid lookups of roi_stats by annotation file.
+- slides: the content hash of every uploaded slide, unique so one content is
+  stored once, and the filename lookup of slide_uploads.
+
+ensure_indexes runs at app startup and before precompute.py. It creates what
+is missing (create_index is a no-op for an existing index). Hexbin documents
+written before they were keyed by annotation file keep the unique hexbin index
+from being built; migrating them deletes the ones it cannot attribute, so it
+only runs from `python mongo_indexes.py --migrate-hex-bins`, and otherwise the
+index is skipped with a warning. `python mongo_indexes.py --check` only
+reports missing indexes and exits non-zero if there are any.
+"""
+import argparse
+import logging
+import sys
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+from hexbin import HEX_BIN_KEY, hex_bin_bbox
+from metrics import log_event
+from mongo import get_db
+
+# {collection: [(keys, options)]}
+INDEXES = {
+    "fs.files": [
+        ([("metadata.dzi_file", 1), ("metadata.model_name", 1)], {}),
+        ([("metadata.filename", 1), ("metadata.dzi_file", 1)], {}),
+        ([("filename", 1), ("uploadDate", 1)], {}),
+    ],
+    "geojson_hex_bins": [
+        ([(field, 1) for field in HEX_BIN_KEY], {"unique": True}),
+        ([("dzi_file", 1), ("resolution", 1), ("bbox.x_min", 1), ("bbox.y_min", 1)], {}),
+    ],
+    "annotation_buckets": [
+        ([("file_id", 1), ("bx", 1), ("by", 1)], {}),
+    ],
+    "roi_grids.files": [
+        ([("metadata.file_id", 1)], {}),
+    ],
+    "slides": [
+        ([("sha256", 1)], {"unique": True}),
+        ([("filename", 1)], {}),
+    ],
+}
+
+
+def _has_index(collection, keys, options):
+    for index in collection.index_information().values():
+        if [tuple(key) for key in index["key"]] == keys and all(index.get(k) == v for k, v in options.items()):
+            return True
+    return False
+
+
+def missing_indexes(db):
+    """
+    [(collection name, keys, options)] of the INDEXES the database lacks.
+    """
+    return [
+        (name, keys, options)
+        for name, indexes in INDEXES.items()
+        for keys, options in indexes
+        if not _has_index(db[name], keys, options)
+    ]
+
+
+def migrate_hex_bins(db):
+    """
+    Brings hexbin documents written before they were keyed by annotation file
+    to the current layout: attributes them to the slide's annotation file
+    (removing them when the slide has several, as they cannot be told apart),
+    adds the bbox, and removes the duplicates repeated precompute runs inserted.
+    """
+    hex_bins = db.geojson_hex_bins
+    legacy = {"filename": {"$exists": False}}
+    for dzi_file in hex_bins.distinct("dzi_file", legacy):
+        file_docs = list(db.fs.files.find({"metadata.dzi_file": dzi_file}, {"metadata": 1}))
+        query = {"dzi_file": dzi_file, **legacy}
+        if len(file_docs) == 1:
+            metadata = file_docs[0].get("metadata", {})
+            hex_bins.update_many(query, {"$set": {
+                "filename": metadata.get("filename"), "model_name": metadata.get("model_name"),
+            }})
+        else:
+            removed = hex_bins.delete_many(query).deleted_count
+            log_event("legacy_hex_bins_removed", level=logging.WARNING, dzi=dzi_file, removed=removed,
+                      hint="not attributable to one annotation file; run precompute.py for the slide")
+
+    updates = [
+        pymongo.UpdateOne({"_id": document["_id"]}, {"$set": {"bbox": hex_bin_bbox(document["image_coordinates"])}})
+        for document in hex_bins.find({"bbox": {"$exists": False}}, {"image_coordinates": 1})
+        if document.get("image_coordinates")
+    ]
+    if updates:
+        hex_bins.bulk_write(updates, ordered=False)
+
+    duplicates = hex_bins.aggregate([
+        {"$group": {"_id": {field: f"${field}" for field in HEX_BIN_KEY}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ], allowDiskUse=True)
+    removed = sum(hex_bins.delete_many({"_id": {"$in": group["ids"][1:]}}).deleted_count for group in duplicates)
+    if removed:
+        log_event("duplicate_hex_bins_removed", removed=removed)
+
+
+def hex_bins_need_migration(db):
+    """
+    Whether hexbin documents from before they were keyed by annotation file (or without a bbox) remain.
+    """
+    legacy = {"$or": [{"filename": {"$exists": False}}, {"bbox": {"$exists": False}}]}
+    return db.geojson_hex_bins.find_one(legacy, {"_id": 1}) is not None
+
+
+def ensure_indexes(db, migrate=False):
+    """
+    Creates the missing INDEXES. When the unique hexbin index does not exist
+    yet, legacy hexbin documents are migrated first with migrate, and without
+    it the index is left out with a warning. Returns the indexes created.
+    """
+    missing = missing_indexes(db)
+    if any(name == "geojson_hex_bins" and options.get("unique") for name, _, options in missing):
+        if migrate:
+            migrate_hex_bins(db)
+        elif hex_bins_need_migration(db):
+            log_event("hex_bin_migration_needed", level=logging.WARNING,
+                      hint="hex bins from before they were stored per annotation file remain, so their unique "
+                           "index is not created; run `python mongo_indexes.py --migrate-hex-bins` (it deletes "
+                           "the hex bins it cannot attribute to one annotation file, and duplicates)")
+            missing = [
+                (name, keys, options) for name, keys, options in missing
+                if not (name == "geojson_hex_bins" and options.get("unique"))
+            ]
+    for name, keys, options in missing:
+        db[name].create_index(keys, **options)
+        log_event("index_created", collection=name, keys=keys)
+    return missing
+
+
+def ensure_indexes_or_warn(db):
+    """
+    ensure_indexes for server startup: a database that cannot be reached, or
+    is not configured (no MONGO_URI), is reported, not raised.
+    """
+    try:
+        ensure_indexes(db)
+    except (PyMongoError, ValueError) as e:
+        log_event("indexes_not_created", level=logging.WARNING, error=str(e))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or check the MongoDB indexes of the application.")
+    parser.add_argument("--check", action="store_true", help="only report missing indexes")
+    parser.add_argument("--migrate-hex-bins", action="store_true",
+                        help="migrate legacy hex bins so their unique index can be built; deletes the hex bins "
+                             "that cannot be attributed to one annotation file, and duplicates")
+    args = parser.parse_args()
+
+    database = get_db()
+
+    if args.check:
+        missing = missing_indexes(database)
+        for name, keys, options in missing:
+            print(f"Missing index {keys} {options or ''} on {name}")
+        sys.exit(1 if missing else 0)
+    ensure_indexes(database, migrate=args.migrate_hex_bins)
@@ -0,0 +1,199 @@
+"""
+Raster annotation overlay tiles.
+
+The annotations of a slide and model are also served as transparent images on
+the slide's DeepZoom grid (its size, tile size and overlap), so the viewer can
+show every cell at any zoom as an ordinary OpenSeadragon tiled layer instead of
+drawing vector annotations. A tile is rasterized the first time it is requested
+from the parts that overlap it, at the level of detail its scale calls for
+(lod.lod_for_scale): contours filled in their classification color where cells
+are large enough to see, and one dot per cell further out.
+
+Like annotation tiles, overlay tile URLs carry the version of the annotation
+set (annotation_tiles.tile_version), and the classes a tile shows are part of
+its key. The content under a URL never changes, so tiles are sent as immutable
+with a strong ETag and kept in a bounded in-memory cache.
+"""
+import hashlib
+import io
+import json
+import math
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from cache import ByteLRUCache
+from columnar import GEOMETRY_TYPES
+from metrics import register_cache
+
+OVERLAY_CACHE_BYTES = int(os.getenv("OVERLAY_TILE_CACHE_MB", "128")) * 1024 * 1024
+OVERLAY_FORMATS = {"png": "image/png", "webp": "image/webp"}
+OVERLAY_FORMAT = os.getenv("OVERLAY_TILE_FORMAT", "png")
+OVERLAY_QUALITY = int(os.getenv("OVERLAY_TILE_QUALITY", "80"))  # WebP only; its alpha channel stays lossless
+OVERLAY_STYLE = 1  # Part of the overlay version; bump when the drawing changes
+FILL_ALPHA = 153  # The 0.6 fill opacity of the vector overlay
+POINT_RADIUS_PX = 2  # Dots for points and centroids, in tile pixels
+POLYGON_TYPES = {GEOMETRY_TYPES.index("Polygon"), GEOMETRY_TYPES.index("MultiPolygon")}
+
+if OVERLAY_FORMAT not in OVERLAY_FORMATS:
+    raise ValueError(f"OVERLAY_TILE_FORMAT must be one of {sorted(OVERLAY_FORMATS)}, not {OVERLAY_FORMAT!r}")
+
+overlay_cache = ByteLRUCache(OVERLAY_CACHE_BYTES)
+register_cache("overlay_tiles", overlay_cache)
+
+
+def max_level(width, height):
+    """
+    Index of the full-resolution level of a DeepZoom pyramid of this size.
+    """
+    return max(int(math.ceil(math.log2(max(width, height, 1)))), 0)
+
+
+def overlay_tile_box(width, height, tile_size, overlap, level, col, row):
+    """
+    Scale (tile pixels per image pixel) and pixel box (x0, y0, x1, y1) within
+    its level of a DeepZoom tile, overlap included; None outside the pyramid.
+    """
+    top = max_level(width, height)
+    if level > top:
+        return None
+    scale = 0.5 ** (top - level)
+    level_width = max(int(math.ceil(width * scale)), 1)
+    level_height = max(int(math.ceil(height * scale)), 1)
+    if col * tile_size >= level_width or row * tile_size >= level_height:
+        return None
+    x0 = col * tile_size - (overlap if col else 0)
+    y0 = row * tile_size - (overlap if row else 0)
+    x1 = min((col + 1) * tile_size + overlap, level_width)
+    y1 = min((row + 1) * tile_size + overlap, level_height)
+    return scale, (x0, y0, x1, y1)
+
+
+def overlay_query_bounds(scale, box):
+    """
+    Level-0 image bounds of the parts that can show on a tile, with room for dots drawn over its edge.
+    """
+    margin = POINT_RADIUS_PX + 1
+    x0, y0, x1, y1 = box
+    return (x0 - margin) / scale, (y0 - margin) / scale, (x1 + margin) / scale, (y1 + margin) / scale
+
+
+def overlay_classes(names):
+    """
+    Canonical class filter: the sorted class names shown, or None for every class.
+    """
+    names = sorted({name for name in names if name})
+    return names or None
+
+
+def overlay_version(annotation_version, tile_size, overlap):
+    """
+    Version of a slide's overlay tiles: that of its annotations
+    (annotation_tiles.tile_version) with the grid and the drawing style.
+    """
+    key = json.dumps([annotation_version, tile_size, overlap, OVERLAY_STYLE])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def overlay_etag(dzi_file, model_name, version, level, col, row, tile_format, classes):
+    """
+    Strong ETag (unquoted) of an overlay tile; also its key in overlay_cache.
+    """
+    key = json.dumps([dzi_file, model_name, version, level, col, row, tile_format, classes])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def class_colors(table, classes=None):
+    """
+    RGB color of each class of a query table, or None for classes that are not
+    shown: filtered out, or without a classification color (the viewer skips those too).
+    """
+    colors = []
+    for properties in table["classes"]:
+        classification = (properties or {}).get("classification") or {}
+        color = classification.get("color")
+        if not color or (classes is not None and classification.get("name") not in classes):
+            colors.append(None)
+        else:
+            colors.append(tuple(int(channel) for channel in color[:3]))
+    return colors
+
+
+def render_overlay_tile(tables, scale, box, classes=None):
+    """
+    Draws the parts of query tables (annotation_index.query_spatial_table) onto
+    a transparent RGBA tile covering box at scale: polygons filled with their
+    class color and outlined, points and centroids as dots on top.
+    """
+    x0, y0, x1, y1 = box
+    image = Image.new("RGBA", (x1 - x0, y1 - y0), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    dots = []  # (pixels, colors) per table
+
+    for table in tables:
+        colors = class_colors(table, classes)
+        if not any(colors):
+            continue
+        feature_parts = table["feature_parts"]
+        part_features = np.repeat(np.arange(len(feature_parts) - 1), np.diff(feature_parts))
+        if len(part_features) == 0:
+            continue
+        part_rings, ring_offsets = table["part_rings"], table["ring_offsets"]
+        pixels = table["coords"].astype(np.float64) * scale - (x0, y0)
+
+        polygon = np.isin(table["feature_types"][part_features], list(POLYGON_TYPES))
+        polygons = np.flatnonzero(polygon)
+        for part, class_id in zip(polygons.tolist(), table["feature_classes"][part_features[polygons]].tolist()):
+            color = colors[class_id]
+            if color is None:
+                continue
+            for ring in range(part_rings[part], part_rings[part + 1]):
+                ring_pixels = pixels[ring_offsets[ring]:ring_offsets[ring + 1]]
+                if len(ring_pixels) >= 2:
+                    draw.polygon(ring_pixels.ravel().tolist(), fill=color + (FILL_ALPHA,), outline=color + (255,))
+
+        # A point part is the first vertex of its only ring
+        points = np.flatnonzero(~polygon)
+        rings = part_rings[points]
+        has_ring = part_rings[points + 1] > rings
+        points, rings = points[has_ring], rings[has_ring]
+        first = ring_offsets[rings]
+        has_vertex = ring_offsets[rings + 1] > first
+        points, first = points[has_vertex], first[has_vertex]
+        palette = np.array([color + (255,) if color else (0, 0, 0, 0) for color in colors], dtype=np.uint8)
+        point_classes = table["feature_classes"][part_features[points]]
+        shown = (palette[point_classes, 3] > 0) & np.isfinite(pixels[first]).all(axis=1)
+        if shown.any():
+            dots.append((pixels[first[shown]], palette[point_classes[shown]]))
+
+    if dots:
+        image = _draw_dots(image, dots)
+    return image
+
+
+def _draw_dots(image, dots):
+    """
+    Stamps a disc of POINT_RADIUS_PX per point into the tile, all points at once.
+    """
+    pixels = np.array(image)
+    height, width = pixels.shape[:2]
+    radius = POINT_RADIUS_PX
+    offsets = [(dx, dy) for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1)
+               if dx * dx + dy * dy <= radius * radius + radius]
+    for points, colors in dots:
+        centers = np.floor(points).astype(np.int64)
+        for dx, dy in offsets:
+            x, y = centers[:, 0] + dx, centers[:, 1] + dy
+            inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            pixels[y[inside], x[inside]] = colors[inside]
+    return Image.fromarray(pixels, "RGBA")
+
+
+def encode_overlay(image, tile_format):
+    buffer = io.BytesIO()
+    if tile_format == "webp":
+        image.save(buffer, "WEBP", quality=OVERLAY_QUALITY)
+    else:
+        image.save(buffer, "PNG")
+    return buffer.getvalue()
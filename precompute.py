@@ -1,123 +1,62 @@
-import h3
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
-from pymongo.errors import PyMongoError
-import pymongo
-from gridfs import GridFS
+"""
+Batch hexbin precomputation for the annotation files stored in GridFS.
+
+    python precompute.py [--dzi DZI_FILE] [--model NAME] [--manifest FILE] [--resolutions 2,3,4]
+                         [--workers N] [--force] [--failures FILE]
+
+Finds every annotation file in GridFS (or those a manifest lists, one
+annotation filename per line), skips the files whose hex bins are already
+current (their metadata carries the hex_bin_stamp of the resolutions) and
+computes the others in a process pool, each worker with its own MongoDB
+client. Progress and throughput (features/sec, slides/min) are printed as
+files complete; failures are listed at the end and written to a JSON file.
+"""
 from dotenv import load_dotenv
+import argparse
+import multiprocessing
 import os
 import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from annotation_index import is_indexed
+from annotation_ingest import index_hex_pyramid, ingest_geojson_stream
+from geojson_stream import GeoJSONStreamError
+from hexbin import HEX_RESOLUTIONS
+from hexbin_updates import hex_bin_stamp, store_hex_pyramid
+from metrics import READ_BYTES, log_event
+from mongo import database as db, grid_fs, hex_bins as hexbin_collection
+from mongo_indexes import ensure_indexes
 
 # Load environment variables
 load_dotenv()
 
-# MongoDB setup
-mongo_uri = os.getenv("MONGO_URI")
-if not mongo_uri:
-    raise ValueError("MONGO_URI not found in environment variables.")
+DEFAULT_WORKERS = max(os.cpu_count() or 1, 1)
+FAILURES_PATH = "precompute_failures.json"
 
-client = MongoClient(mongo_uri, server_api=ServerApi('1'))
-db = client.annotationsDB
-hexbin_collection = db.geojson_hex_bins
-grid_fs = GridFS(db)
 
-def process_geojson(dzi_file, geojson_data, image_width, image_height, resolutions):
-    """
-    Process GeoJSON data to compute hexagons and store them in the hexbin collection.
-    """
-    for resolution in resolutions:
-        hex_bins = {}
-
-        for feature in geojson_data:
-            geometry = feature.get("geometry")
-            if not geometry:
-                continue
-
-            feature_id = feature.get("id")
-            if not feature_id:
-                print("Skipping feature without an ID.")
-                continue
-
-            # Extract classification and color
-            properties = feature.get("properties", {})
-            classification = properties.get("classification", {}).get("name", "Unknown")
-            color = properties.get("classification", {}).get("color", [255, 255, 255])  # Default to white
-
-            if geometry["type"] == "Point" or geometry["type"] == "MultiPoint":
-                coordinates = geometry["coordinates"]
-                if geometry["type"] == "Point":
-                    coordinates = [coordinates]
-
-                for x, y in coordinates:
-                    lat, lon = normalize_to_lat_lon(x, y, image_width, image_height)
-                    hex_id = h3.latlng_to_cell(lat, lon, resolution)
-                    add_to_hex_bins(hex_bins, hex_id, feature_id, classification, color)
-
-            elif geometry["type"] in ["Polygon", "MultiPolygon"]:
-                polygons = geometry["coordinates"]
-                if geometry["type"] == "Polygon":
-                    polygons = [polygons]
-
-                for polygon in polygons:
-                    for ring in polygon:
-                        for x, y in ring:
-                            lat, lon = normalize_to_lat_lon(x, y, image_width, image_height)
-                            hex_id = h3.latlng_to_cell(lat, lon, resolution)
-                            add_to_hex_bins(hex_bins, hex_id, feature_id, classification, color)
-
-        print(f"Resolution {resolution}: Generated {len(hex_bins)} hex bins for {dzi_file}.")
-
-        # Batch insert hex bins into MongoDB
-        bulk_operations = []
-        for hex_id, hex_data in hex_bins.items():
-            hex_boundary = h3.cell_to_boundary(hex_id)
-            image_coordinates = [
-                lat_lon_to_image_coordinates(lat, lon, image_width, image_height)
-                for lat, lon in hex_boundary
-            ]
-
-            bulk_operations.append(
-                pymongo.InsertOne({
-                    "dzi_file": dzi_file,
-                    "hex_id": hex_id,
-                    "feature_ids": list(set(hex_data["feature_ids"])),
-                    "annotation_count": hex_data["annotation_count"],
-                    "resolution": resolution,
-                    "image_coordinates": image_coordinates,
-                    "classifications": hex_data["classifications"],
-                })
-            )
-
-        if bulk_operations:
-            try:
-                hexbin_collection.bulk_write(bulk_operations)
-            except Exception as e:
-                print(f"Error during bulk write: {e}")
-
-def compute_hexagons_for_specific_file_and_dzi(resolutions, filename, dzi_file):
+class PrecomputeError(Exception):
+    pass
+
+
+def compute_hexagons_for_specific_file_and_dzi(resolutions, filename, dzi_file, progress=None):
     """
     Compute hexagons for a specific document in GridFS identified by metadata.filename and metadata.dzi_file.
+    progress(done_bytes, total_bytes) reports how far a first ingest has read the file.
+    Raises PrecomputeError when the file cannot be processed.
     """
     # Find the specific file document in GridFS
     file_doc = db.fs.files.find_one({"metadata.filename": filename, "metadata.dzi_file": dzi_file})
 
     if not file_doc:
-        print(f"File with metadata.filename '{filename}' and metadata.dzi_file '{dzi_file}' not found in GridFS.")
-        return
+        raise PrecomputeError(
+            f"File with metadata.filename '{filename}' and metadata.dzi_file '{dzi_file}' not found in GridFS."
+        )
 
     file_id = file_doc.get("_id")
 
     if not file_id:
-        print("Skipping incomplete file document in GridFS.")
-        return
-
-    # Retrieve the file content from GridFS
-    try:
-        file_data = grid_fs.get(file_id).read()
-        geojson_data = json.loads(file_data)
-    except Exception as e:
-        print(f"Error reading file from GridFS: {e}")
-        return
+        raise PrecomputeError("Incomplete file document in GridFS.")
 
     # Extract image dimensions from metadata
     metadata = file_doc.get("metadata", {})
@@ -125,45 +64,130 @@ def compute_hexagons_for_specific_file_and_dzi(resolutions, filename, dzi_file):
     image_height = metadata.get("image_height")
 
     if not (image_width and image_height):
-        print(f"Skipping file {filename} due to missing image dimensions.")
-        return
-
-    # Process GeoJSON data
-    process_geojson(dzi_file, geojson_data, image_width, image_height, resolutions)
-
-    print(f"Hexagon computation complete for file '{filename}' with DZI file '{dzi_file}'.")
-
-def add_to_hex_bins(hex_bins, hex_id, feature_id, classification, color):
-    if hex_id not in hex_bins:
-        hex_bins[hex_id] = {
-            "feature_ids": [],
-            "annotation_count": 0,
-            "classifications": {},
-        }
-    hex_bins[hex_id]["feature_ids"].append(feature_id)
-    hex_bins[hex_id]["annotation_count"] += 1
-    if classification not in hex_bins[hex_id]["classifications"]:
-        hex_bins[hex_id]["classifications"][classification] = {"count": 0, "color": color}
-    hex_bins[hex_id]["classifications"][classification]["count"] += 1
-
-def normalize_to_lat_lon(x, y, image_width, image_height):
-    normalized_x = x / image_width
-    normalized_y = y / image_height
-    latitude = normalized_y * 180 - 90
-    longitude = normalized_x * 360 - 180
-    return latitude, longitude
-
-def lat_lon_to_image_coordinates(lat, lon, image_width, image_height):
-    x = ((lon + 180) / 360) * image_width
-    y = ((lat + 90) / 180) * image_height
-    return x, y
+        raise PrecomputeError(f"File {filename} has no image dimensions.")
+
+    if is_indexed(metadata):
+        # Indexed files are read back one columnar bucket document at a time
+        pyramid = index_hex_pyramid(db, file_doc, resolutions)
+    else:
+        # Stream the file from GridFS in batches; the bucket documents store it from then on
+        try:
+            pyramid = ingest_geojson_stream(db, file_doc, grid_fs.get(file_id), resolutions, progress)
+        except GeoJSONStreamError as e:
+            raise PrecomputeError(f"Invalid GeoJSON in '{filename}': {e}")
+        READ_BYTES.inc(file_doc.get("length", 0), source="gridfs")
+
+    store_hex_pyramid(
+        hexbin_collection, dzi_file, filename, metadata.get("model_name"), pyramid, image_width, image_height,
+        resolutions,
+    )
+    db.fs.files.update_one({"_id": file_id}, {"$set": {"metadata.hex_bins": hex_bin_stamp(resolutions)}})
+
+    log_event("hexagons_computed", filename=filename, dzi=dzi_file, resolutions=list(resolutions))
+
+
+def find_annotation_files(dzi_file=None, model_name=None, filenames=None):
+    """
+    GridFS documents of the annotation files to precompute, optionally of one
+    slide, one model or a list of annotation filenames. Files still being
+    ingested are left out.
+    """
+    query = {"metadata.dzi_file": {"$exists": True}, "metadata.ingest_pending": {"$exists": False}}
+    if dzi_file:
+        query["metadata.dzi_file"] = dzi_file
+    if model_name:
+        query["metadata.model_name"] = model_name
+    if filenames is not None:
+        query["metadata.filename"] = {"$in": list(filenames)}
+    return list(db.fs.files.find(query, {"metadata": 1}))
 
-if __name__ == "__main__":
-    resolutions = [2]
-    filename = "Cell Contours.geojson"  # Replace with the specific filename
-    dzi_file = "TCGA-V5-A7RE-11A-01-TS1.57401526-EF9E-49AC-8FF6-B4F9652311CE.svs"  # Replace with the specific DZI file
 
+def read_manifest(path):
+    """
+    Annotation filenames listed in a manifest, one per line; blank lines and lines starting with # are skipped.
+    """
+    with open(path) as manifest:
+        return [line.strip() for line in manifest if line.strip() and not line.startswith("#")]
+
+
+def precompute_file(filename, dzi_file, resolutions):
+    """
+    Pool task: computes and stores the hex bins of one annotation file and
+    returns a result record (status "done" or "failed", features, seconds).
+    """
+    result = {"filename": filename, "dzi_file": dzi_file, "status": "done", "features": 0}
+    started = time.time()
     try:
         compute_hexagons_for_specific_file_and_dzi(resolutions, filename, dzi_file)
-    except Exception as e:
-        print(f"Error: {e}")
+        file_doc = db.fs.files.find_one({"metadata.filename": filename, "metadata.dzi_file": dzi_file}, {"metadata": 1})
+        result["features"] = (file_doc["metadata"].get("spatial_index") or {}).get("feature_count", 0)
+    except Exception as e:  # One bad file is reported, not allowed to stop the batch
+        result.update(status="failed", error=str(e))
+    result["seconds"] = round(time.time() - started, 3)
+    return result
+
+
+def report_throughput(results, elapsed):
+    """
+    Prints files, features and slides done with features/sec and slides/min.
+    """
+    done = [result for result in results if result["status"] == "done"]
+    features = sum(result["features"] for result in done)
+    slides = len({result["dzi_file"] for result in done})
+    print(f"Processed {len(done)} files ({features} features, {slides} slides) in {elapsed:.1f}s: "
+          f"{features / max(elapsed, 1e-9):.0f} features/sec, {60 * slides / max(elapsed, 1e-9):.1f} slides/min.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the hex bins of the annotation files in GridFS.")
+    parser.add_argument("--dzi", help="only the annotation files of this slide")
+    parser.add_argument("--model", help="only the annotation files of this model")
+    parser.add_argument("--manifest", help="file listing the annotation filenames to process, one per line")
+    parser.add_argument("--resolutions", default=",".join(map(str, HEX_RESOLUTIONS)),
+                        help="comma-separated H3 resolutions (default: HEX_RESOLUTIONS)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="worker processes")
+    parser.add_argument("--force", action="store_true", help="recompute files whose hex bins are current")
+    parser.add_argument("--failures", default=FAILURES_PATH, help="where to write the failure summary")
+    args = parser.parse_args()
+
+    resolutions = sorted({int(resolution) for resolution in args.resolutions.split(",")})
+    filenames = read_manifest(args.manifest) if args.manifest else None
+    ensure_indexes(db)
+
+    file_docs = find_annotation_files(args.dzi, args.model, filenames)
+    stamp = hex_bin_stamp(resolutions)
+    pending = [file_doc["metadata"] for file_doc in file_docs
+               if args.force or file_doc["metadata"].get("hex_bins") != stamp]
+    results = [
+        {"filename": filename, "dzi_file": None, "status": "failed", "error": "Not found in GridFS"}
+        for filename in sorted(set(filenames or []) - {file_doc["metadata"].get("filename") for file_doc in file_docs})
+    ]
+    print(f"{len(file_docs)} annotation files found, {len(file_docs) - len(pending)} already current, "
+          f"{len(pending)} to compute with {args.workers} workers.")
+
+    started = time.time()
+    # Spawned workers open their own MongoDB client instead of inheriting this one
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [
+            pool.submit(precompute_file, metadata["filename"], metadata["dzi_file"], resolutions)
+            for metadata in pending
+        ]
+        for count, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            results.append(result)
+            print(f"[{count}/{len(futures)}] {result['filename']}: {result['status']}, "
+                  f"{result['features']} features in {result['seconds']}s")
+    report_throughput(results, time.time() - started)
+
+    failures = [result for result in results if result["status"] == "failed"]
+    if failures:
+        with open(args.failures, "w") as f:
+            json.dump(failures, f, indent=2)
+        print(f"{len(failures)} files failed (written to {args.failures}):")
+        for failure in failures:
+            print(f"  {failure['filename']}: {failure['error']}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Region-of-interest statistics from per-class count grids.
+
+At ingest every annotation file gets a count grid: the number of cells (parts,
+placed at their centroid) of each class in every ROI_GRID_CELL square of the
+slide, with classes merged by classification name as hex bins merge them
+(hexbin.class_dictionary). Grids are stored compressed in the roi_grids GridFS
+store, apart from the annotation files. For queries a grid is turned into a
+summed-area table, kept in a bounded cache, so the counts inside a rectangle
+take four lookups per class, and those inside a polygon two lookups per grid
+column that each of its edges crosses.
+
+Regions are resolved to whole grid cells: a cell is counted when its center
+lies inside the region, and areas are those of the counted cells. Region
+coordinates at or past the image edge count the partial cells along it.
+"""
+import io
+import math
+import os
+
+import numpy as np
+
+from annotation_index import index_metadata, iter_part_centroids
+from cache import ByteLRUCache
+from hexbin import class_dictionary
+from metrics import log_event, register_cache
+
+ROI_GRID_CELL = int(os.getenv("ROI_GRID_CELL", "64"))  # Grid cell edge in level-0 image pixels
+ROI_CACHE_BYTES = int(os.getenv("ROI_GRID_CACHE_MB", "256")) * 1024 * 1024
+ROI_GRID_VERSION = 1
+
+table_cache = ByteLRUCache(ROI_CACHE_BYTES)
+register_cache("roi_grids", table_cache)
+
+
+class RegionError(ValueError):
+    """
+    A region that is not a bounds rectangle, Polygon or MultiPolygon of finite coordinates.
+    """
+
+
+def build_count_grid(db, file_doc, cell=ROI_GRID_CELL):
+    """
+    Counts the parts of an indexed annotation file per class and grid cell.
+    Returns the counts (classes x rows x cols), the class names and their colors.
+    """
+    metadata = file_doc["metadata"]
+    cols = max(int(math.ceil(metadata["image_width"] / cell)), 1)
+    rows = max(int(math.ceil(metadata["image_height"] / cell)), 1)
+    spatial_index = metadata.get("spatial_index") or index_metadata(db, file_doc["_id"])
+    dictionary_class, class_names, dictionary_color = class_dictionary(spatial_index.get("classes", []))
+    counts = np.zeros((max(len(class_names), 1), rows, cols), dtype=np.uint32)
+    merged = np.asarray(dictionary_class, dtype=np.int64)
+
+    for centroids, classes in iter_part_centroids(db, file_doc["_id"]):
+        col = np.clip(np.floor(centroids[:, 0] / cell).astype(np.int64), 0, cols - 1)
+        row = np.clip(np.floor(centroids[:, 1] / cell).astype(np.int64), 0, rows - 1)
+        np.add.at(counts, (merged[classes], row, col), 1)
+
+    # A class takes the color of its first dictionary entry
+    colors = [None] * len(class_names)
+    for class_id, color in zip(dictionary_class, dictionary_color):
+        if colors[class_id] is None:
+            colors[class_id] = color
+    return counts[:len(class_names)], class_names, colors
+
+
+def store_count_grid(db, roi_grids, file_doc):
+    """
+    Builds the count grid of an annotation file and stores it in roi_grids,
+    replacing any earlier grid of the file. Returns the id of the stored grid.
+    """
+    counts, class_names, colors = build_count_grid(db, file_doc)
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, counts=counts)
+    delete_count_grid(roi_grids, file_doc["_id"])
+    grid_id = roi_grids.put(buffer.getvalue(), filename=str(file_doc["_id"]), metadata={
+        "file_id": file_doc["_id"],
+        "version": ROI_GRID_VERSION,
+        "cell": ROI_GRID_CELL,
+        "image_width": file_doc["metadata"]["image_width"],
+        "image_height": file_doc["metadata"]["image_height"],
+        "class_names": class_names,
+        "class_colors": colors,
+    })
+    log_event("roi_grid_stored", filename=file_doc["metadata"].get("filename"), cols=counts.shape[2],
+              rows=counts.shape[1], cell=ROI_GRID_CELL, classes=len(class_names))
+    return grid_id
+
+
+def delete_count_grid(roi_grids, file_id):
+    """
+    Removes the count grids of an annotation file and their cached tables.
+    """
+    for grid in list(roi_grids.find({"metadata.file_id": file_id})):
+        roi_grids.delete(grid._id)
+    table_cache.discard_where(lambda key: key[0] == file_id)
+
+
+def summed_area_table(db, roi_grids, file_doc):
+    """
+    The count grid of an annotation file as a summed-area table, with its cell
+    size and classes. The grid is built first when the file has none yet (files
+    ingested before grids existed) or it was made with other settings.
+    """
+    key = (file_doc["_id"], ROI_GRID_VERSION, ROI_GRID_CELL)
+    table = table_cache.get(key)
+    if table is not None:
+        return table
+
+    grid = roi_grids.find_one({
+        "metadata.file_id": file_doc["_id"],
+        "metadata.version": ROI_GRID_VERSION,
+        "metadata.cell": ROI_GRID_CELL,
+    })
+    if grid is None:
+        grid = roi_grids.get(store_count_grid(db, roi_grids, file_doc))
+    counts = np.load(io.BytesIO(grid.read()))["counts"]
+
+    # sums[k, r, c] is the count of class k in the rows above r and the columns left of c
+    dtype = np.int32 if counts.sum(dtype=np.int64) < 2 ** 31 else np.int64
+    sums = np.zeros((counts.shape[0], counts.shape[1] + 1, counts.shape[2] + 1), dtype=dtype)
+    np.cumsum(np.cumsum(counts, axis=1, dtype=dtype), axis=2, out=sums[:, 1:, 1:])
+    table = {
+        "sums": sums,
+        "cell": grid.metadata["cell"],
+        "class_names": grid.metadata["class_names"],
+        "class_colors": grid.metadata["class_colors"],
+        "image_width": grid.metadata["image_width"],
+        "image_height": grid.metadata["image_height"],
+    }
+    table_cache.put(key, table, sums.nbytes + 1024)
+    return table
+
+
+def _to_grid(values, cell, extent, cells):
+    """
+    Image coordinates in grid cells; those at or past the image extent are
+    moved past the last cell, whose center may lie outside the image.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(values >= extent, np.maximum(values / cell, cells), values / cell)
+
+
+def _grid_lines(values, last):
+    """
+    Index of the first grid cell whose center is at or after each value (in grid cells), within 0..last.
+    """
+    return np.clip(np.ceil(values - 0.5), 0, last).astype(np.int64)
+
+
+def rectangle_counts(table, x_min, y_min, x_max, y_max):
+    """
+    Per class counts of the grid cells whose center lies in the rectangle, and how many cells that is.
+    """
+    sums, cell = table["sums"], table["cell"]
+    rows, cols = sums.shape[1] - 1, sums.shape[2] - 1
+    c0, c1 = _grid_lines(_to_grid([x_min, x_max], cell, table["image_width"], cols), cols)
+    r0, r1 = _grid_lines(_to_grid([y_min, y_max], cell, table["image_height"], rows), rows)
+    if c1 <= c0 or r1 <= r0:
+        return np.zeros(sums.shape[0], dtype=np.int64), 0
+    counts = sums[:, r1, c1] - sums[:, r0, c1] - sums[:, r1, c0] + sums[:, r0, c0]
+    return counts, int((r1 - r0) * (c1 - c0))
+
+
+def ring_counts(table, ring):
+    """
+    Per class counts of the grid cells whose center lies in a closed ring of
+    (x, y) image coordinates, and how many cells that is. Every edge adds, for
+    each grid column whose center it crosses, the count of the column above the
+    crossing, with the sign of its direction; the columns of a ring's interior
+    are left with the cells between its edges.
+    """
+    sums, cell = table["sums"], table["cell"]
+    rows, cols = sums.shape[1] - 1, sums.shape[2] - 1
+    points = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+    if len(points) < 3:
+        return np.zeros(sums.shape[0], dtype=np.int64), 0
+    x0 = _to_grid(points[:, 0], cell, table["image_width"], cols)
+    y0 = _to_grid(points[:, 1], cell, table["image_height"], rows)
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+
+    # Columns c with center c + 0.5 in [min(x0, x1), max(x0, x1)), clipped to the grid
+    first = _grid_lines(np.minimum(x0, x1), cols)
+    stop = _grid_lines(np.maximum(x0, x1), cols)
+    crossings = np.maximum(stop - first, 0)
+    edge = np.repeat(np.arange(len(points)), crossings)
+    column = np.arange(crossings.sum()) - np.repeat(np.cumsum(crossings) - crossings, crossings) + first[edge]
+
+    centers = column + 0.5
+    y = y0[edge] + (centers - x0[edge]) * (y1[edge] - y0[edge]) / (x1[edge] - x0[edge])
+    row = _grid_lines(y, rows)
+    sign = np.where(x1[edge] > x0[edge], 1, -1)
+
+    column_sums = sums[:, row, column + 1] - sums[:, row, column]
+    counts = np.abs(column_sums @ sign)
+    return counts, int(abs(sign @ row))
+
+
+def region_counts(table, region):
+    """
+    Per class counts and cell count of a region: {"bounds": {"xMin", "xMax",
+    "yMin", "yMax"}} or a GeoJSON Polygon or MultiPolygon (a Feature's geometry
+    is used), in level-0 image coordinates. Holes are subtracted.
+    """
+    if not isinstance(region, dict):
+        raise RegionError("A region must be an object")
+    if region.get("type") == "Feature":
+        region = region.get("geometry") or {}
+    if "bounds" in region:
+        bounds = region["bounds"]
+        try:
+            box = [float(bounds[name]) for name in ("xMin", "yMin", "xMax", "yMax")]
+        except (KeyError, TypeError, ValueError):
+            raise RegionError("Bounds need numeric xMin, xMax, yMin and yMax")
+        if not np.isfinite(box).all():
+            raise RegionError("Bounds must be finite")
+        return rectangle_counts(table, *box)
+
+    if region.get("type") == "Polygon":
+        polygons = [region.get("coordinates")]
+    elif region.get("type") == "MultiPolygon":
+        polygons = region.get("coordinates")
+    else:
+        raise RegionError("A region must have bounds or be a Polygon or MultiPolygon")
+
+    try:
+        rings = [
+            (index, np.asarray(ring, dtype=np.float64).reshape(-1, 2))
+            for polygon in polygons or []
+            for index, ring in enumerate(polygon or [])
+        ]
+    except (TypeError, ValueError):
+        raise RegionError("Polygon coordinates must be lists of [x, y] rings")
+    if not all(np.isfinite(points).all() for _, points in rings):
+        raise RegionError("Polygon coordinates must be finite")
+
+    counts = np.zeros(table["sums"].shape[0], dtype=np.int64)
+    cells = 0
+    for index, points in rings:
+        ring_count, ring_cells = ring_counts(table, points)
+        sign = 1 if index == 0 else -1  # Rings after the first are holes
+        counts += sign * ring_count
+        cells += sign * ring_cells
+    return counts, cells
+
+
+def region_stats(table, region, mpp=None):
+    """
+    Counts, proportions and densities of each class in a region (see region_counts).
+    Densities are per megapixel of level-0 image, and per square millimetre
+    when the microns per pixel (mpp) are known.
+    """
+    counts, cells = region_counts(table, region)
+    area_px = cells * table["cell"] ** 2
+    area_mm2 = area_px * mpp * mpp / 1e6 if mpp else None
+    total = int(counts.sum())
+
+    def densities(count):
+        return {
+            "density_per_mpx": count * 1e6 / area_px if area_px else None,
+            "density_per_mm2": count / area_mm2 if area_mm2 else None,
+        }
+
+    return {
+        "area_px": area_px,
+        "area_mm2": area_mm2,
+        "total": total,
+        **densities(total),
+        "classes": [
+            {
+                "name": name,
+                "color": color,
+                "count": int(count),
+                "proportion": int(count) / total if total else None,
+                **densities(int(count)),
+            }
+            for name, color, count in zip(table["class_names"], table["class_colors"], counts.tolist())
+        ],
+    }
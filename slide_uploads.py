@@ -0,0 +1,336 @@
+"""
+Slide uploads: deduplication by content hash and resumable chunked uploads.
+
+Every slide is hashed (SHA-256) while it is written to disk and recorded in
+the slides collection. A slide whose content is already stored is neither kept
+nor tiled again: the upload answers with the dzi_path of the stored slide, so
+its pyramid and annotations are reused whatever the new file is called. A
+different slide with the name of a stored one is kept under that name with the
+start of its hash appended, and the response names the dzi_path to open.
+
+Large slides are sent in chunks instead of one multipart body:
+
+    POST   /uploads               {filename, size, lastModified} -> {upload_id, offset, chunk_size}
+    PATCH  /uploads/<upload_id>   Upload-Offset header, chunk bytes as the body -> {offset, size}
+    GET    /uploads/<upload_id>   -> {filename, size, lastModified, offset, chunk_size}
+    DELETE /uploads/<upload_id>
+
+The PATCH that completes the file answers like /upload (dzi_path, or 202 with
+the tiling job). Every POST starts a new session under a random upload id; the
+client keeps that id, and after an interruption asks GET for the offset
+received so far and continues from there. Chunks are
+appended to a partial file in PARTIAL_FOLDER while they are hashed; the hash
+state is kept in memory per process and rebuilt from the partial file when
+another process (or the server before a restart) received the earlier chunks.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import openslide
+from flask import Blueprint, jsonify, request
+from pymongo.errors import DuplicateKeyError
+
+import tile_server
+from jobs import job_accepted, submit_job
+from metrics import log_event
+from mongo import database as db
+from tile_server import UPLOAD_FOLDER, convert_slide, slide_converted
+
+PARTIAL_FOLDER = os.path.join(UPLOAD_FOLDER, '.partial')
+CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_MB", "16")) * 1024 * 1024  # Suggested to clients
+COPY_BUFFER = 1024 * 1024
+HASH_PREFIX = 12  # Hex digits of the hash appended to a colliding filename
+
+slide_upload_blueprint = Blueprint('slide_uploads', __name__)
+
+_hashers = {}  # upload_id -> (offset, sha256 of the first offset bytes)
+_hashers_lock = threading.Lock()
+_chunks_lock = threading.Lock()  # Serializes PATCHes where flock is not available
+
+
+def valid_slide_name(filename):
+    return bool(filename) and os.path.basename(filename) == filename and not filename.startswith('.')
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER), b''):
+            sha256.update(block)
+    return sha256
+
+
+def write_hashed(stream, path):
+    """
+    Copies a stream to path, hashing it on the way. Returns (size, sha256 hex digest).
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as f:
+        for block in iter(lambda: stream.read(COPY_BUFFER), b''):
+            f.write(block)
+            sha256.update(block)
+            size += len(block)
+    return size, sha256.hexdigest()
+
+
+def _slide_digest(filename):
+    """
+    SHA-256 of a stored slide, recorded on first use for slides uploaded before hashing.
+    """
+    record = db.slides.find_one({"filename": filename})
+    if record:
+        return record["sha256"]
+    path = os.path.join(UPLOAD_FOLDER, filename)
+    digest = file_sha256(path).hexdigest()
+    try:
+        db.slides.insert_one({
+            "sha256": digest, "filename": filename, "size": os.path.getsize(path), "uploaded_at": time.time(),
+        })
+    except DuplicateKeyError:
+        pass  # The same content is stored under another name too; that record stays the canonical one
+    return digest
+
+
+def register_slide(temp_path, filename, digest, size):
+    """
+    Moves a hashed upload into UPLOAD_FOLDER unless its content is already
+    stored. Returns (stored filename, True when an existing slide was reused).
+    """
+    existing = db.slides.find_one({"sha256": digest})
+    if existing:
+        if os.path.exists(os.path.join(UPLOAD_FOLDER, existing["filename"])):
+            os.remove(temp_path)
+            return existing["filename"], True
+        db.slides.delete_one({"_id": existing["_id"]})  # The file was removed by hand
+
+    name = filename
+    if os.path.exists(os.path.join(UPLOAD_FOLDER, name)):
+        if _slide_digest(name) == digest:
+            os.remove(temp_path)
+            return name, True
+        stem, extension = os.path.splitext(filename)
+        name = f"{stem}-{digest[:HASH_PREFIX]}{extension}"
+        if os.path.exists(os.path.join(UPLOAD_FOLDER, name)):
+            os.remove(temp_path)
+            return name, True
+
+    os.replace(temp_path, os.path.join(UPLOAD_FOLDER, name))
+    try:
+        db.slides.insert_one({"sha256": digest, "filename": name, "size": size, "uploaded_at": time.time()})
+    except DuplicateKeyError:
+        # The same content finished uploading concurrently under another name
+        os.remove(os.path.join(UPLOAD_FOLDER, name))
+        return db.slides.find_one({"sha256": digest})["filename"], True
+    return name, False
+
+
+def forget_slide(filename):
+    """
+    Removes a stored slide that turned out to be unusable, so it is not reused.
+    """
+    db.slides.delete_many({"filename": filename})
+    path = os.path.join(UPLOAD_FOLDER, filename)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def convert_uploaded_slide(filename, deduplicated=False):
+    """
+    Response to a stored slide upload: the dzi_path when the slide is already
+    converted (or only its descriptor is needed), else the queued tiling job.
+    """
+    file_path = os.path.join(UPLOAD_FOLDER, filename)
+    dzi_path = os.path.join('output', filename + '.dzi')
+    tiles_path = os.path.join('output', filename + '_files')
+    extra = {"dzi_path": filename + '.dzi', "deduplicated": deduplicated}
+
+    # Check if the DeepZoom files also exist and were fully written
+    if slide_converted(dzi_path, tiles_path):
+        log_event("slide_already_converted", slide=filename)
+        return jsonify({"message": "Image already exists and is converted", **extra})
+
+    try:
+        openslide.OpenSlide(file_path).close()
+    except openslide.OpenSlideUnsupportedFormatError:
+        log_event("slide_unsupported", level=logging.WARNING, slide=filename)
+        if not deduplicated:
+            forget_slide(filename)
+        return jsonify({"error": "Unsupported or missing image file"}), 400
+
+    # Writing only the descriptor for on-demand tiles is instant, a full pyramid is built by a background job
+    if not tile_server.PREGENERATE_TILES:
+        convert_slide(file_path, dzi_path, tiles_path)
+        return jsonify({"message": "Image uploaded and converted successfully", **extra})
+
+    job_id = submit_job("tile_slide", {
+        "file_path": file_path,
+        "dzi_path": dzi_path,
+        "tiles_path": tiles_path,
+        "dzi_name": filename + '.dzi',
+    }, job_key=f"tiles:{dzi_path}")
+    return job_accepted(job_id, message="Image uploaded; DeepZoom tiles are being generated", **extra)
+
+
+def _session_paths(upload_id):
+    base = os.path.join(PARTIAL_FOLDER, upload_id)
+    return base + '.json', base + '.part'
+
+
+def _read_session(upload_id):
+    if not upload_id.isalnum():
+        return None
+    session_path, part_path = _session_paths(upload_id)
+    try:
+        with open(session_path) as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        return None
+    session["offset"] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return session
+
+
+def _hasher(upload_id, part_path, offset):
+    """
+    sha256 of the first offset bytes of an upload, from memory or rebuilt from its partial file.
+    """
+    with _hashers_lock:
+        state = _hashers.pop(upload_id, None)
+    if state is not None and state[0] == offset:
+        return state[1]
+    return file_sha256(part_path) if offset else hashlib.sha256()
+
+
+@contextmanager
+def _upload_lock(upload_id):
+    """
+    Exclusive lock of a chunked upload, held on its session file so the PATCHes
+    of one upload run one at a time in every server process (without flock, on
+    Windows, only within this process). Yields False when there is no session.
+    """
+    if fcntl is None:
+        with _chunks_lock:
+            yield True
+        return
+    session_path, _ = _session_paths(upload_id)
+    try:
+        session_file = open(session_path)
+    except OSError:
+        yield False
+        return
+    with session_file:
+        fcntl.flock(session_file, fcntl.LOCK_EX)
+        yield True
+
+
+@slide_upload_blueprint.route('/uploads', methods=['POST'])
+def start_upload():
+    """
+    Starts a chunked slide upload. Its id is random, so two files are never
+    written to the same partial file; the client keeps it to resume the upload.
+    """
+    data = request.json or {}
+    filename = data.get('filename')
+    size = data.get('size')
+    if not valid_slide_name(filename):
+        return jsonify({"error": "A plain filename is required"}), 400
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({"error": "The file size in bytes is required"}), 400
+
+    upload_id = uuid.uuid4().hex
+    os.makedirs(PARTIAL_FOLDER, exist_ok=True)
+    session_path, part_path = _session_paths(upload_id)
+    open(part_path, 'wb').close()
+    with open(session_path, 'w') as f:
+        json.dump({
+            "filename": filename, "size": size, "lastModified": data.get('lastModified'), "started_at": time.time(),
+        }, f)
+    return jsonify({"upload_id": upload_id, "offset": 0, "size": size, "chunk_size": CHUNK_SIZE})
+
+
+@slide_upload_blueprint.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    session = _read_session(upload_id)
+    if session is None:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify({
+        "upload_id": upload_id,
+        "filename": session["filename"],
+        "size": session["size"],
+        "lastModified": session.get("lastModified"),
+        "offset": session["offset"],
+        "chunk_size": CHUNK_SIZE,
+    })
+
+
+@slide_upload_blueprint.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """
+    Appends a chunk at the Upload-Offset header, which must be the offset
+    received so far (409 with that offset otherwise). The chunk completing the
+    file stores the slide and answers like /upload; should storing fail, the
+    session stays and an empty PATCH at the full size retries it.
+    """
+    if _read_session(upload_id) is None:
+        return jsonify({"error": "Upload not found"}), 404
+
+    with _upload_lock(upload_id) as found:
+        # The session as left by the PATCHes of this upload that held the lock before this one
+        session = _read_session(upload_id) if found else None
+        if session is None:
+            return jsonify({"error": "Upload not found"}), 404
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset != session["offset"]:
+            return jsonify({"error": "Chunk does not continue the upload", "offset": session["offset"]}), 409
+
+        session_path, part_path = _session_paths(upload_id)
+        sha256 = _hasher(upload_id, part_path, offset)
+        size = session["size"]
+        with open(part_path, 'r+b') as part:
+            part.seek(offset)
+            try:
+                for block in iter(lambda: request.stream.read(COPY_BUFFER), b''):
+                    if offset + len(block) > size:
+                        part.truncate(session["offset"])
+                        offset, sha256 = session["offset"], None
+                        return jsonify({"error": "Chunk runs past the announced size", "offset": offset}), 400
+                    part.write(block)
+                    sha256.update(block)
+                    offset += len(block)
+            finally:
+                # A chunk cut short by a dropped connection is kept; the client resumes after its last byte
+                if sha256 is not None:
+                    with _hashers_lock:
+                        _hashers[upload_id] = (offset, sha256)
+
+        if offset < size:
+            return jsonify({"upload_id": upload_id, "offset": offset, "size": size})
+
+        filename, deduplicated = register_slide(part_path, session["filename"], sha256.hexdigest(), size)
+        # The session only ends once the slide is stored
+        os.remove(session_path)
+        with _hashers_lock:
+            _hashers.pop(upload_id, None)
+    return convert_uploaded_slide(filename, deduplicated)
+
+
+@slide_upload_blueprint.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    if _read_session(upload_id) is None:
+        return jsonify({"error": "Upload not found"}), 404
+    with _hashers_lock:
+        _hashers.pop(upload_id, None)
+    for path in _session_paths(upload_id):
+        if os.path.exists(path):
+            os.remove(path)
+    return jsonify({"message": "Upload aborted", "upload_id": upload_id})
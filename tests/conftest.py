@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, next to app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+
+@pytest.fixture
+def mongo_db():
+    """
+    A fresh mongomock database, also set as the client of mongo.py.
+    """
+    mongomock = pytest.importorskip("mongomock")
+    import mongomock.gridfs
+    from mongomock.collection import BulkOperationBuilder
+
+    import mongo
+
+    mongomock.gridfs.enable_gridfs_integration()
+    # pymongo >= 4.9 passes a sort option to bulk updates that mongomock does not know
+    add_replace, add_update = BulkOperationBuilder.add_replace, BulkOperationBuilder.add_update
+    BulkOperationBuilder.add_replace = lambda self, *args, sort=None, **kwargs: add_replace(self, *args, **kwargs)
+    BulkOperationBuilder.add_update = lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs)
+    mongo.set_client(mongomock.MongoClient())
+    try:
+        yield mongo.get_db()
+    finally:
+        BulkOperationBuilder.add_replace, BulkOperationBuilder.add_update = add_replace, add_update
+        mongo.set_client(None)
@@ -0,0 +1,53 @@
+import io
+import json
+
+from annotation_index import query_spatial_index, query_spatial_table
+from annotation_ingest import ingest_geojson_stream
+from columnar import MAX_CLASSES
+from wire import annotation_message, decode_message
+
+WIDTH, HEIGHT = 4096, 4096
+
+
+def store_file(db, features):
+    content = json.dumps({"type": "FeatureCollection", "features": features}).encode("utf-8")
+    file_id = db.fs.files.insert_one({"metadata": {
+        "filename": "slide_model.geojson", "dzi_file": "slide.svs", "image_width": WIDTH, "image_height": HEIGHT,
+    }}).inserted_id
+    ingest_geojson_stream(db, db.fs.files.find_one({"_id": file_id}), io.BytesIO(content))
+    return db.fs.files.find_one({"_id": file_id})
+
+
+def measured_cells(count):
+    return [
+        {"type": "Feature", "id": f"cell-{index}", "geometry": {"type": "Polygon", "coordinates": [[
+            [x, y], [x + 6, y], [x + 6, y + 6], [x, y + 6], [x, y],
+        ]]}, "properties": {"classification": {"name": f"class-{index % 3}", "color": [index % 3, 0, 0]},
+                            "measurements": {"area": 36 + index}}}
+        for index in range(count)
+        for x, y in [((index * 37) % (WIDTH - 8), (index * 101) % (HEIGHT - 8))]
+    ]
+
+
+def test_query_returns_every_feature_with_its_properties(mongo_db):
+    features = measured_cells(MAX_CLASSES + 300)
+    file_doc = store_file(mongo_db, features)
+    assert len(file_doc["metadata"]["spatial_index"]["classes"]) <= MAX_CLASSES + 3
+
+    found = query_spatial_index(mongo_db, file_doc)
+    assert sorted(found, key=lambda feature: feature["id"]) == sorted(features, key=lambda feature: feature["id"])
+
+    bounds = (0, 0, WIDTH / 2, HEIGHT / 2)
+    inside = {feature["id"]: feature["properties"] for feature in query_spatial_index(mongo_db, file_doc, bounds)}
+    assert inside
+    assert all(inside[feature["id"]] == feature["properties"] for feature in features if feature["id"] in inside)
+
+
+def test_wire_message_carries_the_properties(mongo_db):
+    features = measured_cells(MAX_CLASSES + 50)
+    file_doc = store_file(mongo_db, features)
+    header, arrays = decode_message(annotation_message({"a": query_spatial_table(mongo_db, file_doc)}))
+    classes = header["files"][0]["classes"]
+    properties = {feature_id: classes[class_id]
+                  for feature_id, class_id in zip(header["files"][0]["feature_ids"], arrays["0/feature_classes"])}
+    assert properties == {feature["id"]: feature["properties"] for feature in features}
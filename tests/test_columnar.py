@@ -0,0 +1,108 @@
+import io
+import json
+
+import bson
+import numpy as np
+import pytest
+
+from columnar import (
+    GEOMETRY_TYPES, MAX_CLASSES, PENDING_CLASS, TableBuilder, chunk_fields, decode_chunk, part_coordinates,
+)
+from geojson_stream import iter_geojson_events
+
+FEATURES = [
+    {"type": "Feature", "id": "point", "geometry": {"type": "Point", "coordinates": [10, 20]},
+     "properties": {"classification": {"name": "Dead", "color": [254, 255, 0]}}},
+    {"type": "Feature", "id": "cells", "geometry": {"type": "MultiPolygon", "coordinates": [
+        [[[i, 2 * i], [i + 3, 2 * i], [i + 3, 2 * i + 4], [i, 2 * i]]] for i in range(40)
+    ]}, "properties": {"classification": {"name": "Neoplastic", "color": [255, 0, 0]}}},
+    {"type": "Feature", "id": 3, "geometry": {"type": "Polygon", "coordinates": [
+        [[0.1, 0.2], [100.7, 0.2], [100.7, 50.3], [0.1, 0.2]], [[10, 10], [20, 10], [20, 20], [10, 10]],
+    ]}, "properties": {"classification": {"name": "Neoplastic", "color": [255, 0, 0]}, "score": 0.93}},
+    {"type": "Feature", "id": None, "geometry": {"type": "MultiPoint", "coordinates": [[i / 3, -i] for i in range(25)]},
+     "properties": {}},
+    {"type": "Feature", "id": "empty", "geometry": None, "properties": {"skipped": True}},
+]
+
+
+def stream_tables(features, batch_vertices):
+    """
+    Batch tables of a FeatureCollection streamed as annotation_ingest does, and the builder.
+    """
+    builder = TableBuilder(batch_vertices)
+    tables = []
+    stream = io.BytesIO(json.dumps({"type": "FeatureCollection", "features": features}).encode("utf-8"))
+    for event in iter_geojson_events(stream):
+        if event[0] == "part":
+            builder.add_part(event[1], event[2])
+        else:
+            builder.end_feature(event[1])
+        if builder.ready():
+            tables.append(builder.take())
+    tables.append(builder.take())
+    return builder, tables
+
+
+def rebuild_features(builder, tables, parts_per_chunk):
+    """
+    Features read back from chunk documents of every table, after a round trip through BSON.
+    """
+    geometries = {}
+    own_properties = {fid: split["properties"] for fid, split in builder.split_features.items() if "properties" in split}
+    for table in tables:
+        part_count = len(table["part_feature"])
+        for start in range(0, part_count, parts_per_chunk):
+            parts = np.arange(start, min(start + parts_per_chunk, part_count))
+            chunk = decode_chunk(bson.decode(bson.encode(chunk_fields(table, parts))))
+            for part, feature in enumerate(chunk["part_features"].tolist()):
+                fid = int(chunk["fids"][feature])
+                if "properties" in chunk and chunk["properties"][feature] is not None:
+                    own_properties[fid] = chunk["properties"][feature]
+                geometry_type = GEOMETRY_TYPES[chunk["types"][feature]]
+                coordinates = part_coordinates(chunk, part, geometry_type)
+                vertices = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+                assert chunk["bboxes"][part].tolist() == [*vertices.min(axis=0), *vertices.max(axis=0)]
+                geometries.setdefault(fid, (geometry_type, []))[1].append(coordinates)
+
+    features = []
+    for fid, (geometry_type, parts) in sorted(geometries.items()):
+        features.append({
+            "type": "Feature",
+            "id": builder.feature_ids[fid],
+            "geometry": {"type": geometry_type,
+                         "coordinates": parts if geometry_type in ("MultiPoint", "MultiPolygon") else parts[0]},
+            "properties": own_properties.get(fid, builder.classes[builder.feature_classes[fid]]),
+        })
+    return features
+
+
+@pytest.mark.parametrize("batch_vertices", [None, 1, 30, 1 << 18])
+@pytest.mark.parametrize("parts_per_chunk", [1, 7, 1000])
+def test_round_trip(batch_vertices, parts_per_chunk):
+    builder, tables = stream_tables(FEATURES, batch_vertices)
+    assert PENDING_CLASS not in builder.feature_classes
+    expected = [feature for feature in FEATURES if feature["geometry"]]
+    assert rebuild_features(builder, tables, parts_per_chunk) == expected
+
+
+@pytest.mark.parametrize("batch_vertices", [None, 1, 500])
+def test_properties_past_the_class_dictionary_round_trip(batch_vertices):
+    features = [
+        {"type": "Feature", "id": f"cell-{index}", "geometry": {"type": "MultiPoint", "coordinates": [
+            [index, 0], [index, 1], [index, 2],
+        ]}, "properties": {"classification": {"name": f"class-{index % 3}", "color": [index % 3, 0, 0]},
+                           "measurements": {"area": index * 1.5}}}
+        for index in range(MAX_CLASSES + 200)
+    ]
+    features.append({"type": "Feature", "id": "plain", "geometry": {"type": "Point", "coordinates": [1, 1]},
+                     "properties": {"classification": {"name": "class-9", "color": [9, 0, 0]}}})
+    builder, tables = stream_tables(features, batch_vertices)
+    assert len(builder.classes) <= MAX_CLASSES + 4
+    assert rebuild_features(builder, tables, 100) == features
+
+
+def test_exact_coordinates_are_narrowed():
+    _, whole = stream_tables(FEATURES[:2], None)
+    _, fractional = stream_tables(FEATURES[2:3], None)
+    assert whole[0]["coords"].dtype == np.float32
+    assert fractional[0]["coords"].dtype == np.float64
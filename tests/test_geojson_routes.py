@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from geojson_routes import ingest_annotation_file
+from test_hexbin_updates import HEIGHT, WIDTH, cell_features
+
+DZI_FILE, MODEL_NAME = "slide.svs", "cellvit"
+FILENAME = "slide_cellvit.geojson"
+
+
+def spool(tmp_path, content):
+    path = tmp_path / "upload.geojson"
+    path.write_bytes(content)
+    return str(path)
+
+
+def ingest(spool_path, **kwargs):
+    return ingest_annotation_file(spool_path, FILENAME, DZI_FILE, MODEL_NAME, WIDTH, HEIGHT, **kwargs)
+
+
+def test_ingest_stores_the_file(mongo_db, tmp_path):
+    content = json.dumps({"type": "FeatureCollection", "features": cell_features(50)}).encode("utf-8")
+    spool_path = spool(tmp_path, content)
+    result = ingest(spool_path)
+
+    file_doc = mongo_db.fs.files.find_one({"filename": FILENAME})
+    assert result["file_id"] == str(file_doc["_id"])
+    assert "ingest_pending" not in file_doc["metadata"]
+    assert file_doc["metadata"]["spatial_index"]["feature_count"] == 50
+    assert mongo_db.geojson_hex_bins.count_documents({"filename": FILENAME})
+    assert mongo_db.roi_grids.files.count_documents({"metadata.file_id": file_doc["_id"]}) == 1
+    assert not tmp_path.joinpath("upload.geojson").exists()
+
+
+@pytest.mark.parametrize("replace", [False, True])
+def test_invalid_file_is_removed_and_raised(mongo_db, tmp_path, replace):
+    if replace:
+        valid = json.dumps({"type": "FeatureCollection", "features": cell_features(50)}).encode("utf-8")
+        ingest(spool(tmp_path, valid))
+    content = json.dumps({"type": "FeatureCollection", "features": cell_features(50, seed=1)}).encode("utf-8")
+    spool_path = spool(tmp_path, content[:len(content) // 2])
+
+    with pytest.raises(Exception, match="Invalid GeoJSON"):
+        ingest(spool_path, replace=replace)
+    assert mongo_db.fs.files.count_documents({}) == 0
+    assert mongo_db.fs.chunks.count_documents({}) == 0
+    assert mongo_db.annotation_buckets.count_documents({}) == 0
+    assert mongo_db.geojson_hex_bins.count_documents({}) == 0
+    assert mongo_db.roi_grids.files.count_documents({}) == 0
+    assert not tmp_path.joinpath("upload.geojson").exists()
+
+    # The upload can be made again
+    ingest(spool(tmp_path, content))
+    assert mongo_db.fs.files.count_documents({}) == 1
@@ -0,0 +1,98 @@
+import io
+import json
+
+import pytest
+
+from geojson_stream import STREAMED_TYPES, WHOLE_TYPES, GeoJSONStreamError, iter_geojson_events
+
+
+class Trickle(io.RawIOBase):
+    """
+    A binary stream that returns at most `step` bytes per read, so values are cut at every position.
+    """
+
+    def __init__(self, data, step):
+        self.data, self.step, self.offset = data, step, 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunk = self.data[self.offset:self.offset + min(self.step, size if size >= 0 else self.step)]
+        self.offset += len(chunk)
+        return chunk
+
+
+FEATURES = [
+    {"type": "Feature", "id": "p-1", "geometry": {"type": "Point", "coordinates": [1.5, -2e3]},
+     "properties": {"name": "Zelle é水 \"quoted\" \\ back", "nested": {"a": [1, 2, {"b": None}]}}},
+    {"type": "Feature", "id": 7, "properties": {"classification": {"name": "Neoplastic", "color": [255, 0, 0]}},
+     "geometry": {"coordinates": [[[0, 0], [10, 0], [10, 10], [0, 0]], [[2, 2], [3, 2], [3, 3], [2, 2]]],
+                  "type": "Polygon"}},
+    {"type": "Feature", "geometry": {"type": "MultiPolygon", "coordinates": [
+        [[[i, i], [i + 1.25, i], [i + 1, i + 1e-3], [i, i]]] for i in range(50)
+    ]}, "properties": {"objectType": "annotation"}},
+    {"type": "Feature", "geometry": {"type": "MultiPoint", "coordinates": [[i * 0.5, -i] for i in range(30)]},
+     "properties": {}},
+    {"type": "Feature", "geometry": None, "properties": {"empty": True}},
+    {"type": "Feature", "geometry": {"type": "LineString", "coordinates": [[0, 0], [1, 1]]}, "properties": {}},
+]
+
+
+def read_features(stream):
+    """
+    Rebuilds the features of a stream from its events.
+    """
+    features, parts = [], []
+    for event in iter_geojson_events(stream):
+        if event[0] == "part":
+            parts.append(event[2])
+            continue
+        feature = event[1]
+        geometry_type = (feature.get("geometry") or {}).get("type")
+        if geometry_type in STREAMED_TYPES:
+            feature["geometry"]["coordinates"] = parts
+        elif geometry_type in WHOLE_TYPES:
+            feature["geometry"]["coordinates"] = parts[0]
+        features.append(feature)
+        parts = []
+    return features
+
+
+def expected_features(document):
+    features = json.loads(document)
+    features = features["features"] if isinstance(features, dict) else features
+    for feature in features:
+        geometry = feature.get("geometry")
+        if geometry and geometry["type"] not in STREAMED_TYPES + WHOLE_TYPES:
+            del geometry["coordinates"]  # Unsupported geometry keeps only its type
+    return features
+
+
+@pytest.mark.parametrize("document", [
+    json.dumps({"type": "FeatureCollection", "features": FEATURES}),
+    json.dumps({"features": FEATURES, "type": "FeatureCollection", "crs": {"name": "pixels"}}, indent=2),
+    json.dumps(FEATURES, separators=(",", ":")),
+    json.dumps({"type": "FeatureCollection", "features": FEATURES}, ensure_ascii=False),
+    json.dumps({"type": "FeatureCollection", "features": []}),
+])
+@pytest.mark.parametrize("step", [1, 7, 4096])
+def test_stream_matches_json_load(document, step):
+    data = document.encode("utf-8")
+    assert read_features(Trickle(data, step)) == expected_features(document)
+
+
+def test_coordinates_before_type_are_kept():
+    document = json.dumps([{"type": "Feature", "geometry": {"coordinates": [[1, 2], [3, 4]], "type": "MultiPoint"}}])
+    assert read_features(Trickle(document.encode(), 3)) == expected_features(document)
+
+
+@pytest.mark.parametrize("document", [
+    '{"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": {"type": "Point"',
+    '{"type": "FeatureCollection", "features": [{"type": "Feature",, }]}',
+    '{"type": "FeatureCollection"}',
+    '"features"',
+])
+def test_invalid_documents_raise(document):
+    with pytest.raises(GeoJSONStreamError):
+        read_features(Trickle(document.encode(), 5))
@@ -0,0 +1,80 @@
+import json
+
+from benchmarks.synthetic import CELL_CLASSES, cell_rings
+from columnar import encode_features
+from hexbin import HEX_RESOLUTIONS, compute_hex_pyramid
+from hexbin_updates import hex_bin_delta, store_hex_pyramid, stored_hex_bins
+
+WIDTH, HEIGHT = 20000, 15000
+DZI_FILE, FILENAME, MODEL_NAME = "slide.svs", "slide_cellvit.geojson", "cellvit"
+
+
+def cell_features(cells, seed=0):
+    rings, classes = cell_rings(cells, WIDTH, HEIGHT, seed)
+    return [
+        {
+            "type": "Feature",
+            "id": f"cell-{seed}-{index}",
+            "geometry": {"type": "Polygon", "coordinates": [ring.tolist()]},
+            "properties": {"classification": {"name": CELL_CLASSES[cls][0], "color": CELL_CLASSES[cls][1]}},
+        }
+        for index, (ring, cls) in enumerate(zip(rings, classes.tolist()))
+    ]
+
+
+def pyramid(features):
+    return compute_hex_pyramid(encode_features(features), WIDTH, HEIGHT, HEX_RESOLUTIONS)
+
+
+def store(collection, features):
+    store_hex_pyramid(collection, DZI_FILE, FILENAME, MODEL_NAME, pyramid(features), WIDTH, HEIGHT, HEX_RESOLUTIONS)
+
+
+def stored_documents(collection):
+    """
+    The stored hex bins, comparable across collections: ids dropped, feature ids sorted.
+    """
+    documents = []
+    for document in collection.find({}, {"_id": 0}):
+        document["feature_ids"] = sorted(document["feature_ids"])
+        documents.append(json.dumps(document, sort_keys=True))
+    return sorted(documents)
+
+
+def assert_matches_recompute(collection, features):
+    expected = pyramid(features)
+    for resolution in HEX_RESOLUTIONS:
+        assert hex_bin_delta(expected[resolution], stored_hex_bins(collection, DZI_FILE, FILENAME, resolution)) == {}
+
+
+def test_first_store_inserts_the_computed_bins(mongo_db):
+    features = cell_features(300)
+    store(mongo_db.geojson_hex_bins, features)
+    assert_matches_recompute(mongo_db.geojson_hex_bins, features)
+    expected = pyramid(features)
+    assert mongo_db.geojson_hex_bins.count_documents({}) == sum(len(expected[r]) for r in HEX_RESOLUTIONS)
+
+
+def test_delta_updates_match_a_full_recompute(mongo_db):
+    features = cell_features(300)
+    store(mongo_db.geojson_hex_bins, features)
+
+    # A replaced upload: cells removed, cells added and a cell reclassified
+    changed = features[40:] + cell_features(60, seed=1)
+    changed[0] = json.loads(json.dumps(changed[0]))
+    changed[0]["properties"]["classification"] = {"name": "Dead", "color": [254, 255, 0]}
+    store(mongo_db.geojson_hex_bins, changed)
+    assert_matches_recompute(mongo_db.geojson_hex_bins, changed)
+
+    store(mongo_db.fresh_hex_bins, changed)
+    assert stored_documents(mongo_db.geojson_hex_bins) == stored_documents(mongo_db.fresh_hex_bins)
+
+
+def test_removing_every_cell_of_a_class_drops_it(mongo_db):
+    features = cell_features(200)
+    store(mongo_db.geojson_hex_bins, features)
+    kept = [feature for feature in features if feature["properties"]["classification"]["name"] != "Neoplastic"]
+    store(mongo_db.geojson_hex_bins, kept)
+    assert_matches_recompute(mongo_db.geojson_hex_bins, kept)
+    assert not mongo_db.geojson_hex_bins.count_documents({"classifications.Neoplastic": {"$exists": True}})
+    assert all(document["annotation_count"] > 0 for document in mongo_db.geojson_hex_bins.find())
@@ -0,0 +1,150 @@
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import jobs
+
+
+@pytest.fixture
+def job_pool(tmp_path, monkeypatch):
+    """
+    A job table in a temporary file and a thread pool in place of the process pool.
+    """
+    monkeypatch.setattr(jobs, "JOBS_DB", str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(jobs, "PROGRESS_INTERVAL", 0)
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(jobs, "_pool", pool)
+    try:
+        yield pool
+    finally:
+        pool.shutdown(wait=True)
+
+
+def add_handler(monkeypatch, kind, handler):
+    monkeypatch.setitem(jobs.JOB_HANDLERS, kind, handler)
+
+
+def wait_for(job_id, statuses=("done", "failed", "cancelled"), timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = jobs.get_job(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} still {jobs.get_job(job_id)['status']}")
+
+
+def test_job_records_progress_and_result(job_pool, monkeypatch):
+    def handler(params, report):
+        for done in range(1, 5):
+            report(done, 4)
+        return {"echo": params["value"]}
+
+    add_handler(monkeypatch, "test", handler)
+    job = wait_for(jobs.submit_job("test", {"value": 7}))
+    assert job["status"] == "done"
+    assert job["result"] == {"echo": 7}
+    assert (job["done"], job["total"], job["progress"]) == (4, 4, 1.0)
+
+
+def test_failed_job_keeps_its_error(job_pool, monkeypatch):
+    def handler(params, report):
+        raise ValueError("bad input")
+
+    add_handler(monkeypatch, "test", handler)
+    job = wait_for(jobs.submit_job("test", {}))
+    assert job["status"] == "failed"
+    assert job["error"] == "bad input"
+
+
+def test_concurrent_submits_of_a_key_start_one_job(job_pool, monkeypatch):
+    release = threading.Event()
+    started = []
+
+    def handler(params, report):
+        started.append(params["caller"])
+        release.wait(10)
+        return None
+
+    add_handler(monkeypatch, "test", handler)
+    barrier = threading.Barrier(8)
+
+    def submit(caller):
+        barrier.wait()
+        return jobs.submit_job("test", {"caller": caller}, job_key="tiles:slide.svs")
+
+    with ThreadPoolExecutor(max_workers=8) as callers:
+        job_ids = set(callers.map(submit, range(8)))
+    release.set()
+    assert len(job_ids) == 1
+    assert wait_for(job_ids.pop())["status"] == "done"
+    assert len(started) == 1
+
+    # Once it has finished, the key can run again
+    other = jobs.submit_job("test", {"caller": 8}, job_key="tiles:slide.svs")
+    assert wait_for(other)["status"] == "done"
+
+
+def test_cancel_queued_and_running_jobs(job_pool, monkeypatch):
+    running = threading.Event()
+    release = threading.Event()
+
+    def handler(params, report):
+        running.set()
+        release.wait(10)
+        report(1, 2)  # A running job stops at its next progress report
+        return "finished"
+
+    add_handler(monkeypatch, "test", handler)
+    first = jobs.submit_job("test", {})
+    assert running.wait(10)
+    queued = jobs.submit_job("test", {})  # Waits for the only worker
+
+    assert jobs.cancel_job(queued)["status"] == "cancelled"
+    assert jobs.cancel_job(first)["status"] == "running"
+    release.set()
+    assert wait_for(first)["status"] == "cancelled"
+    assert jobs.cancel_job("missing") is None
+
+
+def test_recover_jobs_of_exited_servers(job_pool, monkeypatch):
+    resumed = []
+    add_handler(monkeypatch, "tile_slide", lambda params, report: resumed.append(params["dzi_name"]) or "resumed")
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+
+    # Jobs as an exited server process left them
+    submit = jobs._submit
+    monkeypatch.setattr(jobs, "_submit", lambda job_id: None)
+    tile_job = jobs.submit_job("tile_slide", {"dzi_name": "slide.dzi"}, job_key="tiles:slide.svs")
+    ingest_job = jobs.submit_job("ingest_annotation", {}, job_key="annotation:slide_cellvit.geojson")
+    jobs._update(tile_job, status="running", owner_pid=exited.pid)
+    jobs._update(ingest_job, owner_pid=exited.pid)
+    own_job = jobs.submit_job("tile_slide", {"dzi_name": "own.dzi"})
+    monkeypatch.setattr(jobs, "_submit", submit)
+
+    jobs.recover_jobs()
+    assert wait_for(tile_job)["result"] == "resumed"
+    assert resumed == ["slide.dzi"]
+    ingest = jobs.get_job(ingest_job)
+    assert ingest["status"] == "failed"
+    assert "upload the file again" in ingest["error"]
+    assert jobs.get_job(own_job)["status"] == "queued"  # Its server process is this one, still alive
+
+
+def test_list_jobs_limit(job_pool, monkeypatch):
+    from flask import Flask
+
+    add_handler(monkeypatch, "test", lambda params, report: None)
+    for _ in range(3):
+        wait_for(jobs.submit_job("test", {}))
+    app = Flask(__name__)
+    app.register_blueprint(jobs.jobs_blueprint)
+    monkeypatch.setattr(jobs, "_get_pool", lambda: job_pool)
+    client = app.test_client()
+    assert len(client.get("/jobs?limit=2").get_json()["jobs"]) == 2
+    assert len(client.get("/jobs?limit=many").get_json()["jobs"]) == 3
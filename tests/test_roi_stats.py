@@ -0,0 +1,74 @@
+import math
+
+import numpy as np
+import pytest
+
+from roi_stats import RegionError, region_counts
+
+CELL = 64
+
+
+def count_table(counts, width, height):
+    """
+    The summed_area_table of a count grid, without the database.
+    """
+    sums = np.zeros((counts.shape[0], counts.shape[1] + 1, counts.shape[2] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(counts, axis=1), axis=2, out=sums[:, 1:, 1:])
+    return {"sums": sums, "cell": CELL, "image_width": width, "image_height": height,
+            "class_names": [f"class {k}" for k in range(counts.shape[0])], "class_colors": [None] * counts.shape[0]}
+
+
+def centers_inside(ring, rows, cols):
+    """
+    Grid cells whose center is inside a ring (even-odd rule), by brute force.
+    """
+    ys, xs = np.mgrid[0:rows, 0:cols]
+    x, y = (xs.ravel() + 0.5) * CELL, (ys.ravel() + 0.5) * CELL
+    inside = np.zeros(len(x), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1]):
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            at = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < at)
+    return inside.reshape(rows, cols)
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(0)
+    counts = rng.integers(0, 5, size=(3, 40, 50))
+    return count_table(counts, 50 * CELL, 40 * CELL), counts
+
+
+def test_polygon_counts_match_brute_force(table):
+    table, counts = table
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        cx, cy, radius = rng.uniform(500, 2700), rng.uniform(500, 2000), rng.uniform(100, 900)
+        angles = np.sort(rng.uniform(0, 2 * math.pi, size=9))
+        ring = [[cx + radius * math.cos(a), cy + radius * math.sin(a)] for a in angles]
+        inside = centers_inside(ring, 40, 50)
+        got, cells = region_counts(table, {"type": "Polygon", "coordinates": [ring + ring[:1]]})
+        assert got.tolist() == counts[:, inside].sum(axis=1).tolist()
+        assert cells == inside.sum()
+
+
+def test_whole_image_bounds_count_every_cell(table):
+    table, counts = table
+    got, cells = region_counts(table, {"bounds": {"xMin": 0, "yMin": 0, "xMax": 50 * CELL, "yMax": 40 * CELL}})
+    assert got.tolist() == counts.sum(axis=(1, 2)).tolist()
+    assert cells == 40 * 50
+
+
+@pytest.mark.parametrize("region", [
+    {"bounds": {"xMin": 0, "yMin": 0, "xMax": math.inf, "yMax": 100}},
+    {"bounds": {"xMin": math.nan, "yMin": 0, "xMax": 100, "yMax": 100}},
+    {"type": "Polygon", "coordinates": [[[0, 0], [math.inf, 0], [100, 100], [0, 0]]]},
+    {"type": "MultiPolygon", "coordinates": [[[[0, 0], [100, 0], [100, -math.inf], [0, 0]]]]},
+    {"type": "Polygon", "coordinates": [[[0, 0], [100, math.nan], [100, 100], [0, 0]]]},
+    {"type": "Polygon", "coordinates": [[[0, 0], [100], [100, 100]]]},
+    {"type": "Point", "coordinates": [0, 0]},
+])
+def test_invalid_regions_are_rejected(table, region):
+    with pytest.raises(RegionError):
+        region_counts(table[0], region)
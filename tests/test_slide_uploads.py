@@ -0,0 +1,149 @@
+import hashlib
+import os
+
+import pytest
+from flask import Flask
+
+import slide_uploads
+from benchmarks.synthetic import write_tiff_slide
+from mongo_indexes import ensure_indexes
+
+
+@pytest.fixture
+def client(mongo_db, tmp_path, monkeypatch):
+    """
+    A test client of the upload routes, with uploads and output in a temporary directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    ensure_indexes(mongo_db)
+    app = Flask(__name__)
+    app.register_blueprint(slide_uploads.slide_upload_blueprint)
+    slide_uploads._hashers.clear()
+    return app.test_client()
+
+
+@pytest.fixture(scope="module")
+def slide_bytes(tmp_path_factory):
+    path = tmp_path_factory.mktemp("slides") / "slide.tif"
+    with open(write_tiff_slide(str(path), 700, 500), "rb") as f:
+        return f.read()
+
+
+def start(client, filename, content, last_modified=1700000000000):
+    response = client.post("/uploads", json={"filename": filename, "size": len(content), "lastModified": last_modified})
+    assert response.status_code == 200
+    assert response.get_json()["offset"] == 0
+    return response.get_json()["upload_id"]
+
+
+def patch(client, upload_id, offset, chunk):
+    return client.patch(f"/uploads/{upload_id}", data=chunk, headers={"Upload-Offset": str(offset)})
+
+
+def upload(client, filename, content, chunks=3):
+    upload_id = start(client, filename, content)
+    step = -(-len(content) // chunks)
+    for offset in range(0, len(content), step):
+        response = patch(client, upload_id, offset, content[offset:offset + step])
+    return upload_id, response
+
+
+def test_chunked_upload_stores_and_converts_the_slide(client, mongo_db, slide_bytes):
+    upload_id, response = upload(client, "slide.tif", slide_bytes)
+    assert response.status_code == 200
+    assert response.get_json()["dzi_path"] == "slide.tif.dzi"
+    assert response.get_json()["deduplicated"] is False
+    with open(os.path.join("uploads", "slide.tif"), "rb") as f:
+        assert f.read() == slide_bytes
+    assert os.path.exists(os.path.join("output", "slide.tif.dzi"))
+    assert mongo_db.slides.find_one({"filename": "slide.tif"})["sha256"] == hashlib.sha256(slide_bytes).hexdigest()
+    assert client.get(f"/uploads/{upload_id}").status_code == 404
+    assert upload_id not in slide_uploads._hashers
+
+
+def test_chunks_must_continue_the_upload(client, slide_bytes):
+    upload_id = start(client, "slide.tif", slide_bytes)
+    assert patch(client, upload_id, 0, slide_bytes[:1000]).get_json()["offset"] == 1000
+
+    for offset in (0, 999, 1001):
+        response = patch(client, upload_id, offset, slide_bytes[offset:offset + 1000])
+        assert response.status_code == 409
+        assert response.get_json()["offset"] == 1000
+    response = client.patch(f"/uploads/{upload_id}", data=slide_bytes[1000:2000])  # No Upload-Offset
+    assert response.status_code == 409
+
+    status = client.get(f"/uploads/{upload_id}").get_json()
+    assert (status["filename"], status["size"], status["offset"]) == ("slide.tif", len(slide_bytes), 1000)
+
+
+def test_chunk_past_the_size_is_refused(client, slide_bytes):
+    upload_id = start(client, "slide.tif", slide_bytes)
+    patch(client, upload_id, 0, slide_bytes[:1000])
+    response = patch(client, upload_id, 1000, slide_bytes[1000:] + b"extra")
+    assert response.status_code == 400
+    assert response.get_json()["offset"] == 1000
+    assert client.get(f"/uploads/{upload_id}").get_json()["offset"] == 1000
+
+    # The upload continues once the right bytes come
+    response = patch(client, upload_id, 1000, slide_bytes[1000:])
+    assert response.status_code == 200
+    assert response.get_json()["dzi_path"] == "slide.tif.dzi"
+
+
+def test_resume_in_another_process(client, mongo_db, slide_bytes):
+    upload_id = start(client, "slide.tif", slide_bytes)
+    patch(client, upload_id, 0, slide_bytes[:5000])
+    slide_uploads._hashers.clear()  # The hash state of the first chunk is rebuilt from the partial file
+    assert client.get(f"/uploads/{upload_id}").get_json()["offset"] == 5000
+    assert patch(client, upload_id, 5000, slide_bytes[5000:]).status_code == 200
+    assert mongo_db.slides.find_one({"filename": "slide.tif"})["sha256"] == hashlib.sha256(slide_bytes).hexdigest()
+
+
+def test_uploads_of_files_alike_do_not_share_a_session(client, slide_bytes):
+    other = bytes(reversed(slide_bytes))
+    first = start(client, "slide.tif", slide_bytes)
+    second = start(client, "slide.tif", other)
+    assert first != second
+    patch(client, first, 0, slide_bytes[:1000])
+    assert client.get(f"/uploads/{second}").get_json()["offset"] == 0
+    assert patch(client, second, 0, other[:1000]).get_json()["offset"] == 1000
+
+
+def test_same_content_is_deduplicated(client, mongo_db, slide_bytes):
+    upload(client, "slide.tif", slide_bytes)
+    _, response = upload(client, "copy.tif", slide_bytes)
+    assert response.get_json()["dzi_path"] == "slide.tif.dzi"
+    assert response.get_json()["deduplicated"] is True
+    assert not os.path.exists(os.path.join("uploads", "copy.tif"))
+    assert mongo_db.slides.count_documents({}) == 1
+
+
+def test_other_content_under_a_stored_name_is_renamed(client, slide_bytes, tmp_path):
+    upload(client, "slide.tif", slide_bytes)
+    other = write_tiff_slide(str(tmp_path / "other.tif"), 600, 400, seed=1)
+    with open(other, "rb") as f:
+        other_bytes = f.read()
+    _, response = upload(client, "slide.tif", other_bytes)
+    digest = hashlib.sha256(other_bytes).hexdigest()
+    assert response.get_json()["dzi_path"] == f"slide-{digest[:slide_uploads.HASH_PREFIX]}.tif.dzi"
+    assert response.get_json()["deduplicated"] is False
+
+
+def test_unsupported_slide_is_not_kept(client, mongo_db):
+    content = b"not a slide" * 100
+    _, response = upload(client, "notes.tif", content)
+    assert response.status_code == 400
+    assert not os.path.exists(os.path.join("uploads", "notes.tif"))
+    assert mongo_db.slides.count_documents({}) == 0
+
+
+def test_abort_and_unknown_uploads(client, slide_bytes):
+    upload_id = start(client, "slide.tif", slide_bytes)
+    patch(client, upload_id, 0, slide_bytes[:1000])
+    assert client.delete(f"/uploads/{upload_id}").status_code == 200
+    assert client.get(f"/uploads/{upload_id}").status_code == 404
+    assert patch(client, upload_id, 1000, slide_bytes[1000:2000]).status_code == 404
+    assert client.get("/uploads/../../etc").status_code == 404
+    assert client.post("/uploads", json={"filename": "../slide.tif", "size": 10}).status_code == 400
+    assert client.post("/uploads", json={"filename": "slide.tif"}).status_code == 400
@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+from tile_pack import RECORD, TilePack, TilePackWriter, pack_directory, pack_path, read_partial_tile
+
+LEVEL_TILES = [(1, 1), (2, 1), (3, 2)]
+
+
+def tile_bytes(level, col, row):
+    return f"tile {level}/{col}_{row}".encode("utf-8") * (1 + level + col + row)
+
+
+def all_tiles(level_tiles=LEVEL_TILES):
+    return [
+        (level, col, row, tile_bytes(level, col, row))
+        for level, (cols, rows) in enumerate(level_tiles)
+        for row in range(rows)
+        for col in range(cols)
+    ]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "slide_files.pack")
+    tiles = all_tiles()
+    missing = tiles.pop(4)
+    writer = TilePackWriter(path, LEVEL_TILES)
+    writer.add_many(reversed(tiles))
+    writer.add(2, 0, 0, b"rewritten")  # The last copy of a tile is kept
+    assert not os.path.exists(path)
+    writer.finish()
+    assert not os.path.exists(path + ".partial")
+
+    pack = TilePack(path)
+    try:
+        assert pack.level_tiles == LEVEL_TILES
+        assert pack.tile_count() == len(tiles)
+        for level, col, row, data in tiles:
+            expected = b"rewritten" if (level, col, row) == (2, 0, 0) else data
+            assert pack.get(level, col, row) == expected
+        assert pack.get(*missing[:3]) is None
+        assert pack.get(1, 2, 0) is None
+        assert pack.get(2, 0, 2) is None
+        assert pack.get(3, 0, 0) is None
+    finally:
+        pack.close()
+
+
+def test_resume_after_interruption(tmp_path):
+    path = str(tmp_path / "slide_files.pack")
+    tiles = all_tiles()
+    writer = TilePackWriter(path, LEVEL_TILES)
+    writer.add_many(tiles[:5])
+    writer.flush()
+    with open(writer.partial_path, "rb") as f:
+        level, col, row, data = tiles[2]
+        assert read_partial_tile(f, *writer.index[(level, col, row)]) == data
+    writer.close()
+
+    # A record torn by the interruption is dropped
+    with open(path + ".partial", "ab") as f:
+        f.write(RECORD.pack(*tiles[5][:3], 1000) + b"torn")
+    with pytest.raises(ValueError):
+        TilePack(path + ".partial")
+
+    writer = TilePackWriter(path, LEVEL_TILES, resume=True)
+    assert writer.resumed
+    assert sorted(writer.index) == sorted(tile[:3] for tile in tiles[:5])
+    writer.add_many(tiles[5:])
+    writer.finish()
+
+    pack = TilePack(path)
+    try:
+        assert pack.tile_count() == len(tiles)
+        for level, col, row, data in tiles:
+            assert pack.get(level, col, row) == data
+    finally:
+        pack.close()
+
+
+def test_pack_directory(tmp_path):
+    tiles_path = str(tmp_path / "slide_files")
+    tiles = all_tiles()
+    for level, col, row, data in tiles:
+        os.makedirs(os.path.join(tiles_path, str(level)), exist_ok=True)
+        with open(os.path.join(tiles_path, str(level), f"{col}_{row}.jpeg"), "wb") as f:
+            f.write(data)
+    with open(os.path.join(tiles_path, "2", "notes.txt"), "w") as f:
+        f.write("not a tile")
+
+    path, count = pack_directory(tiles_path)
+    assert path == pack_path(tiles_path)
+    assert count == len(tiles)
+    pack = TilePack(path)
+    try:
+        assert pack.level_tiles == LEVEL_TILES
+        for level, col, row, data in tiles:
+            assert pack.get(level, col, row) == data
+    finally:
+        pack.close()
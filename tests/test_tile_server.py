@@ -0,0 +1,108 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+import tile_server
+import tiler
+from benchmarks.synthetic import write_tiff_slide
+
+SLIDE = "slide.tif"
+
+
+@pytest.fixture
+def slide(tmp_path, monkeypatch):
+    """
+    A slide in uploads/ with only its .dzi in output/, as after an upload, and empty tile caches.
+    """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tile_server.UPLOAD_FOLDER)
+    os.makedirs(tile_server.OUTPUT_FOLDER)
+    slide_path = write_tiff_slide(os.path.join(tile_server.UPLOAD_FOLDER, SLIDE), 900, 700)
+    tile_server.write_dzi(slide_path, os.path.join(tile_server.OUTPUT_FOLDER, SLIDE + ".dzi"))
+    monkeypatch.setattr(tile_server, "TILE_DISK_CACHE", None)
+    tile_server.tile_cache.discard_where(lambda key: True)
+    tile_server._open_slides.clear()
+    tile_server._open_packs.clear()
+    yield slide_path
+    tile_server.tile_cache.discard_where(lambda key: True)
+    tile_server._open_slides.clear()
+    tile_server._open_packs.clear()
+
+
+def tile_url(level, col, row, tile_format=tiler.TILE_FORMAT):
+    return f"{SLIDE}_files/{level}/{col}_{row}.{tile_format}"
+
+
+def rendered(slide_path, level, col, row, tile_size=tiler.TILE_SIZE, overlap=tiler.TILE_OVERLAP):
+    buffer = io.BytesIO()
+    tiler.save_tile(tile_server.get_generator(slide_path, tile_size, overlap).get_tile(level, (col, row)), buffer)
+    return buffer.getvalue()
+
+
+def no_rendering(*args, **kwargs):
+    raise AssertionError("The tile was rendered again")
+
+
+def test_tile_is_rendered_then_served_from_memory(slide, monkeypatch):
+    top = tile_server.get_generator(slide).level_count - 1
+    data, mimetype = tile_server.get_tile(tile_url(top, 1, 2))
+    assert mimetype == tiler.TILE_FORMATS[tiler.TILE_FORMAT]
+    assert data == rendered(slide, top, 1, 2)
+
+    monkeypatch.setattr(tile_server, "get_generator", no_rendering)
+    assert tile_server.get_tile(tile_url(top, 1, 2)) == (data, mimetype)
+
+
+def test_tile_is_served_from_the_disk_cache(slide, tmp_path, monkeypatch):
+    monkeypatch.setattr(tile_server, "TILE_DISK_CACHE", str(tmp_path / "tile_cache"))
+    data, _ = tile_server.get_tile(tile_url(9, 0, 0))
+    with open(tmp_path / "tile_cache" / tile_url(9, 0, 0), "rb") as f:
+        assert f.read() == data
+
+    tile_server.tile_cache.discard_where(lambda key: True)
+    monkeypatch.setattr(tile_server, "get_generator", no_rendering)
+    assert tile_server.get_tile(tile_url(9, 0, 0))[0] == data
+
+
+def test_tile_is_served_from_the_pack(slide, monkeypatch):
+    monkeypatch.setattr(tiler, "PACK_TILES", True)
+    dzi_path = os.path.join(tile_server.OUTPUT_FOLDER, SLIDE + ".dzi")
+    tiler.generate_deepzoom(slide, dzi_path, os.path.join(tile_server.OUTPUT_FOLDER, SLIDE + "_files"), workers=1)
+    top = tile_server.get_generator(slide).level_count - 1
+    pack = tile_server.get_pack(os.path.join(tile_server.OUTPUT_FOLDER, SLIDE + "_files.pack"))
+
+    os.remove(slide)  # A packed pyramid does not need its slide
+    monkeypatch.setattr(tile_server, "get_generator", no_rendering)
+    for level, col, row in [(0, 0, 0), (top, 0, 0), (top, 7, 5)]:
+        data, _ = tile_server.get_tile(tile_url(level, col, row))
+        assert data == pack.get(level, col, row)
+    assert tile_server.get_tile(tile_url(top, 8, 0)) is None
+    assert len(tile_server.tile_cache) == 0
+
+
+def test_tiles_follow_the_settings_of_their_dzi(slide, monkeypatch):
+    dzi_path = os.path.join(tile_server.OUTPUT_FOLDER, SLIDE + ".dzi")
+    with open(dzi_path, "w") as f:
+        f.write(tile_server.get_generator(slide, 256, 1).get_dzi("png"))
+    top = tile_server.get_generator(slide).level_count - 1
+
+    assert tile_server.get_tile(tile_url(top, 0, 0, "jpeg")) is None
+    data, mimetype = tile_server.get_tile(tile_url(top, 0, 0, "png"))
+    assert mimetype == "image/png"
+    with Image.open(io.BytesIO(data)) as tile:
+        assert tile.format == "PNG"
+        assert tile.size == (257, 257)
+
+
+@pytest.mark.parametrize("path", [
+    "slide.tif_files/99/0_0.jpeg",  # Level past the pyramid
+    "slide.tif_files/10/50_0.jpeg",  # Column past the level
+    "other.tif_files/10/0_0.jpeg",  # No such slide
+    "../slide.tif_files/10/0_0.jpeg",
+    "slide.tif_files/10/0_0",
+    "slide.tif.dzi",
+])
+def test_tiles_that_do_not_exist(slide, path):
+    assert tile_server.get_tile(path) is None
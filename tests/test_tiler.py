@@ -0,0 +1,129 @@
+import io
+import os
+
+import numpy as np
+import openslide
+import pytest
+from openslide.deepzoom import DeepZoomGenerator
+from PIL import Image
+
+import tiler
+from benchmarks.synthetic import write_png_slide, write_tiff_slide
+from tile_pack import TilePack, pack_path
+
+SIZES = [(3001, 2049), (3072, 2048), (1025, 130)]
+
+
+def pyramid_tiles(tiles_path):
+    """
+    Opens the tiles of a finished pyramid as open_tile(level, col, row), from its directory or its pack.
+    """
+    if os.path.exists(pack_path(tiles_path)):
+        pack = TilePack(pack_path(tiles_path))
+        return lambda level, col, row: Image.open(io.BytesIO(pack.get(level, col, row)))
+    return lambda level, col, row: Image.open(os.path.join(tiles_path, str(level), f"{col}_{row}.{tiler.TILE_FORMAT}"))
+
+
+def deepzoom_tile_size(generator, level, col, row):
+    """
+    Size DeepZoomGenerator gives a tile. get_tile reads it from the slide level
+    closest in resolution and may lose a pixel to rounding there (or when
+    thumbnail() keeps the aspect ratio), so below full resolution this is the
+    tile size it computes, clamped to the level as its reads are.
+    """
+    _, (width, height) = generator._get_tile_info(level, (col, row))
+    x, y = col * generator._z_t_downsample, row * generator._z_t_downsample
+    overlap = generator._z_overlap
+    level_width, level_height = generator.level_dimensions[level]
+    return (min(width, level_width - x + (overlap if col else 0)),
+            min(height, level_height - y + (overlap if row else 0)))
+
+
+def assert_same_tile_sizes(generator, tiles_path):
+    open_tile = pyramid_tiles(tiles_path)
+    top = generator.level_count - 1
+    for level in range(generator.level_count):
+        cols, rows = generator.level_tiles[level]
+        for col in range(cols):
+            for row in range(rows):
+                with open_tile(level, col, row) as tile:
+                    size = tile.size
+                if level == top:
+                    assert size == generator.get_tile(level, (col, row)).size, (level, col, row)
+                assert size == deepzoom_tile_size(generator, level, col, row), (level, col, row)
+
+
+@pytest.mark.parametrize("pack", [False, True])
+@pytest.mark.parametrize("width,height", SIZES)
+def test_slide_tiles_match_deepzoom_generator(tmp_path, monkeypatch, width, height, pack):
+    monkeypatch.setattr(tiler, "PACK_TILES", pack)
+    slide_path = write_tiff_slide(str(tmp_path / "slide.tif"), width, height)
+    tiles_path = str(tmp_path / "slide_files")
+    tiler.generate_deepzoom(slide_path, str(tmp_path / "slide.dzi"), tiles_path, workers=2)
+
+    with openslide.OpenSlide(slide_path) as slide:
+        generator = tiler.open_generator(slide)
+        assert_same_tile_sizes(generator, tiles_path)
+
+        # Full-resolution tiles only differ from get_tile by their JPEG encoding
+        level = generator.level_count - 1
+        open_tile = pyramid_tiles(tiles_path)
+        for col, row in [(0, 0), (generator.level_tiles[level][0] - 1, generator.level_tiles[level][1] - 1)]:
+            with open_tile(level, col, row) as tile:
+                expected = np.asarray(generator.get_tile(level, (col, row)), dtype=np.int16)
+                assert np.abs(np.asarray(tile, dtype=np.int16) - expected).mean() < 8
+
+
+@pytest.mark.parametrize("pack", [False, True])
+@pytest.mark.parametrize("width,height", SIZES)
+def test_patch_tiles_match_deepzoom_generator(tmp_path, monkeypatch, width, height, pack):
+    monkeypatch.setattr(tiler, "PACK_TILES", pack)
+    monkeypatch.setattr(tiler, "PATCH_STRIP_ROWS", 100)
+    png_path = write_png_slide(str(tmp_path / "patch.png"), width, height)
+    tiles_path = str(tmp_path / "patch_files")
+    with Image.open(png_path) as img:
+        tiler.generate_deepzoom_patch(img, str(tmp_path / "patch.dzi"), tiles_path, workers=2)
+
+    with Image.open(png_path) as img:
+        generator = DeepZoomGenerator(openslide.ImageSlide(img), tile_size=tiler.TILE_SIZE,
+                                      overlap=tiler.TILE_OVERLAP)
+        assert_same_tile_sizes(generator, tiles_path)
+
+
+def png_image(mode, width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, size=(height, width, 4), dtype=np.uint8)
+    # Smooth bands among the noise, so the encoder picks different filters per row
+    pixels[::3] = np.arange(width, dtype=np.uint8)[None, :, None]
+    image = Image.fromarray(pixels, 'RGBA')
+    if mode == 'P':
+        return image.convert('RGB').quantize(64)
+    return image.convert(mode)
+
+
+@pytest.mark.parametrize("mode", ['RGB', 'RGBA', 'L', 'LA', 'P'])
+@pytest.mark.parametrize("strip_rows", [1, 7, 512])
+def test_png_strips_match_pillow(tmp_path, mode, strip_rows):
+    path = str(tmp_path / "patch.png")
+    png_image(mode, 301, 259).save(path, compress_level=6)
+    with Image.open(path) as img:
+        expected = np.asarray(tiler._as_rgb(img))
+
+    strips = tiler._png_strips(path, strip_rows)
+    assert strips is not None
+    strips = list(strips)
+    assert all(len(strip) == strip_rows for strip in strips[:-1])
+    assert np.array_equal(np.concatenate(strips), expected)
+
+
+@pytest.mark.parametrize("save", [
+    lambda path: png_image('P', 97, 61).save(path, transparency=0),
+    lambda path: png_image('L', 97, 61).convert('I;16').save(path),
+])
+def test_other_pngs_are_decoded_whole(tmp_path, save):
+    path = str(tmp_path / "patch.png")
+    save(path)
+    with Image.open(path) as img:
+        expected = np.asarray(tiler._as_rgb(img))
+        strips = list(tiler._patch_strips(img, 16))
+    assert np.array_equal(np.concatenate(strips), expected)
@@ -0,0 +1,114 @@
+import gzip
+
+import numpy as np
+import pytest
+from flask import Flask
+
+from annotation_index import query_spatial_table
+from test_annotation_index import measured_cells, store_file
+from wire import (
+    ALIGNMENT, COORDINATE_QUANTUM, MAGIC, MIMETYPE, annotation_message, binary_response, decode_message,
+    encode_message, hex_bin_message, quantize_coordinates, wants_binary,
+)
+
+
+def test_message_round_trip():
+    arrays = {
+        "bytes": np.arange(5, dtype=np.uint8),
+        "big_endian": np.arange(7, dtype=">u4"),
+        "empty": np.zeros(0, dtype=np.float32),
+        "pairs": np.arange(6, dtype=np.float64).reshape(3, 2) / 3,
+        "signed": np.array([-2 ** 31, 0, 2 ** 31 - 1], dtype=np.int32),
+    }
+    message = encode_message(arrays, kind="test", names=["a", "ü"])
+    assert message[:len(MAGIC)] == MAGIC
+    header, decoded = decode_message(message)
+    assert header == {"kind": "test", "names": ["a", "ü"]}
+    assert list(decoded) == list(arrays)
+    start = len(message) - sum(-(-values.nbytes // ALIGNMENT) * ALIGNMENT for values in arrays.values())
+    assert start % ALIGNMENT == 0
+    for name, values in arrays.items():
+        assert decoded[name].dtype.byteorder in ("<", "|", "=")
+        np.testing.assert_array_equal(decoded[name], values.ravel())
+    with pytest.raises(ValueError):
+        decode_message(b"JSON" + message[len(MAGIC):])
+
+
+def test_whole_pixels_are_sent_exactly():
+    coords = np.array([[100, 250], [-3, 7], [40000, 1]], dtype=np.float32)
+    values, quantization = quantize_coordinates(coords)
+    assert values.dtype == np.int32
+    assert quantization == {"origin": [-3.0, 1.0], "quantum": 1}
+    np.testing.assert_array_equal(np.array(quantization["origin"]) + values * quantization["quantum"], coords)
+
+
+def test_fractional_coordinates_are_within_half_a_quantum():
+    coords = np.random.default_rng(0).uniform(-500, 90000, size=(1000, 2))
+    values, quantization = quantize_coordinates(coords)
+    assert quantization["quantum"] == COORDINATE_QUANTUM
+    restored = np.array(quantization["origin"]) + values * quantization["quantum"]
+    assert np.abs(restored - coords).max() <= COORDINATE_QUANTUM / 2
+
+    values, quantization = quantize_coordinates(np.zeros((0, 2)))
+    assert values.shape == (0, 2)
+
+
+def test_annotation_message_round_trip(mongo_db):
+    table = query_spatial_table(mongo_db, store_file(mongo_db, measured_cells(200)))
+    header, arrays = decode_message(annotation_message({"slide_model.geojson": table}))
+    assert header["kind"] == "annotations"
+    file = header["files"][0]
+    assert file["name"] == "slide_model.geojson"
+    assert file["feature_ids"] == table["feature_ids"]
+    assert file["classes"] == table["classes"]
+    for column in ("feature_types", "feature_classes", "feature_parts", "part_rings", "ring_offsets"):
+        np.testing.assert_array_equal(arrays[f"0/{column}"], table[column])
+    coords = np.array(file["origin"]) + arrays["0/coords"].reshape(-1, 2) * file["quantum"]
+    np.testing.assert_array_equal(coords, table["coords"])
+
+
+def test_hex_bin_message_round_trip():
+    hex_bins = [
+        {"hex_id": "822d57fffffffff", "annotation_count": 3, "image_coordinates": [[0.5, 1.0], [2.0, 3.25], [4.0, 0.0]],
+         "classifications": {"Neoplastic": {"count": 2, "color": [255, 0, 0]}, "Dead": {"count": 1}},
+         "feature_ids": ["a", "b", 7]},
+        {"hex_id": "822d5ffffffffff", "annotation_count": 1, "image_coordinates": [],
+         "classifications": {"Dead": {"count": 1, "color": [1, 2, 3]}}, "feature_ids": ["b"]},
+    ]
+    header, arrays = decode_message(hex_bin_message(hex_bins, resolution=2))
+    assert header["resolution"] == 2
+    assert header["hex_ids"] == [hex_bin["hex_id"] for hex_bin in hex_bins]
+    assert arrays["annotation_counts"].tolist() == [3, 1]
+
+    boundary = arrays["boundary"].reshape(-1, 2)
+    class_offsets, feature_offsets, boundary_offsets = (
+        arrays["class_offsets"], arrays["feature_offsets"], arrays["boundary_offsets"],
+    )
+    for index, hex_bin in enumerate(hex_bins):
+        assert boundary[boundary_offsets[index]:boundary_offsets[index + 1]].tolist() == hex_bin["image_coordinates"]
+        classes = range(class_offsets[index], class_offsets[index + 1])
+        assert {header["class_names"][arrays["class_ids"][i]]: int(arrays["class_counts"][i]) for i in classes} == {
+            name: classification["count"] for name, classification in hex_bin["classifications"].items()
+        }
+        features = arrays["features"][feature_offsets[index]:feature_offsets[index + 1]]
+        assert [header["feature_ids"][feature] for feature in features] == hex_bin["feature_ids"]
+    assert arrays["class_colors"].reshape(-1, 3).tolist() == [[255, 0, 0], [0, 0, 0], [1, 2, 3]]
+
+
+def test_binary_responses():
+    app = Flask(__name__)
+    with app.test_request_context("/", headers={"Accept": MIMETYPE, "Accept-Encoding": "gzip"}):
+        assert wants_binary()
+        message = encode_message({"values": np.arange(1000, dtype=np.uint32)})
+        response = binary_response(message)
+        assert response.mimetype == MIMETYPE
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.get_data()) == message
+        assert {"Accept", "Accept-Encoding"} <= set(response.vary)
+    with app.test_request_context("/?format=binary"):
+        assert wants_binary()
+        response = binary_response(encode_message({}))
+        assert "Content-Encoding" not in response.headers
+    with app.test_request_context("/", headers={"Accept": "application/json"}):
+        assert not wants_binary()
+        assert wants_binary({"format": "binary"})
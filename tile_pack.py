@@ -0,0 +1,218 @@
+"""
+Single-file tile packs: every tile of a DeepZoom pyramid in one file.
+
+A pack, <slide>_files.pack, replaces the <slide>_files directory and its one
+file per tile. Its layout is:
+
+    magic
+    records: a (level, col, row, length) header and the tile bytes, in any order
+    index: per level, cols * rows (offset, length) entries in row-major order,
+           length 0 for a tile that is missing
+    footer: (cols, rows) per level, index offset, level count, index magic
+
+TilePackWriter appends records to <pack>.partial while a pyramid is built. The
+record headers let an interrupted build rebuild its index by scanning the
+file. finish() writes the index and the footer and renames the file, so a pack
+only exists once it is complete. TilePack maps a pack into memory, and reading
+a tile takes one lookup in the index.
+
+    python tile_pack.py output/<slide>_files [--remove]
+
+packs an existing directory of tiles, and removes the directory with --remove.
+"""
+import argparse
+import mmap
+import os
+import re
+import shutil
+import struct
+
+PACK_SUFFIX = '.pack'
+MAGIC = b'DZPACK1\0'
+INDEX_MAGIC = b'DZINDEX\0'
+RECORD = struct.Struct('>IIII')  # level, col, row, length
+ENTRY = struct.Struct('>QI')  # offset, length
+LEVEL = struct.Struct('>II')  # cols, rows
+FOOTER = struct.Struct('>QI8s')  # index offset, level count, magic
+TILE_NAME = re.compile(r'^(\d+)_(\d+)\.\w+$')
+
+
+def pack_path(tiles_path):
+    return tiles_path.rstrip('/\\') + PACK_SUFFIX
+
+
+class TilePackWriter:
+    """
+    Appends tiles to the partial file of a pack. With resume, the tiles of an
+    earlier, interrupted writer of the same pack are kept.
+    """
+
+    def __init__(self, path, level_tiles, resume=False):
+        self.path = path
+        self.partial_path = path + '.partial'
+        self.level_tiles = [tuple(tiles) for tiles in level_tiles]
+        self.index = {}  # (level, col, row) -> (offset, length)
+        self.resumed = resume and os.path.exists(self.partial_path)
+        self._file = open(self.partial_path, 'r+b' if self.resumed else 'w+b')
+        self._end = self._scan() if self.resumed else 0
+        if not self._end:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(MAGIC)
+            self._end = len(MAGIC)
+
+    def _scan(self):
+        f = self._file
+        size = os.fstat(f.fileno()).st_size
+        if f.read(len(MAGIC)) != MAGIC:
+            return 0
+        end = len(MAGIC)
+        while end + RECORD.size <= size:
+            f.seek(end)
+            level, col, row, length = RECORD.unpack(f.read(RECORD.size))
+            if end + RECORD.size + length > size:
+                break
+            # A tile written twice (a block redone after an interruption) is read from its last copy
+            self.index[(level, col, row)] = (end + RECORD.size, length)
+            end += RECORD.size + length
+        f.seek(end)
+        f.truncate()  # Drops a record torn by the interruption
+        return end
+
+    def add(self, level, col, row, data):
+        self._file.write(RECORD.pack(level, col, row, len(data)))
+        self._file.write(data)
+        self.index[(level, col, row)] = (self._end + RECORD.size, len(data))
+        self._end += RECORD.size + len(data)
+
+    def add_many(self, tiles):
+        for level, col, row, data in tiles:
+            self.add(level, col, row, data)
+
+    def flush(self):
+        self._file.flush()
+
+    def finish(self):
+        """
+        Writes the index and the footer and moves the pack into place.
+        """
+        f = self._file
+        index_offset = self._end
+        for level, (cols, rows) in enumerate(self.level_tiles):
+            entries = bytearray(ENTRY.size * cols * rows)
+            for row in range(rows):
+                for col in range(cols):
+                    entry = self.index.get((level, col, row))
+                    if entry is not None:
+                        ENTRY.pack_into(entries, (row * cols + col) * ENTRY.size, *entry)
+            f.write(entries)
+        for cols, rows in self.level_tiles:
+            f.write(LEVEL.pack(cols, rows))
+        f.write(FOOTER.pack(index_offset, len(self.level_tiles), INDEX_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(self.partial_path, self.path)
+
+    def close(self):
+        """
+        Closes the partial file without finishing it, so a later writer can resume.
+        """
+        if not self._file.closed:
+            self._file.close()
+
+
+def read_partial_tile(f, offset, length):
+    """
+    Reads a tile from the partial file of a pack being written, opened as f.
+    """
+    f.seek(offset)
+    return f.read(length)
+
+
+class TilePack:
+    """
+    A finished pack, mapped into memory.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self._map)
+        index_offset, level_count, magic = FOOTER.unpack_from(self._map, size - FOOTER.size)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a finished tile pack")
+        levels_offset = size - FOOTER.size - LEVEL.size * level_count
+        self.level_tiles = [LEVEL.unpack_from(self._map, levels_offset + i * LEVEL.size) for i in range(level_count)]
+        self._level_offsets = []
+        for cols, rows in self.level_tiles:
+            self._level_offsets.append(index_offset)
+            index_offset += cols * rows * ENTRY.size
+
+    def get(self, level, col, row):
+        """
+        The bytes of a tile, or None when the pack has no such tile.
+        """
+        if level >= len(self.level_tiles):
+            return None
+        cols, rows = self.level_tiles[level]
+        if col >= cols or row >= rows:
+            return None
+        offset, length = ENTRY.unpack_from(self._map, self._level_offsets[level] + (row * cols + col) * ENTRY.size)
+        if not length:
+            return None
+        return self._map[offset:offset + length]
+
+    def tile_count(self):
+        return sum(
+            1
+            for level, (cols, rows) in enumerate(self.level_tiles)
+            for i in range(cols * rows)
+            if ENTRY.unpack_from(self._map, self._level_offsets[level] + i * ENTRY.size)[1]
+        )
+
+    def close(self):
+        self._map.close()
+
+
+def pack_directory(tiles_path):
+    """
+    Packs the tiles of an existing pyramid directory. Returns the pack path and the tile count.
+    """
+    levels = {}
+    for entry in os.scandir(tiles_path):
+        if entry.is_dir() and entry.name.isdigit():
+            levels[int(entry.name)] = [
+                (int(match.group(1)), int(match.group(2)), name)
+                for name in os.listdir(entry.path)
+                for match in [TILE_NAME.match(name)]
+                if match
+            ]
+    level_tiles = [
+        (max((col for col, _, _ in levels.get(level, [])), default=-1) + 1,
+         max((row for _, row, _ in levels.get(level, [])), default=-1) + 1)
+        for level in range(max(levels, default=-1) + 1)
+    ]
+    writer = TilePackWriter(pack_path(tiles_path), level_tiles)
+    try:
+        for level, tiles in sorted(levels.items()):
+            for col, row, name in tiles:
+                with open(os.path.join(tiles_path, str(level), name), 'rb') as f:
+                    writer.add(level, col, row, f.read())
+        writer.finish()
+    finally:
+        writer.close()
+    return writer.path, len(writer.index)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack the tiles of a DeepZoom pyramid directory into one file.")
+    parser.add_argument("tiles_path", help="The <slide>_files directory")
+    parser.add_argument("--remove", action="store_true", help="Remove the directory once the pack is written")
+    args = parser.parse_args()
+
+    path, count = pack_directory(args.tiles_path)
+    print(f"Packed {count} tiles into {path}")
+    if args.remove:
+        shutil.rmtree(args.tiles_path)
+        print(f"Removed {args.tiles_path}")
@@ -0,0 +1,238 @@
+"""
+On-demand DeepZoom tile rendering.
+
+Tiles are rendered from the uploaded slide the first time they are requested
+and kept as encoded bytes in a bounded in-memory LRU. When TILE_DISK_CACHE is
+set, rendered tiles are also written there and served from disk after the
+in-memory copy is evicted. Open slides are kept in a small pool so a pan does
+not reopen the slide for every tile.
+
+Pregenerated pyramids written as a tile pack (PACK_TILES) are answered from
+the pack, which is mapped into memory once and kept in a pool like the slides.
+
+Tiles of a slide are rendered with the tile size, overlap and format of its
+.dzi, so slides converted before the tile settings changed keep their pyramid.
+The URL of a tile therefore always names the same content, and app.py sends
+tiles as immutable (TILE_CACHE_CONTROL) with an ETag.
+"""
+import hashlib
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import openslide
+from werkzeug.security import safe_join
+
+from cache import ByteLRUCache
+from metrics import log_event, phase, register_cache
+from tile_pack import TilePack, pack_path
+from tiler import (
+    TILE_FORMAT, TILE_FORMATS, TILE_OVERLAP, TILE_SIZE, generate_deepzoom, open_generator, pyramid_complete, save_tile,
+)
+
+UPLOAD_FOLDER = 'uploads'
+OUTPUT_FOLDER = 'output'
+PREGENERATE_TILES = os.getenv("PREGENERATE_TILES", "0") == "1"
+TILE_CACHE_BYTES = int(os.getenv("TILE_CACHE_MB", "256")) * 1024 * 1024
+TILE_DISK_CACHE = os.getenv("TILE_DISK_CACHE")
+MAX_OPEN_SLIDES = int(os.getenv("MAX_OPEN_SLIDES", "16"))
+TILE_CACHE_CONTROL = f"public, max-age={int(os.getenv('TILE_MAX_AGE', '31536000'))}, immutable"
+
+TILE_PATH = re.compile(r'^(?P<name>.+)_files/(?P<level>\d+)/(?P<col>\d+)_(?P<row>\d+)\.(?P<format>\w+)$')
+DZI_SETTINGS = re.compile(r'TileSize="(?P<tile_size>\d+)"|Overlap="(?P<overlap>\d+)"|Format="(?P<format>\w+)"')
+
+_open_slides = OrderedDict()
+_open_slides_lock = threading.Lock()
+_open_packs = OrderedDict()  # pack path -> (mtime, TilePack)
+_open_packs_lock = threading.Lock()
+tile_cache = ByteLRUCache(TILE_CACHE_BYTES)
+register_cache("image_tiles", tile_cache)
+
+
+def get_generator(slide_path, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """
+    Returns the DeepZoomGenerator of a slide from the pool, opening the slide if needed.
+    """
+    key = (slide_path, tile_size, overlap)
+    with _open_slides_lock:
+        generator = _open_slides.get(key)
+        if generator is not None:
+            _open_slides.move_to_end(key)
+            return generator
+
+    generator = open_generator(openslide.open_slide(slide_path), tile_size, overlap)
+    with _open_slides_lock:
+        _open_slides[key] = generator
+        while len(_open_slides) > MAX_OPEN_SLIDES:
+            # Evicted slides are not closed here since another request may still be
+            # reading from them; the handle is released once the last reference goes.
+            _open_slides.popitem(last=False)
+    return generator
+
+
+def dzi_settings(dzi_path):
+    """
+    (tile_size, overlap, format) of the pyramid described by a .dzi, or the
+    current tile settings when there is no descriptor.
+    """
+    try:
+        mtime = os.stat(dzi_path).st_mtime_ns
+    except OSError:
+        return TILE_SIZE, TILE_OVERLAP, TILE_FORMAT
+    return _read_dzi_settings(dzi_path, mtime)
+
+
+@lru_cache(maxsize=1024)
+def _read_dzi_settings(dzi_path, mtime):
+    settings = {"tile_size": TILE_SIZE, "overlap": TILE_OVERLAP, "format": TILE_FORMAT}
+    with open(dzi_path) as f:
+        for match in DZI_SETTINGS.finditer(f.read()):
+            settings.update((key, value) for key, value in match.groupdict().items() if value is not None)
+    return int(settings["tile_size"]), int(settings["overlap"]), settings["format"]
+
+
+def slide_mpp(slide_path):
+    """
+    Microns per pixel of a slide (the mean of its x and y resolution), or None
+    when the slide does not record it.
+    """
+    try:
+        mtime = os.stat(slide_path).st_mtime_ns
+    except OSError:
+        return None
+    return _read_slide_mpp(slide_path, mtime)
+
+
+@lru_cache(maxsize=1024)
+def _read_slide_mpp(slide_path, mtime):
+    try:
+        slide = openslide.open_slide(slide_path)
+    except (openslide.OpenSlideError, OSError, ValueError):
+        return None
+    try:
+        mpp = [slide.properties.get(name) for name in (openslide.PROPERTY_NAME_MPP_X, openslide.PROPERTY_NAME_MPP_Y)]
+    finally:
+        slide.close()
+    try:
+        mpp = [float(value) for value in mpp if value]
+    except ValueError:
+        return None
+    return sum(mpp) / len(mpp) if mpp else None
+
+
+def tile_etag(data):
+    """
+    Strong ETag (unquoted) of a tile's bytes.
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+def get_pack(path):
+    """
+    Returns the TilePack at path from the pool, or None if there is none. A
+    pack replaced by a new build is mapped again.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    with _open_packs_lock:
+        entry = _open_packs.get(path)
+        if entry is not None and entry[0] == mtime:
+            _open_packs.move_to_end(path)
+            return entry[1]
+
+    pack = TilePack(path)
+    with _open_packs_lock:
+        _open_packs[path] = (mtime, pack)
+        while len(_open_packs) > MAX_OPEN_SLIDES:
+            # Like slides, evicted packs are unmapped once the last reference goes
+            _open_packs.popitem(last=False)
+    return pack
+
+
+def write_dzi(slide_path, dzi_path):
+    """
+    Writes only the .dzi descriptor of a slide; its tiles are rendered when first requested.
+    """
+    generator = get_generator(slide_path)
+    with open(dzi_path, 'w') as f:
+        f.write(generator.get_dzi(TILE_FORMAT))
+    log_event("dzi_written", slide=slide_path, dzi=dzi_path)
+
+
+def convert_slide(file_path, dzi_path, tiles_path, progress=None, workers=None):
+    """
+    Writes the .dzi descriptor and leaves tile rendering to the tile server,
+    or builds the whole pyramid up front when PREGENERATE_TILES is set.
+    """
+    if PREGENERATE_TILES:
+        generate_deepzoom(file_path, dzi_path, tiles_path, workers=workers, progress=progress)
+    else:
+        write_dzi(file_path, dzi_path)
+
+
+def slide_converted(dzi_path, tiles_path):
+    if PREGENERATE_TILES:
+        return pyramid_complete(dzi_path, tiles_path)
+    return os.path.exists(dzi_path)
+
+
+def get_tile(filename):
+    """
+    Returns (tile_bytes, mimetype) for a DeepZoom tile path such as
+    'slide.svs_files/12/3_4.jpeg', or None if it is not a renderable tile.
+    """
+    match = TILE_PATH.match(filename)
+    dzi_path = safe_join(OUTPUT_FOLDER, match.group('name') + '.dzi') if match else None
+    if dzi_path is None:
+        return None
+    tile_size, overlap, tile_format = dzi_settings(dzi_path)
+    if match.group('format') != tile_format or tile_format not in TILE_FORMATS:
+        return None
+    mimetype = TILE_FORMATS[tile_format]
+    level, col, row = (int(match.group(key)) for key in ('level', 'col', 'row'))
+
+    pack = get_pack(pack_path(dzi_path[:-len('.dzi')] + '_files'))
+    if pack is not None:
+        data = pack.get(level, col, row)
+        return (data, mimetype) if data is not None else None
+
+    slide_path = safe_join(UPLOAD_FOLDER, match.group('name'))
+    if slide_path is None or not os.path.isfile(slide_path):
+        return None
+
+    data = tile_cache.get(filename)
+    if data is not None:
+        return data, mimetype
+
+    disk_path = safe_join(TILE_DISK_CACHE, filename) if TILE_DISK_CACHE else None
+    if disk_path and os.path.isfile(disk_path):
+        with open(disk_path, 'rb') as f:
+            data = f.read()
+    else:
+        with phase("render"):
+            try:
+                tile = get_generator(slide_path, tile_size, overlap).get_tile(level, (col, row))
+            except ValueError:
+                return None  # Level or address outside the pyramid
+            buffer = io.BytesIO()
+            save_tile(tile, buffer, tile_format)
+            data = buffer.getvalue()
+        if disk_path:
+            _write_disk_tile(disk_path, data)
+
+    tile_cache.put(filename, data)
+    return data, mimetype
+
+
+def _write_disk_tile(disk_path, data):
+    os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+    # Write then rename so concurrent readers never see a partial tile
+    temp_path = f"{disk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, disk_path)
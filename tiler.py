@@ -0,0 +1,601 @@
+"""
+Parallel, resumable DeepZoom pyramid generation for OpenSlide slides.
+
+The pyramid is built in rounds of BLOCK_LEVELS levels. In the first round each
+worker reads one block of the slide at full resolution (with enough margin for
+the tile overlap) and writes the tiles of that block for the top level and the
+BLOCK_LEVELS levels below it by halving the block in memory. Every later round
+stitches its source pixels from the tiles written by the previous round instead
+of reading the slide again. Workers keep their own OpenSlide handle.
+
+Finished blocks are appended to a journal inside the tiles directory, so an
+interrupted run resumes where it stopped. The .dzi descriptor is only written
+once every tile exists and the journal is removed after that.
+
+With PACK_TILES=1 the tiles go into a single tile_pack file per pyramid instead
+of a directory: workers return their encoded tiles and the parent appends
+them, then journals the block. Later rounds read their source tiles from the
+partial pack.
+
+PNG patches (generate_deepzoom_patch) have no slide to read regions from and
+are tiled in one streaming pass instead: strips of the image go down the
+pyramid level by level, and tiles are encoded by a thread pool.
+"""
+import io
+import math
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+import openslide
+from dotenv import load_dotenv
+from openslide.deepzoom import DeepZoomGenerator
+from PIL import Image
+
+from metrics import TILES_WRITTEN, RateLimitedLog, log_event
+from tile_pack import TilePackWriter, pack_path, read_partial_tile
+
+load_dotenv()
+
+# Per-deployment tile settings; a pyramid keeps those in its .dzi (see tile_server.dzi_settings)
+TILE_SIZE = int(os.getenv("TILE_SIZE", "128"))
+TILE_OVERLAP = int(os.getenv("TILE_OVERLAP", "2"))
+LIMIT_BOUNDS = True
+TILE_FORMAT = os.getenv("TILE_FORMAT", "jpeg").lower()
+TILE_QUALITY = int(os.getenv("TILE_QUALITY", "75"))  # JPEG and WebP quality, 1-100
+TILE_FORMATS = {'jpeg': 'image/jpeg', 'webp': 'image/webp', 'png': 'image/png'}
+if TILE_FORMAT not in TILE_FORMATS:
+    raise ValueError(f"TILE_FORMAT must be one of {', '.join(TILE_FORMATS)}, not {TILE_FORMAT!r}")
+BLOCK_LEVELS = 4  # A block spans 2**BLOCK_LEVELS x 2**BLOCK_LEVELS tiles of its source level
+# Tiling processes (or threads for a patch) per pyramid, so the INGEST_WORKERS jobs (see jobs.py) at once share the CPUs
+TILE_WORKERS = int(os.getenv("TILE_WORKERS", max((os.cpu_count() or 1) // int(os.getenv("INGEST_WORKERS", "2")), 1)))
+PACK_TILES = os.getenv("PACK_TILES", "0") == "1"  # Write pyramids as one tile_pack file instead of a directory
+JOURNAL_NAME = '.progress'
+PROGRESS_LOG_SECONDS = 5  # Least time between two progress log lines of one pyramid
+PATCH_STRIP_ROWS = 512  # Rows of a patch decoded at a time
+COPY_BUFFER = 1024 * 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}  # Samples per pixel of each PNG color type
+
+_worker_slide = None
+_worker_generator = None
+
+
+def open_generator(slide, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    return DeepZoomGenerator(slide, tile_size=tile_size, overlap=overlap, limit_bounds=LIMIT_BOUNDS)
+
+
+def save_tile(tile, fp, tile_format=TILE_FORMAT, quality=TILE_QUALITY):
+    """
+    Encodes a tile image to a path or file object.
+    """
+    tile.save(fp, format=tile_format, quality=quality)
+
+
+def pyramid_complete(dzi_path, tiles_path):
+    """
+    A pyramid is complete once its descriptor exists and either its pack was
+    finished or its tiles directory has no journal left behind.
+    """
+    if not os.path.exists(dzi_path):
+        return False
+    if os.path.exists(pack_path(tiles_path)):
+        return True
+    return os.path.exists(tiles_path) and not os.path.exists(os.path.join(tiles_path, JOURNAL_NAME))
+
+
+def generate_deepzoom(slide_path, dzi_path, tiles_path, workers=None, progress=None):
+    """
+    Builds the DeepZoom pyramid of a slide with a pool of worker processes.
+    progress, if given, is called as progress(tiles_done, tiles_total) after every block.
+    """
+    started = time.perf_counter()
+    slide = openslide.OpenSlide(slide_path)
+    generator = open_generator(slide)
+    top_level = generator.level_count - 1
+    total_tiles = generator.tile_count
+    progress_log = RateLimitedLog(PROGRESS_LOG_SECONDS)
+
+    # A pack keeps its journal next to its partial file, so switching PACK_TILES never mixes the two layouts
+    pack = None
+    if PACK_TILES:
+        journal_path = pack_path(tiles_path) + JOURNAL_NAME
+        finished = _read_journal(journal_path)
+        pack = TilePackWriter(pack_path(tiles_path), generator.level_tiles, resume=bool(finished))
+        if not pack.resumed:
+            finished = {}
+    else:
+        os.makedirs(tiles_path, exist_ok=True)
+        journal_path = os.path.join(tiles_path, JOURNAL_NAME)
+        finished = _read_journal(journal_path)
+    if finished:
+        log_event("deepzoom_resume", slide=slide_path, blocks_done=len(finished))
+
+    # The first round also writes its source (top) level, later rounds start one level below theirs
+    rounds = [(top_level, 0)]
+    source_level = top_level - BLOCK_LEVELS
+    while source_level > 0:
+        rounds.append((source_level, 1))
+        source_level -= BLOCK_LEVELS
+
+    tiles_done = sum(count for count in finished.values())
+    workers = workers or TILE_WORKERS
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(slide_path,)) as pool, \
+            open(journal_path, 'a' if finished else 'w') as journal:
+        for source_level, first_depth in rounds:
+            width, height = generator.level_dimensions[source_level]
+            span = TILE_SIZE << BLOCK_LEVELS
+            blocks = [
+                (bx, by)
+                for bx in range(int(math.ceil(width / span)))
+                for by in range(int(math.ceil(height / span)))
+                if (source_level, bx, by) not in finished
+            ]
+            futures = [
+                pool.submit(_render_block, tiles_path, source_level, first_depth, bx, by,
+                            _pack_source(pack, generator, source_level, first_depth, bx, by))
+                for bx, by in blocks
+            ]
+            try:
+                for future in as_completed(futures):
+                    level, bx, by, written, tiles = future.result()
+                    if pack:
+                        # Tiles are in the pack before their block is journaled as finished
+                        pack.add_many(tiles)
+                        pack.flush()
+                    journal.write(f"{level} {bx} {by} {written}\n")
+                    journal.flush()
+                    tiles_done += written
+                    TILES_WRITTEN.inc(written)
+                    progress_log.log("deepzoom_progress", slide=slide_path, level=level, tiles_done=tiles_done,
+                                     tiles_total=total_tiles)
+                    if progress:
+                        progress(tiles_done, total_tiles)
+            except BaseException:
+                # Drop the queued blocks so an abort (or a cancelled job) does not wait for the whole level
+                pool.shutdown(wait=True, cancel_futures=True)
+                if pack:
+                    pack.close()
+                raise
+            progress_log.log("deepzoom_round", force=True, slide=slide_path, source_level=source_level,
+                             tiles_done=tiles_done, tiles_total=total_tiles)
+
+    if pack:
+        pack.finish()
+    with open(dzi_path, 'w') as f:
+        f.write(generator.get_dzi(TILE_FORMAT))
+    os.remove(journal_path)
+    slide.close()
+
+    elapsed = time.perf_counter() - started
+    log_event("deepzoom_done", slide=slide_path, dzi=dzi_path, tiles=total_tiles, seconds=round(elapsed, 3),
+              tiles_per_sec=round(total_tiles / max(elapsed, 1e-9), 1))
+
+
+def _read_journal(journal_path):
+    finished = {}
+    if not os.path.exists(journal_path):
+        return finished
+    with open(journal_path) as journal:
+        for line in journal:
+            fields = line.split()
+            # A torn last line from an interrupted write is simply redone
+            if len(fields) == 4:
+                level, bx, by, written = (int(field) for field in fields)
+                finished[(level, bx, by)] = written
+    return finished
+
+
+def _pack_source(pack, generator, source_level, first_depth, bx, by):
+    """
+    What a block needs to render into a pack: the partial file and the
+    (offset, length) of the tiles it stitches its source region from.
+    """
+    if pack is None:
+        return None
+    if first_depth == 0:
+        return pack.partial_path, {}
+    x0, y0, x1, y1 = _block_bounds(generator, source_level, bx, by)
+    return pack.partial_path, {
+        (col, row): pack.index[(source_level, col, row)]
+        for col in range(x0 // TILE_SIZE, (x1 - 1) // TILE_SIZE + 1)
+        for row in range(y0 // TILE_SIZE, (y1 - 1) // TILE_SIZE + 1)
+    }
+
+
+def _init_worker(slide_path):
+    global _worker_slide, _worker_generator
+    _worker_slide = openslide.OpenSlide(slide_path)
+    _worker_generator = open_generator(_worker_slide)
+
+
+def _block_bounds(generator, source_level, bx, by):
+    """
+    The pixel box of a block within its source level, margin for the tile overlap included.
+    """
+    width, height = generator.level_dimensions[source_level]
+    span = TILE_SIZE << BLOCK_LEVELS
+    margin = TILE_OVERLAP << BLOCK_LEVELS
+
+    # Both ends stay divisible by 2**BLOCK_LEVELS unless clamped to the level edge,
+    # so every halving below maps the block exactly onto the lower level grid.
+    return (
+        max(bx * span - margin, 0),
+        max(by * span - margin, 0),
+        min((bx + 1) * span + margin, width),
+        min((by + 1) * span + margin, height),
+    )
+
+
+def _render_block(tiles_path, source_level, first_depth, bx, by, pack_source=None):
+    """
+    Writes every tile of one block for the levels source_level - first_depth
+    down to source_level - BLOCK_LEVELS, halving the block in memory per level.
+    With a pack_source the tiles are returned encoded instead, for the parent
+    to append to the pack, and the source region is read from the pack.
+    """
+    generator = _worker_generator
+    x0, y0, x1, y1 = _block_bounds(generator, source_level, bx, by)
+
+    if source_level == generator.level_count - 1:
+        region = _read_slide_region(x0, y0, x1 - x0, y1 - y0)
+    elif pack_source is None:
+        level_dir = os.path.join(tiles_path, str(source_level))
+        region = _stitch_level_region(
+            source_level, x0, y0, x1, y1, lambda col, row: os.path.join(level_dir, f'{col}_{row}.{TILE_FORMAT}'),
+        )
+    else:
+        partial_path, entries = pack_source
+        with open(partial_path, 'rb') as f:
+            region = _stitch_level_region(
+                source_level, x0, y0, x1, y1,
+                lambda col, row: io.BytesIO(read_partial_tile(f, *entries[(col, row)])),
+            )
+
+    written = 0
+    packed = []
+    for depth in range(BLOCK_LEVELS + 1):
+        level = source_level - depth
+        if level < 0:
+            break
+        if depth > 0:
+            region = region.reduce(2)
+        if depth < first_depth:
+            continue
+
+        level_width, level_height = generator.level_dimensions[level]
+        cols, rows = generator.level_tiles[level]
+        origin_x, origin_y = x0 >> depth, y0 >> depth
+        per_block = 1 << (BLOCK_LEVELS - depth)
+
+        level_dir = os.path.join(tiles_path, str(level))
+        if pack_source is None:
+            os.makedirs(level_dir, exist_ok=True)
+        for col in range(bx * per_block, min((bx + 1) * per_block, cols)):
+            for row in range(by * per_block, min((by + 1) * per_block, rows)):
+                left, upper, right, lower = tile_box(col, row, cols, rows, level_width, level_height)
+                tile = region.crop((left - origin_x, upper - origin_y, right - origin_x, lower - origin_y))
+                if pack_source is None:
+                    save_tile(tile, os.path.join(level_dir, f'{col}_{row}.{TILE_FORMAT}'))
+                else:
+                    buffer = io.BytesIO()
+                    save_tile(tile, buffer)
+                    packed.append((level, col, row, buffer.getvalue()))
+                written += 1
+
+    return source_level, bx, by, written, packed
+
+
+def tile_box(col, row, cols, rows, level_width, level_height):
+    """
+    Returns the DeepZoom pixel box of a tile within its level, overlap included.
+    Like DeepZoomGenerator it is clamped to the level, even where a narrow last
+    tile is thinner than the overlap.
+    """
+    left = col * TILE_SIZE - (TILE_OVERLAP if col > 0 else 0)
+    upper = row * TILE_SIZE - (TILE_OVERLAP if row > 0 else 0)
+    right = min((col + 1) * TILE_SIZE + (TILE_OVERLAP if col < cols - 1 else 0), level_width)
+    lower = min((row + 1) * TILE_SIZE + (TILE_OVERLAP if row < rows - 1 else 0), level_height)
+    return left, upper, right, lower
+
+
+def _read_slide_region(x, y, width, height):
+    # Tile (0, 0) of the top level has no leading overlap, so its level-0 location is the bounds offset
+    (offset_x, offset_y), _, _ = _worker_generator.get_tile_coordinates(_worker_generator.level_count - 1, (0, 0))
+    region = _worker_slide.read_region((offset_x + x, offset_y + y), 0, (width, height))
+    background = '#' + _worker_slide.properties.get(openslide.PROPERTY_NAME_BACKGROUND_COLOR, 'ffffff')
+    return Image.composite(region, Image.new('RGB', region.size, background), region)
+
+
+def _stitch_level_region(level, x0, y0, x1, y1, open_tile):
+    """
+    Pastes a region of a level together from its tiles; open_tile(col, row)
+    returns the path or file object of a tile.
+    """
+    generator = _worker_generator
+    level_width, level_height = generator.level_dimensions[level]
+    region = Image.new('RGB', (x1 - x0, y1 - y0))
+
+    for col in range(x0 // TILE_SIZE, (x1 - 1) // TILE_SIZE + 1):
+        for row in range(y0 // TILE_SIZE, (y1 - 1) // TILE_SIZE + 1):
+            with Image.open(open_tile(col, row)) as tile:
+                # Drop the overlap and paste only the pixels the tile owns
+                skip_x = TILE_OVERLAP if col > 0 else 0
+                skip_y = TILE_OVERLAP if row > 0 else 0
+                core_width = min(TILE_SIZE, level_width - col * TILE_SIZE)
+                core_height = min(TILE_SIZE, level_height - row * TILE_SIZE)
+                core = tile.crop((skip_x, skip_y, skip_x + core_width, skip_y + core_height))
+            region.paste(core, (col * TILE_SIZE - x0, row * TILE_SIZE - y0))
+    return region
+
+
+def generate_deepzoom_patch(img, dzi_path, tiles_path, progress=None, workers=None):
+    """
+    Builds the DeepZoom pyramid of an image patch (a PIL image, usually a PNG
+    opened from disk) in one streaming pass.
+
+    The image is read in strips of PATCH_STRIP_ROWS rows (_patch_strips). Each
+    level keeps only the rows its next tile row needs, and hands its rows to the
+    level below in pairs, halved with Image.reduce like the slide pyramid. Tile
+    rows are cropped and JPEG-encoded by a thread pool, in batches of tiles.
+    progress, if given, is called as progress(tiles_done, tiles_total).
+    """
+    started = time.perf_counter()
+    width, height = img.size
+    top_level = int(math.ceil(math.log(max(width, height), 2)))
+    levels = [
+        _PatchLevel(level, int(math.ceil(width / 2 ** (top_level - level))),
+                    int(math.ceil(height / 2 ** (top_level - level))), None if PACK_TILES else tiles_path)
+        for level in range(top_level + 1)
+    ]
+    pack = TilePackWriter(pack_path(tiles_path), [(level.cols, level.rows) for level in levels]) if PACK_TILES else None
+    total_tiles = sum(level.cols * level.rows for level in levels)
+    progress_log = RateLimitedLog(PROGRESS_LOG_SECONDS)
+    tiles_done = 0
+
+    workers = workers or TILE_WORKERS
+    pending = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def collect(limit):
+            # Bounds the tile rows in flight, so memory does not grow with a slow disk
+            nonlocal tiles_done
+            while len(pending) > limit:
+                written, packed = pending.pop(0).result()
+                if pack:
+                    pack.add_many(packed)
+                tiles_done += written
+                TILES_WRITTEN.inc(written)
+                progress_log.log("deepzoom_progress", dzi=dzi_path, tiles_done=tiles_done, tiles_total=total_tiles)
+                if progress:
+                    progress(tiles_done, total_tiles)
+
+        try:
+            for strip in _patch_strips(img, PATCH_STRIP_ROWS):
+                level, rows = top_level, strip
+                while rows is not None:
+                    for batch in levels[level].add_rows(rows, workers):
+                        pending.append(pool.submit(_write_tiles, *batch))
+                        collect(2 * workers)
+                    rows = levels[level].halve() if level > 0 else None
+                    level -= 1
+            collect(0)
+        except BaseException:
+            pool.shutdown(wait=True, cancel_futures=True)
+            if pack:
+                pack.close()
+            raise
+
+    if pack:
+        pack.finish()
+    # The descriptor goes last, so an interrupted run does not look like a finished pyramid
+    with open(dzi_path, 'w') as f:
+        f.write(
+            f'<?xml version="1.0" encoding="UTF-8"?>\n<Image TileSize="{TILE_SIZE}" Overlap="{TILE_OVERLAP}" '
+            f'Format="{TILE_FORMAT}" xmlns="http://schemas.microsoft.com/deepzoom/2008">\n'
+            f'    <Size Width="{width}" Height="{height}"/>\n</Image>'
+        )
+
+    elapsed = time.perf_counter() - started
+    progress_log.log("deepzoom_done", force=True, dzi=dzi_path, tiles=total_tiles, seconds=round(elapsed, 3),
+                     tiles_per_sec=round(total_tiles / max(elapsed, 1e-9), 1))
+
+
+class _PatchLevel:
+    """
+    The rows of one patch pyramid level that are still needed: those of the
+    next tile row (overlap included) and a row waiting for its pair to be halved.
+    """
+
+    def __init__(self, level, width, height, tiles_path):
+        self.level, self.width, self.height = level, width, height
+        self.cols = int(math.ceil(width / TILE_SIZE))
+        self.rows = int(math.ceil(height / TILE_SIZE))
+        # Without a tiles directory the tiles are encoded for a pack
+        self.level_dir = os.path.join(tiles_path, str(level)) if tiles_path else None
+        self.buffer = np.zeros((0, width, 3), dtype=np.uint8)
+        self.buffer_start = 0  # Level row of buffer[0]
+        self.received = 0
+        self.next_row = 0  # Next tile row to write
+        self.unhalved = []  # Rows not yet passed to the level below
+
+    def add_rows(self, rows, workers):
+        """
+        Appends rows below the received ones and returns the (level, level_dir,
+        tiles) batches of every tile row they complete.
+        """
+        self.buffer = np.concatenate([self.buffer, rows]) if len(self.buffer) else rows
+        self.received += len(rows)
+        self.unhalved.append(rows)
+        batches = []
+        while self.next_row < self.rows:
+            row = self.next_row
+            boxes = [
+                tile_box(col, row, self.cols, self.rows, self.width, self.height) for col in range(self.cols)
+            ]
+            upper, lower = boxes[0][1], boxes[0][3]
+            if self.received < lower:
+                break
+            band = self.buffer[upper - self.buffer_start:lower - self.buffer_start]
+            tiles = [(col, row, band[:, left:right]) for col, (left, _, right, _) in enumerate(boxes)]
+            per_batch = int(math.ceil(len(tiles) / workers))
+            batches += [(self.level, self.level_dir, tiles[i:i + per_batch]) for i in range(0, len(tiles), per_batch)]
+
+            # Keep the rows the next tile row shares with this one as overlap
+            self.next_row += 1
+            keep_from = max(self.next_row * TILE_SIZE - TILE_OVERLAP, 0)
+            self.buffer = self.buffer[keep_from - self.buffer_start:]
+            self.buffer_start = keep_from
+        if batches and self.level_dir:
+            os.makedirs(self.level_dir, exist_ok=True)
+        return batches
+
+    def halve(self):
+        """
+        The received rows halved for the level below, in pairs; an odd last row
+        waits for its pair unless it is the bottom row of the level.
+        """
+        rows = np.concatenate(self.unhalved) if len(self.unhalved) > 1 else self.unhalved[0]
+        self.unhalved = []
+        if self.received < self.height and len(rows) % 2:
+            self.unhalved = [rows[-1:]]
+            rows = rows[:-1]
+        if not len(rows):
+            return None
+        return np.asarray(Image.fromarray(rows).reduce(2))
+
+
+def _write_tiles(level, level_dir, tiles):
+    """
+    Encodes a batch of tiles into level_dir, or without one returns them
+    encoded for a pack. Returns (tiles written, [(level, col, row, bytes)]).
+    """
+    packed = []
+    for col, row, pixels in tiles:
+        if level_dir:
+            save_tile(Image.fromarray(pixels), os.path.join(level_dir, f'{col}_{row}.{TILE_FORMAT}'))
+        else:
+            buffer = io.BytesIO()
+            save_tile(Image.fromarray(pixels), buffer)
+            packed.append((level, col, row, buffer.getvalue()))
+    return len(tiles), packed
+
+
+def _patch_strips(img, strip_rows):
+    """
+    Yields the pixels of an image as RGB arrays of strip_rows rows, top to
+    bottom. An 8-bit, non-interlaced PNG on disk is decoded one strip at a time
+    (_png_strips); anything else is decoded whole first.
+    """
+    path = getattr(img, 'filename', None)
+    if img.format == 'PNG' and path and img.info.get('interlace', 0) == 0:
+        strips = _png_strips(path, strip_rows)
+        if strips is not None:
+            yield from strips
+            return
+    pixels = np.asarray(_as_rgb(img))
+    for y in range(0, pixels.shape[0], strip_rows):
+        yield pixels[y:y + strip_rows]
+
+
+def _as_rgb(image):
+    # Transparent pixels are drawn on white, as the slide background is
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+
+def _png_chunks(f):
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, kind = struct.unpack('>I4s', header)
+        yield kind, length
+        f.seek(4, os.SEEK_CUR)  # CRC
+
+
+def _png_strips(path, strip_rows):
+    """
+    Decodes an 8-bit, non-interlaced PNG in strips, or returns None for other PNGs.
+
+    The compressed image data is inflated as a stream and cut into scanlines.
+    Each strip is decoded by Pillow as a small PNG of its own scanlines, after
+    the last row of the previous strip stored unfiltered: the filters of a
+    strip's first row refer to the row above it.
+    """
+    f = open(path, 'rb')
+    if f.read(8) != PNG_SIGNATURE:
+        f.close()
+        return None
+    header_chunks = []
+    for kind, length in _png_chunks(f):
+        if kind == b'IDAT':
+            break
+        data = f.read(length)
+        if kind in (b'IHDR', b'PLTE'):
+            header_chunks.append((kind, data))
+        elif kind == b'tRNS':
+            header_chunks = []  # Transparency is left to the whole-image path
+            break
+    else:
+        header_chunks = []
+    if not header_chunks or header_chunks[0][0] != b'IHDR':
+        f.close()
+        return None
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', header_chunks[0][1])
+    if bit_depth != 8 or interlace or color_type not in PNG_CHANNELS:
+        f.close()
+        return None
+    return _png_strip_rows(f, length, header_chunks, width, height, color_type, strip_rows)
+
+
+def _png_strip_rows(f, idat_length, header_chunks, width, height, color_type, strip_rows):
+    stride = 1 + width * PNG_CHANNELS[color_type]
+    inflate = zlib.decompressobj()
+    pending = bytearray()
+    previous = None  # Unfiltered bytes of the last row decoded
+    done = 0
+    with f:
+        while done < height:
+            want = min(strip_rows, height - done) * stride
+            while len(pending) < want:
+                # Inflating at most the missing bytes bounds the memory of very compressible images
+                data = inflate.unconsumed_tail
+                if not data:
+                    if idat_length == 0:
+                        f.seek(4, os.SEEK_CUR)  # CRC of the finished chunk
+                        kind, idat_length = next(_png_chunks(f), (None, 0))
+                        if kind != b'IDAT':
+                            raise ValueError(f"{f.name}: image data ends after {done} of {height} rows")
+                    data = f.read(min(idat_length, COPY_BUFFER))
+                    idat_length -= len(data)
+                pending += inflate.decompress(data, want - len(pending))
+            scanlines = bytes(pending[:want])
+            del pending[:want]
+            count = want // stride
+            if previous is not None:
+                scanlines = b'\0' + previous + scanlines
+            strip = _decode_png(header_chunks, width, count + (previous is not None), scanlines)
+            if previous is not None:
+                strip = strip.crop((0, 1, width, count + 1))
+            previous = strip.crop((0, count - 1, width, count)).tobytes()
+            done += count
+            yield np.asarray(_as_rgb(strip))
+
+
+def _decode_png(header_chunks, width, height, scanlines):
+    out = io.BytesIO()
+    out.write(PNG_SIGNATURE)
+    ihdr = struct.pack('>II', width, height) + header_chunks[0][1][8:]
+    for kind, data in [(b'IHDR', ihdr)] + header_chunks[1:] + [(b'IDAT', zlib.compress(scanlines, 0)), (b'IEND', b'')]:
+        out.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+    out.seek(0)
+    image = Image.open(out)
+    image.load()
+    return image
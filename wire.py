@@ -0,0 +1,200 @@
+"""
+Binary wire format for annotation and hexbin responses.
+
+A message is the 4-byte MAGIC, the byte length of a JSON header as a
+little-endian uint32, the header itself (padded with spaces so the arrays that
+follow start at an 8-byte boundary), then the arrays, each starting at an
+8-byte boundary. The header's "arrays" entry maps every array name to its
+dtype (NumPy typestr, little-endian), byte offset from the end of the
+header and element count, so the browser takes typed-array views of the
+response without parsing or copying. Everything else in the header (names,
+feature ids, class dictionaries, quantization) is plain JSON.
+
+Coordinates are sent as int32 steps of a quantum from an origin (see
+quantize_coordinates). Responses are gzipped when the client accepts it.
+Clients ask for the format with an Accept header naming MIMETYPE or with
+format=binary in the query string or request body.
+"""
+import gzip
+import json
+
+import numpy as np
+from flask import Response, request
+
+from columnar import GEOMETRY_TYPES, lengths_to_offsets
+
+MAGIC = b"CAW1"
+MIMETYPE = "application/vnd.cell-annotator.wire"
+ALIGNMENT = 8
+COORDINATE_QUANTUM = 0.125  # Image pixels; whole-pixel coordinates are sent exactly with a quantum of 1
+COMPRESS_MIN_BYTES = 1024  # Smaller responses are sent uncompressed
+COMPRESS_LEVEL = 3  # Most of the size gain of higher levels at a fraction of their time
+
+
+def _padding(size):
+    return -size % ALIGNMENT
+
+
+def encode_message(arrays, **header):
+    """
+    Packs {name: ndarray} and the header fields into one message.
+    """
+    layout = {}
+    data = []
+    offset = 0
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values, dtype=np.asarray(values).dtype.newbyteorder("<"))
+        layout[name] = {"dtype": values.dtype.str, "offset": offset, "length": int(values.size)}
+        data.append(values.tobytes() + b"\0" * _padding(values.nbytes))
+        offset += len(data[-1])
+
+    header["arrays"] = layout
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * _padding(len(MAGIC) + 4 + len(header_bytes))
+    return b"".join([MAGIC, np.uint32(len(header_bytes)).astype("<u4").tobytes(), header_bytes, *data])
+
+
+def decode_message(data):
+    """
+    Returns (header, {name: ndarray}) of a message; the arrays are views of data.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a wire format message")
+    header_length = int(np.frombuffer(data, dtype="<u4", count=1, offset=len(MAGIC))[0])
+    start = len(MAGIC) + 4 + header_length
+    header = json.loads(bytes(data[len(MAGIC) + 4:start]))
+    arrays = {
+        name: np.frombuffer(data, dtype=entry["dtype"], count=entry["length"], offset=start + entry["offset"])
+        for name, entry in header.pop("arrays").items()
+    }
+    return header, arrays
+
+
+def quantize_coordinates(coords):
+    """
+    Returns coords (n x 2) as int32 multiples of a quantum from an origin, with
+    {"origin": [x, y], "quantum": q}. Coordinates are recovered as
+    origin + value * quantum, exactly for whole pixels and within half of
+    COORDINATE_QUANTUM otherwise.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    if len(coords) == 0:
+        return np.zeros((0, 2), dtype=np.int32), {"origin": [0, 0], "quantum": 1}
+    origin = np.floor(coords.min(axis=0))
+    quantum = 1 if np.array_equal(coords, np.round(coords)) else COORDINATE_QUANTUM
+    values = np.round((coords - origin) / quantum).astype(np.int32)
+    return values, {"origin": origin.tolist(), "quantum": quantum}
+
+
+def annotation_message(tables):
+    """
+    Message for {filename: query table} (see annotation_index.query_spatial_table).
+    The arrays of the i-th file are named "<i>/<column>": feature_types
+    (index into the header's geometry_types), feature_classes (index into the
+    file's classes), feature_parts, part_rings and ring_offsets (offsets, one
+    longer than their count) and coords (quantized x, y pairs).
+    """
+    arrays = {}
+    files = []
+    for index, (filename, table) in enumerate(tables.items()):
+        coords, quantization = quantize_coordinates(table["coords"])
+        prefix = f"{index}/"
+        arrays[prefix + "feature_types"] = table["feature_types"].astype(np.uint8)
+        arrays[prefix + "feature_classes"] = table["feature_classes"].astype(np.uint32)
+        arrays[prefix + "feature_parts"] = table["feature_parts"].astype(np.uint32)
+        arrays[prefix + "part_rings"] = table["part_rings"].astype(np.uint32)
+        arrays[prefix + "ring_offsets"] = table["ring_offsets"].astype(np.uint32)
+        arrays[prefix + "coords"] = coords
+        files.append({
+            "name": filename,
+            "feature_ids": table["feature_ids"],
+            "classes": table["classes"],
+            **quantization,
+        })
+    return encode_message(arrays, kind="annotations", geometry_types=GEOMETRY_TYPES, files=files)
+
+
+def hex_bin_message(hex_bins, **header):
+    """
+    Message for geojson_hex_bins documents. Per hex: annotation_counts,
+    boundary_offsets into boundary (float32 x, y image coordinates) and
+    class_offsets into class_ids (index into the header's class_names),
+    class_counts and class_colors (r, g, b bytes). Feature ids are listed once
+    in the header's feature_ids; feature_offsets index into features, which
+    holds positions in that list. Hex ids are in the header's hex_ids.
+    """
+    class_names, class_index = [], {}
+    feature_ids, feature_index = [], {}
+    boundaries, boundary_lengths = [], []
+    class_ids, class_counts, class_colors, class_lengths = [], [], [], []
+    features, feature_lengths = [], []
+    for hex_bin in hex_bins:
+        boundary = hex_bin.get("image_coordinates") or []
+        boundaries.extend(boundary)
+        boundary_lengths.append(len(boundary))
+
+        classifications = hex_bin.get("classifications") or {}
+        for name, classification in classifications.items():
+            if name not in class_index:
+                class_index[name] = len(class_names)
+                class_names.append(name)
+            class_ids.append(class_index[name])
+            class_counts.append(classification["count"])
+            class_colors.append((classification.get("color") or [0, 0, 0])[:3])
+        class_lengths.append(len(classifications))
+
+        hex_features = hex_bin.get("feature_ids") or []
+        for feature_id in hex_features:
+            key = json.dumps(feature_id)
+            if key not in feature_index:
+                feature_index[key] = len(feature_ids)
+                feature_ids.append(feature_id)
+            features.append(feature_index[key])
+        feature_lengths.append(len(hex_features))
+
+    arrays = {
+        "annotation_counts": np.array([hex_bin.get("annotation_count", 0) for hex_bin in hex_bins], dtype=np.uint32),
+        "boundary_offsets": lengths_to_offsets(boundary_lengths).astype(np.uint32),
+        "boundary": np.array(boundaries, dtype=np.float32).reshape(-1, 2),
+        "class_offsets": lengths_to_offsets(class_lengths).astype(np.uint32),
+        "class_ids": np.array(class_ids, dtype=np.uint32),
+        "class_counts": np.array(class_counts, dtype=np.uint32),
+        "class_colors": np.array(class_colors, dtype=np.uint8).reshape(-1, 3),
+        "feature_offsets": lengths_to_offsets(feature_lengths).astype(np.uint32),
+        "features": np.array(features, dtype=np.uint32),
+    }
+    return encode_message(
+        arrays, kind="hex_bins", hex_ids=[hex_bin.get("hex_id") for hex_bin in hex_bins],
+        class_names=class_names, feature_ids=feature_ids, **header,
+    )
+
+
+def wants_binary(data=None):
+    """
+    True when the current request asks for the binary format: an Accept header
+    naming MIMETYPE, or format=binary in the query string or JSON body.
+    """
+    if request.args.get("format") == "binary" or (data or {}).get("format") == "binary":
+        return True
+    return any(value == MIMETYPE for value in request.accept_mimetypes.values())
+
+
+def compressed_response(body, mimetype, status=200):
+    """
+    Response with the given bytes, gzipped when the client accepts gzip.
+    """
+    response = Response(body, status=status, mimetype=mimetype)
+    if len(body) >= COMPRESS_MIN_BYTES and "gzip" in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=COMPRESS_LEVEL))
+        response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def binary_response(message, status=200):
+    """
+    Response carrying a message to a client that chose the format with its Accept header.
+    """
+    response = compressed_response(message, MIMETYPE, status)
+    response.vary.add("Accept")
+    return response